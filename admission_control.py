@@ -0,0 +1,250 @@
+"""Per-model admission control and throttling-aware retries for Bedrock calls.
+
+Every model ID gets an AIMD concurrency limit: each successful call raises it by about one
+slot per window of calls, and each throttle halves it. Calls wait for a free slot before they
+go out. Throttled calls and transient failures (5xx, model timeouts, dropped or timed-out
+connections) are retried with full-jitter exponential backoff, but only while the backoff
+still fits in the time the Lambda has left; only throttles lower the limit. Streamed calls
+hold their slot until the stream has been read or closed. Throttles, retries and the model's
+current limit are added to the invocation's telemetry record.
+"""
+import contextvars
+import random
+import threading
+import time
+from collections import Counter
+
+import telemetry
+
+# Error codes Bedrock returns when a model is over its quota or briefly unavailable
+THROTTLING_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+    "ModelNotReadyException", "RequestLimitExceeded", "429", "503",
+}
+
+# Error codes of failures that are worth retrying but say nothing about the model's capacity
+TRANSIENT_CODES = {
+    "InternalServerException", "InternalFailure", "ModelTimeoutException", "ModelStreamErrorException",
+    "RequestTimeout", "RequestTimeoutException",
+}
+
+# time.monotonic() by which the current invocation has to return, set from the Lambda context
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+def set_deadline(seconds_remaining, margin=0.0):
+    """Sets the deadline of the current context; returns the token for reset_deadline."""
+    if seconds_remaining is None:
+        return _deadline.set(None)
+    return _deadline.set(time.monotonic() + seconds_remaining - margin)
+
+
+def reset_deadline(token):
+    _deadline.reset(token)
+
+
+def time_remaining():
+    """Seconds left before the deadline, or None when there is no deadline."""
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def _error_code(error):
+    # Errors raised inside a response stream use camel case (throttlingException)
+    response = getattr(error, "response", None) or {}
+    code = str(response.get("Error", {}).get("Code") or "")
+    return code[:1].upper() + code[1:], response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+
+
+def is_throttle(error):
+    code, status = _error_code(error)
+    return code in THROTTLING_CODES or status in (429, 503)
+
+
+def is_transient(error):
+    """True for server errors, model timeouts and connection or read-timeout failures."""
+    from botocore.exceptions import ConnectionError, HTTPClientError
+    if isinstance(error, (ConnectionError, HTTPClientError)):
+        return True
+    code, status = _error_code(error)
+    return code in TRANSIENT_CODES or (status is not None and status >= 500)
+
+
+def throttling_error(model_id, message):
+    """A ClientError shaped like Bedrock's own throttle, so callers handle both the same way."""
+    from botocore.exceptions import ClientError
+    return ClientError({"Error": {"Code": "ThrottlingException", "Message": message}}, f"InvokeModel {model_id}")
+
+
+class AimdLimiter:
+    """An additive-increase, multiplicative-decrease concurrency limit for one model."""
+    def __init__(self, initial=4, minimum=1, maximum=16, decrease_factor=0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.metrics = Counter()
+        self._condition = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """Waits for a slot; returns False when none freed up within timeout seconds."""
+        with self._condition:
+            queued = self.in_flight >= int(self.limit)
+            if queued:
+                self.metrics["queued"] += 1
+            admitted = self._condition.wait_for(lambda: self.in_flight < int(self.limit), timeout)
+            if not admitted:
+                self.metrics["rejected"] += 1
+            else:
+                self.in_flight += 1
+        if queued:
+            telemetry.count("admission_queued")
+        return admitted
+
+    def release(self, throttled=False, failed=False):
+        """
+        Frees a slot. A throttle halves the limit and a success raises it; any other failure
+        leaves it alone, since it says nothing about the model's capacity. Returns the new limit.
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.metrics["throttles"] += 1
+                self.limit = max(self.minimum, self.limit * self.decrease_factor)
+            elif failed:
+                self.metrics["failures"] += 1
+            else:
+                self.metrics["successes"] += 1
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            limit = self.limit
+        telemetry.gauge("admission_limit", round(limit, 2))
+        return limit
+
+    def stats(self):
+        with self._condition:
+            return dict(self.metrics, limit=round(self.limit, 2), in_flight=self.in_flight)
+
+
+class AdmissionController:
+    """Holds the per-model limiters and runs calls through them with adaptive retries."""
+    def __init__(self, initial=4, minimum=1, maximum=16, max_attempts=4, base_delay=0.2, max_delay=5.0):
+        self.initial = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.metrics = Counter()
+        self._limiters = {}
+        self._lock = threading.Lock()
+
+    def limiter(self, model_id):
+        with self._lock:
+            limiter = self._limiters.get(model_id)
+            if limiter is None:
+                limiter = self._limiters[model_id] = AimdLimiter(self.initial, self.minimum, self.maximum)
+            return limiter
+
+    def _count(self, name):
+        with self._lock:
+            self.metrics[name] += 1
+        telemetry.count(f"admission_{name}")
+
+    def backoff(self, attempt):
+        """Full jitter: a uniform delay up to the exponential cap, so retries don't line up."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def _retry_delay(self, error, attempt):
+        """
+        Counts a failed attempt; returns the backoff before retrying it, or None when it
+        mustn't be retried (not retryable, out of attempts or out of time).
+        """
+        if is_throttle(error):
+            self._count("throttles")
+        elif is_transient(error):
+            self._count("transient_errors")
+        else:
+            return None
+        if attempt >= self.max_attempts:
+            self._count("gave_up")
+            return None
+        delay = self.backoff(attempt)
+        remaining = time_remaining()
+        if remaining is not None and delay >= remaining:
+            self._count("deadline_exceeded")
+            return None
+        self._count("retries")
+        return delay
+
+    def _acquire(self, model_id, limiter):
+        if not limiter.acquire(timeout=time_remaining()):
+            self._count("deadline_exceeded")
+            raise throttling_error(model_id, f"No capacity for {model_id} before the invocation deadline")
+
+    def call(self, model_id, function):
+        """
+        Calls function() inside a slot of the model's limiter, retrying throttles and transient
+        failures with jittered backoff while attempts and the invocation's remaining time allow.
+        """
+        limiter = self.limiter(model_id)
+        attempt = 0
+        while True:
+            self._acquire(model_id, limiter)
+            try:
+                result = function()
+            except Exception as error:
+                throttled = is_throttle(error)
+                limiter.release(throttled, failed=not throttled)
+                attempt += 1
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            limiter.release()
+            return result
+
+    def stream(self, model_id, open_stream):
+        """
+        Yields the events of open_stream() while holding a slot of the model's limiter, which is
+        released once the stream is exhausted, fails or is closed. Failures before the first
+        event are retried like call(); after it they are raised, and a throttle still halves
+        the limit.
+        """
+        limiter = self.limiter(model_id)
+        attempt = 0
+        while True:
+            self._acquire(model_id, limiter)
+            started = False
+            try:
+                for event in open_stream():
+                    started = True
+                    yield event
+            except GeneratorExit:
+                # The reader stopped early; that says nothing about the model's capacity
+                limiter.release(failed=True)
+                raise
+            except Exception as error:
+                throttled = is_throttle(error)
+                limiter.release(throttled, failed=not throttled)
+                if started:
+                    if throttled:
+                        self._count("throttles")
+                    raise
+                attempt += 1
+                delay = self._retry_delay(error, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                continue
+            limiter.release()
+            return
+
+    def stats(self):
+        """Retry counters and the state of every model's limiter."""
+        with self._lock:
+            limiters = dict(self._limiters)
+            metrics = dict(self.metrics)
+        return dict(metrics, models={model_id: limiter.stats() for model_id, limiter in limiters.items()})
@@ -0,0 +1,276 @@
+"""Load generator for the Streamlit client path: lambda_handler -> askQuestion -> decode_response.
+
+Replays a question set through streamlit_app/invoke_agent.lambda_handler at a fixed
+concurrency against the local mock agent runtime (benchmarks/mock_agent_runtime.py), or
+against --url when a mock is already running elsewhere. Each question gets its own agent
+session. For every concurrency level the run reports:
+  - end-to-end latency (p50/p95/p99) of lambda_handler, signing and HTTP included
+  - decode latency (p50/p95/p99): time spent in decode_response minus the time spent
+    waiting for bytes from the socket, i.e. the client's own frame parsing and assembly
+  - time to first byte (p50), requests per second and response bytes per second
+The built-in mock shares the process (and the GIL) with the client; at high concurrency run
+the mock separately and pass --url, so the numbers are the client's alone.
+
+--client async sends the same questions through streamlit_app/async_invoke_agent's
+AsyncAgentClient instead, all from one event loop with the concurrency as its max_concurrency.
+Its decode latency is the time spent parsing frames and assembling the response, and its
+time to first byte is the time to the first decoded event.
+
+Usage:
+    python benchmarks/agent_load.py [--requests 200] [--concurrency 1 8 32] [--questions questions.txt]
+                                    [--client sync|async]
+                                    [--trace-events 20] [--trace-padding 512] [--answer-bytes 2048]
+                                    [--frame-delay 0.0] [--chunk-delay 0.0] [--jitter 0.0]
+                                    [--trace-level off|summary|full]
+                                    [--url http://127.0.0.1:8765] [--json]
+"""
+import argparse
+import asyncio
+import contextlib
+import contextvars
+import io
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCHMARK_DIR), "streamlit_app"))
+sys.path.insert(0, BENCHMARK_DIR)
+# The client signs every request; the mock doesn't check the signature
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+import mock_agent_runtime
+import invoke_agent
+import async_invoke_agent
+
+DEFAULT_QUESTIONS = [
+    "Use model anthropic.claude-3-haiku-20240307-v1:0 and tell me a fact about rivers.",
+    "Use model amazon.titan-image-generator-v1 and create an image of a canoe on a lake.",
+    "Use model anthropic.claude-3-sonnet-20240229-v1:0 and describe the uploaded image.",
+    "Use model meta.llama2-13b-chat-v1 and explain how many apples are left.",
+    "Use model stability.stable-diffusion-xl-v1 and draw an astronaut riding a horse.",
+]
+
+# Timings of the request the current thread is sending, filled in by TimedResponse
+_timings = threading.local()
+
+# [seconds parsing event frames, bytes received] of the current asyncio task, filled in by
+# timed_parse_event_message and CountingEventStreamBuffer
+_async_timings = contextvars.ContextVar("async_timings", default=None)
+
+
+class TimedResponse:
+    """Wraps a streamed requests response and records socket wait time, first byte and bytes read."""
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+
+    @property
+    def text(self):
+        return self.response.text
+
+    def iter_content(self, chunk_size=1):
+        chunks = self.response.iter_content(chunk_size=chunk_size)
+        while True:
+            start = time.perf_counter()
+            data = next(chunks, None)
+            now = time.perf_counter()
+            _timings.wait += now - start
+            if data is None:
+                return
+            if _timings.first_byte is None:
+                _timings.first_byte = now
+            _timings.bytes += len(data)
+            yield data
+
+
+def timed_decode_response(decode_response):
+    """Wraps decode_response so it times decoding separately from waiting on the network."""
+    def decode(response, *args):
+        start = time.perf_counter()
+        try:
+            return decode_response(TimedResponse(response), *args)
+        finally:
+            _timings.decode = time.perf_counter() - start - _timings.wait
+    return decode
+
+
+def timed_parse_event_message(parse_event_message):
+    """Wraps parse_event_message so the async client's frame parsing is timed per task."""
+    def parse(message):
+        start = time.perf_counter()
+        try:
+            return parse_event_message(message)
+        finally:
+            timings = _async_timings.get()
+            if timings is not None:
+                timings[0] += time.perf_counter() - start
+    return parse
+
+
+class CountingEventStreamBuffer(async_invoke_agent.EventStreamBuffer):
+    """Counts the response bytes the async client feeds into its frame buffer."""
+    def add_data(self, data):
+        timings = _async_timings.get()
+        if timings is not None:
+            timings[1] += len(data)
+        super().add_data(data)
+
+
+def load_questions(path):
+    if not path:
+        return DEFAULT_QUESTIONS
+    with open(path) as f:
+        questions = [line.strip() for line in f if line.strip()]
+    if not questions:
+        raise SystemExit(f"No questions in {path}")
+    return questions
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def send(question, trace_level=None):
+    """Asks one question through lambda_handler in a new session; returns its timings."""
+    _timings.wait = 0.0
+    _timings.decode = 0.0
+    _timings.bytes = 0
+    _timings.first_byte = None
+    event = {"sessionId": str(uuid.uuid4()), "question": question, "endSession": False, "traceLevel": trace_level}
+    start = time.perf_counter()
+    response = invoke_agent.lambda_handler(event, None)
+    end = time.perf_counter()
+    if response["status_code"] != 200:
+        raise RuntimeError(json.loads(response["body"]).get("error"))
+    first_byte = _timings.first_byte if _timings.first_byte is not None else end
+    return end - start, _timings.decode, first_byte - start, _timings.bytes
+
+
+async def send_async(client, question, trace_level=None):
+    """Asks one question through AsyncAgentClient in a new session; returns its timings."""
+    timings = [0.0, 0]
+    _async_timings.set(timings)
+    first_event = None
+    events = []
+    start = time.perf_counter()
+    async for event in client.iter_events(question, str(uuid.uuid4()), trace_level=trace_level):
+        if first_event is None:
+            first_event = time.perf_counter()
+        events.append(event)
+    assembled = time.perf_counter()
+    invoke_agent.collect_response(events, trace_level)
+    end = time.perf_counter()
+    return end - start, timings[0] + end - assembled, (first_event or end) - start, timings[1]
+
+
+async def run_async(questions, concurrency, requests, trace_level=None):
+    """Sends requests questions through one AsyncAgentClient from concurrency worker tasks."""
+    replay = itertools.islice(itertools.cycle(questions), requests)
+    samples = []
+
+    async def worker(client):
+        for question in replay:
+            samples.append(await send_async(client, question, trace_level))
+
+    async with async_invoke_agent.AsyncAgentClient(max_concurrency=concurrency) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concurrency)))
+    return samples
+
+
+def run_level(questions, concurrency, requests, trace_level=None, client="sync"):
+    start = time.perf_counter()
+    if client == "async":
+        samples = asyncio.run(run_async(questions, concurrency, requests, trace_level))
+    else:
+        replay = itertools.islice(itertools.cycle(questions), requests)
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            samples = list(pool.map(lambda question: send(question, trace_level), replay))
+    wall = time.perf_counter() - start
+
+    end_to_end = [sample[0] * 1000 for sample in samples]
+    decode = [sample[1] * 1000 for sample in samples]
+    first_byte = [sample[2] * 1000 for sample in samples]
+    total_bytes = sum(sample[3] for sample in samples)
+    return {
+        "concurrency": concurrency,
+        "requests": requests,
+        "end_to_end_ms": {name: round(percentile(end_to_end, fraction), 2)
+                          for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "decode_ms": {name: round(percentile(decode, fraction), 3)
+                      for name, fraction in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "first_byte_p50_ms": round(percentile(first_byte, 0.5), 2),
+        "requests_per_s": round(requests / wall, 1),
+        "bytes_per_s": round(total_bytes / wall),
+        "bytes_per_request": round(total_bytes / requests),
+    }
+
+
+def print_report(results):
+    print(f"{'conc':>5}{'e2e p50':>10}{'p95':>9}{'p99':>9}{'decode p50':>12}{'p95':>8}{'p99':>8}"
+          f"{'ttfb':>9}{'req/s':>9}{'MB/s':>8}")
+    for r in results:
+        e2e, decode = r["end_to_end_ms"], r["decode_ms"]
+        print(f"{r['concurrency']:>5}{e2e['p50']:>8.1f}ms{e2e['p95']:>7.1f}ms{e2e['p99']:>7.1f}ms"
+              f"{decode['p50']:>10.2f}ms{decode['p95']:>6.2f}ms{decode['p99']:>6.2f}ms"
+              f"{r['first_byte_p50_ms']:>7.1f}ms{r['requests_per_s']:>9.1f}{r['bytes_per_s'] / 1e6:>8.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=200, help="questions sent per concurrency level")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32], help="questions in flight at once")
+    parser.add_argument("--questions", help="file with one question per line (default: a built-in set)")
+    parser.add_argument("--url", help="base URL of a running mock agent runtime (default: start one)")
+    parser.add_argument("--trace-events", type=int, default=20, help="trace frames per response")
+    parser.add_argument("--trace-padding", type=int, default=512, help="bytes of filler text per trace frame")
+    parser.add_argument("--answer-bytes", type=int, default=2048, help="size of the answer text")
+    parser.add_argument("--answer-chunks", type=int, default=16, help="chunk frames the answer is split into")
+    parser.add_argument("--frame-delay", type=float, default=0.0, help="seconds between trace frames")
+    parser.add_argument("--chunk-delay", type=float, help="seconds between chunk frames (default: --frame-delay)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative random variation of every delay")
+    parser.add_argument("--trace-level", choices=invoke_agent.TRACE_LEVELS, help="trace level of every question "
+                        "(default: AGENT_TRACE_LEVEL or full)")
+    parser.add_argument("--client", choices=("sync", "async"), default="sync",
+                        help="send through invoke_agent.lambda_handler threads or one AsyncAgentClient")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    base_url = args.url
+    if base_url is None:
+        config = mock_agent_runtime.MockAgentConfig(
+            args.trace_events, args.trace_padding, answer_chunks=args.answer_chunks, frame_delay=args.frame_delay,
+            chunk_delay=args.chunk_delay, jitter=args.jitter, answer_bytes=args.answer_bytes
+        )
+        server, base_url = mock_agent_runtime.start_mock_server(config)
+    invoke_agent.get_agent_url = lambda session_id: mock_agent_runtime.agent_url(base_url, session_id)
+    invoke_agent.decode_response = timed_decode_response(invoke_agent.decode_response)
+    if args.client == "async":
+        invoke_agent.parse_event_message = timed_parse_event_message(invoke_agent.parse_event_message)
+        async_invoke_agent.EventStreamBuffer = CountingEventStreamBuffer
+    # One pooled connection per worker, so the run measures the client rather than pool waits
+    invoke_agent._default_transport = invoke_agent.SigV4Transport(pool_size=max(args.concurrency), retries=0)
+
+    questions = load_questions(args.questions)
+    # lambda_handler prints every question; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        send(questions[0])  # warm up the connection pool and credentials
+        results = [run_level(questions, level, args.requests, args.trace_level, args.client)
+                   for level in args.concurrency]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
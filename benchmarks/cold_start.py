@@ -0,0 +1,125 @@
+"""Cold-start benchmark for lambda_function.py.
+
+Every branch runs in a fresh interpreter so each sample is a real cold start:
+the module import, SDK client setup and the first invocation (which pays for the
+branch's lazy imports) are timed separately, followed by one warm invocation.
+Bedrock and S3 are replaced with the local stubs in benchmarks/stubs.py.
+
+Usage:
+    python benchmarks/cold_start.py [--repeat 5] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+
+# branch name -> (model ID, prompt, whether the input image exists in S3, text engine)
+BRANCHES = {
+    "claude-text": ("anthropic.claude-3-haiku-20240307-v1:0", "Tell me a fact about rivers.", False, "native"),
+    "claude-multimodal": ("anthropic.claude-3-sonnet-20240229-v1:0", "Describe the uploaded image.", True, "native"),
+    "stability": ("stability.stable-diffusion-xl-v1", "An astronaut riding a horse.", False, "native"),
+    "titan-generate": ("amazon.titan-image-generator-v1", "A woman in a boat on a river.", False, "native"),
+    "titan-inpaint": ("amazon.titan-image-generator-v1", "Change the boat to a canoe.", True, "native"),
+    "native-text": ("meta.llama2-13b-chat-v1", "How many apples are left?", False, "native"),
+    "langchain-text": ("meta.llama2-13b-chat-v1", "How many apples are left?", False, "langchain"),
+}
+
+
+def run_child(branch):
+    """Measures one cold start of a branch and prints the result as JSON."""
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+    model_id, prompt, with_image, engine = BRANCHES[branch]
+    # lambda_function reads the engine at import time
+    os.environ["BWB_TEXT_ENGINE"] = engine
+    sys.path.insert(0, REPO_ROOT)
+    sys.path.insert(0, BENCHMARK_DIR)
+    import stubs
+
+    result = {"branch": branch}
+
+    modules_before = set(sys.modules)
+    start = time.perf_counter()
+    import lambda_function
+    result["import_ms"] = (time.perf_counter() - start) * 1000
+
+    # Real clients are built (no network calls) so boto3's import and setup are counted
+    start = time.perf_counter()
+    lambda_function.get_s3_client()
+    lambda_function.get_bedrock_client()
+    result["client_setup_ms"] = (time.perf_counter() - start) * 1000
+
+    event = stubs.action_group_event(model_id, prompt)
+    _, s3 = stubs.install(lambda_function)
+    if with_image:
+        stubs.seed_session_image(lambda_function, s3, event["sessionId"])
+
+    start = time.perf_counter()
+    response = lambda_function.lambda_handler(event, None)
+    result["first_invocation_ms"] = (time.perf_counter() - start) * 1000
+    result["status"] = response["response"]["httpStatusCode"]
+
+    start = time.perf_counter()
+    lambda_function.lambda_handler(event, None)
+    result["warm_invocation_ms"] = (time.perf_counter() - start) * 1000
+
+    loaded = set(sys.modules) - modules_before
+    result["heavy_modules"] = sorted(name for name in ("boto3", "PIL", "langchain") if name in loaded)
+    return result
+
+
+def measure(branch, repeat):
+    samples = []
+    for _ in range(repeat):
+        completed = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", branch],
+            capture_output=True, text=True
+        )
+        if completed.returncode != 0:
+            error = completed.stderr.strip().splitlines()
+            return {"branch": branch, "skipped": error[-1] if error else "child process failed"}
+        samples.append(json.loads(completed.stdout.strip().splitlines()[-1]))
+
+    summary = {"branch": branch, "heavy_modules": samples[-1]["heavy_modules"]}
+    for field in ("import_ms", "client_setup_ms", "first_invocation_ms", "warm_invocation_ms"):
+        summary[field] = round(statistics.median(sample[field] for sample in samples), 2)
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5, help="cold starts per branch (median is reported)")
+    parser.add_argument("--branch", choices=sorted(BRANCHES), action="append", help="limit to these branches")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # The handler prints its own logs; only the last stdout line is the result
+        print(json.dumps(run_child(args.child)))
+        return
+
+    results = [measure(branch, args.repeat) for branch in (args.branch or BRANCHES)]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'branch':<20}{'import':>10}{'clients':>10}{'first':>10}{'warm':>10}  lazy imports")
+    for result in results:
+        if "skipped" in result:
+            print(f"{result['branch']:<20}skipped: {result['skipped']}")
+            continue
+        print(f"{result['branch']:<20}{result['import_ms']:>9.1f}ms{result['client_setup_ms']:>8.1f}ms"
+              f"{result['first_invocation_ms']:>8.1f}ms{result['warm_invocation_ms']:>8.1f}ms  "
+              f"{', '.join(result['heavy_modules'])}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,284 @@
+"""End-to-end benchmark of lambda_handler for every provider branch, gated on a stored baseline.
+
+Each branch runs through lambda_handler against the local Bedrock and S3 stubs in
+benchmarks/stubs.py (recorded-shape fixtures, optional simulated model latency). For every
+branch the suite reports:
+  - per-stage latency: the median of each telemetry span over --iterations invocations
+  - total latency (p50/p95) over the same invocations, and the peak memory allocated
+    during one invocation (tracemalloc; the median over the invocations, so a one-off
+    allocation doesn't decide the result)
+  - throughput in invocations per second at each --concurrency level, with every model
+    call taking --latency seconds (best of --rounds)
+Latency and memory are measured without simulated model latency, so they are the handler's
+own overhead. The response cache is bypassed so every invocation exercises the model path.
+Before measuring, every branch is checked to dispatch its model exactly once per event (one
+model_invocations entry and one Bedrock call); a branch that doesn't is reported as failed.
+
+With --baseline the run is compared with a stored result and the script exits with status 1
+when a branch regresses by more than --tolerance, so it can gate changes to the hot paths.
+Every branch run is required: one that was skipped (e.g. LangChain isn't installed) or has no
+baseline entry fails the gate too, unless it is named with --allow-skipped. p95 is only
+compared for runs of at least MIN_P95_ITERATIONS invocations; in a shorter run it is just
+the slowest invocation or two. The gate also fails when a module copied into streamlit_app/
+differs from its original (see shared_modules.py). --update-baseline writes the current run as the new baseline,
+and refuses to when a required branch was skipped.
+
+When the report is piped (| tee, | tail), the pipeline's status is the last command's; run
+the gate with `set -o pipefail` so a regression still fails the build.
+
+Usage:
+    python benchmarks/end_to_end.py [--iterations 200] [--concurrency 1 4 16] [--latency 0.01]
+                                    [--baseline benchmarks/baseline.json [--tolerance 0.25]]
+                                    [--allow-skipped langchain-text]
+                                    [--update-baseline benchmarks/baseline.json] [--json]
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-west-2")
+
+import stubs
+import shared_modules
+import lambda_function
+
+# branch name -> (model ID, prompt, whether the session has an input image, text engine)
+BRANCHES = {
+    "claude-text": ("anthropic.claude-3-haiku-20240307-v1:0", "Tell me a fact about rivers.", False, "native"),
+    "claude-multimodal": ("anthropic.claude-3-sonnet-20240229-v1:0", "Describe the uploaded image.", True, "native"),
+    "stability": ("stability.stable-diffusion-xl-v1", "An astronaut riding a horse.", False, "native"),
+    "titan-generate": ("amazon.titan-image-generator-v1", "A woman in a boat on a river.", False, "native"),
+    "titan-inpaint": ("amazon.titan-image-generator-v1", "Change the boat to a canoe.", True, "native"),
+    "native-text": ("meta.llama2-13b-chat-v1", "How many apples are left?", False, "native"),
+    "langchain-text": ("meta.llama2-13b-chat-v1", "How many apples are left?", False, "langchain"),
+}
+
+# Differences below these floors are noise, whatever the relative change
+LATENCY_FLOOR_MS = 1.0
+MEMORY_FLOOR_KB = 256
+# Below this many invocations p95 is too close to the maximum to gate on
+MIN_P95_ITERATIONS = 100
+
+
+class LambdaContext:
+    aws_request_id = "benchmark"
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class TelemetryCollector:
+    """Collects the EMF records lambda_handler emits instead of printing them."""
+    def __init__(self):
+        self.records = []
+
+    def __call__(self, record):
+        self.records.append(record.record())
+
+
+def setup_branch(branch):
+    model_id, prompt, with_image, engine = BRANCHES[branch]
+    lambda_function.text_engine = engine
+    bedrock, s3 = stubs.install(lambda_function)
+    event = stubs.action_group_event(model_id, prompt, cache="false")
+    if with_image:
+        stubs.seed_session_image(lambda_function, s3, event["sessionId"])
+    return event, bedrock
+
+
+def invoke(event):
+    response = lambda_function.lambda_handler(event, LambdaContext())
+    status = response["response"]["httpStatusCode"]
+    body = response["response"]["responseBody"]["application/json"]["body"]
+    if status != 200 or "Failed" in str(body) or "error occurred" in str(body):
+        raise RuntimeError(f"status {status}: {str(body)[:200]}")
+
+
+class DispatchError(Exception):
+    """Raised when an event doesn't run its model exactly once."""
+
+
+def check_single_dispatch(event, bedrock):
+    """Invokes once and checks the event added one model_invocations entry and one Bedrock call."""
+    model_id = next(item["value"] for item in event["parameters"] if item["name"] == "modelId")
+    dispatches = lambda_function.model_invocations[model_id]
+    calls = len(bedrock.calls)
+    invoke(event)
+    dispatches = lambda_function.model_invocations[model_id] - dispatches
+    calls = len(bedrock.calls) - calls
+    if dispatches != 1 or calls != 1:
+        raise DispatchError(f"one event ran {dispatches} model dispatch(es) and {calls} Bedrock call(s), expected 1 of each")
+
+
+def measure_latency(event, iterations):
+    """Per-stage medians, total p50/p95 and per-invocation peak memory over sequential invocations."""
+    collector = TelemetryCollector()
+    emit, lambda_function.telemetry.emit = lambda_function.telemetry.emit, collector
+    try:
+        invoke(event)  # warm up pools and caches
+        collector.records.clear()
+        peaks = []
+        tracemalloc.start()
+        for _ in range(iterations):
+            before, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            invoke(event)
+            peaks.append(tracemalloc.get_traced_memory()[1] - before)
+        tracemalloc.stop()
+    finally:
+        lambda_function.telemetry.emit = emit
+
+    stages = {}
+    for record in collector.records:
+        for name, value in record.items():
+            if name.endswith("_ms") and name != "total_ms":
+                stages.setdefault(name[:-3], []).append(value)
+    totals = sorted(record["total_ms"] for record in collector.records)
+    return {
+        "p50_ms": round(statistics.median(totals), 3),
+        "p95_ms": round(totals[min(len(totals) - 1, int(0.95 * len(totals)))], 3),
+        "stages_ms": {name: round(statistics.median(values), 3) for name, values in stages.items()},
+        "peak_kb": round(statistics.median(peaks) / 1024, 1),
+    }
+
+
+def measure_throughput(event, concurrency, invocations, rounds):
+    """Invocations per second with concurrency invocations in flight, best of rounds."""
+    best = 0.0
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for _ in range(rounds):
+            start = time.perf_counter()
+            list(pool.map(lambda _: invoke(event), range(invocations)))
+            best = max(best, invocations / (time.perf_counter() - start))
+    return round(best, 1)
+
+
+def run_branch(branch, args):
+    event, bedrock = setup_branch(branch)
+    try:
+        check_single_dispatch(event, bedrock)
+    except DispatchError as e:
+        return {"branch": branch, "failed": str(e)}
+    except Exception as e:
+        return {"branch": branch, "skipped": f"{type(e).__name__}: {e}"}
+    try:
+        result = {"branch": branch}
+        result.update(measure_latency(event, args.iterations))
+        bedrock.latency = args.latency
+        result["throughput_rps"] = {
+            str(level): measure_throughput(event, level, max(level * 8, 16), args.rounds) for level in args.concurrency
+        }
+        return result
+    except Exception as e:
+        return {"branch": branch, "skipped": f"{type(e).__name__}: {e}"}
+
+
+def compare(results, baseline, tolerance, iterations, allow_skipped=()):
+    """
+    Returns the regressions of results against baseline, one message each. A branch that was
+    skipped, or that the baseline has no result for, counts as one unless it is allowed.
+    """
+    baseline = {entry["branch"]: entry for entry in baseline["results"]}
+    fields = ("p50_ms", "p95_ms") if iterations >= MIN_P95_ITERATIONS else ("p50_ms",)
+    regressions = []
+    for result in results:
+        branch = result["branch"]
+        base = baseline.get(branch)
+        if "failed" in result:
+            regressions.append(f"{branch}: {result['failed']}")
+            continue
+        if "skipped" in result:
+            if branch not in allow_skipped:
+                regressions.append(f"{branch}: skipped ({result['skipped']})")
+            continue
+        if base is None or "skipped" in base:
+            if branch not in allow_skipped:
+                regressions.append(f"{branch}: no baseline result; regenerate it with --update-baseline")
+            continue
+        for field in fields:
+            if result[field] > base[field] * (1 + tolerance) and result[field] - base[field] > LATENCY_FLOOR_MS:
+                regressions.append(f"{branch}: {field} {base[field]} -> {result[field]}")
+        if result["peak_kb"] > base["peak_kb"] * (1 + tolerance) and result["peak_kb"] - base["peak_kb"] > MEMORY_FLOOR_KB:
+            regressions.append(f"{branch}: peak_kb {base['peak_kb']} -> {result['peak_kb']}")
+        for level, rps in result["throughput_rps"].items():
+            base_rps = base["throughput_rps"].get(level)
+            if base_rps and rps < base_rps * (1 - tolerance):
+                regressions.append(f"{branch}: throughput at concurrency {level} {base_rps} -> {rps} rps")
+    return regressions
+
+
+def print_report(results):
+    levels = next((list(r["throughput_rps"]) for r in results if "throughput_rps" in r), [])
+    header = f"{'branch':<19}{'p50':>9}{'p95':>9}{'peak KB':>10}" + "".join(f"{'rps@' + level:>10}" for level in levels)
+    print(header + "  slowest stages")
+    for r in results:
+        if "skipped" in r or "failed" in r:
+            print(f"{r['branch']:<19}" + (f"skipped: {r['skipped']}" if "skipped" in r else f"FAILED: {r['failed']}"))
+            continue
+        slowest = sorted(r["stages_ms"].items(), key=lambda item: -item[1])[:3]
+        print(f"{r['branch']:<19}{r['p50_ms']:>7.2f}ms{r['p95_ms']:>7.2f}ms{r['peak_kb']:>10.1f}"
+              + "".join(f"{r['throughput_rps'][level]:>10.1f}" for level in levels)
+              + "  " + ", ".join(f"{name} {value:.2f}ms" for name, value in slowest))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200, help="invocations per branch for latency and memory")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 4, 16], help="throughput concurrency levels")
+    parser.add_argument("--latency", type=float, default=0.01, help="simulated seconds per model call in the throughput runs")
+    parser.add_argument("--rounds", type=int, default=3, help="throughput rounds per level (the best is reported)")
+    parser.add_argument("--branch", choices=sorted(BRANCHES), action="append", help="limit to these branches")
+    parser.add_argument("--baseline", help="baseline JSON to compare with; exits 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative regression")
+    parser.add_argument("--allow-skipped", choices=sorted(BRANCHES), action="append", default=[],
+                        help="a branch that may be skipped or missing from the baseline without failing the gate")
+    parser.add_argument("--update-baseline", help="write this run to the given baseline JSON")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    lambda_function.logger.disabled = True
+    # The handler logs every event and result; keep the report readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        results = [run_branch(branch, args) for branch in (args.branch or BRANCHES)]
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+    if args.update_baseline:
+        skipped = [r["branch"] for r in results
+                   if "failed" in r or ("skipped" in r and r["branch"] not in args.allow_skipped)]
+        if skipped:
+            print(f"Not writing {args.update_baseline}: required branch(es) skipped or failed: {', '.join(skipped)}")
+            sys.exit(1)
+        with open(args.update_baseline, "w") as f:
+            json.dump({"iterations": args.iterations, "latency": args.latency,
+                       "results": [r for r in results if "skipped" not in r and "failed" not in r]}, f, indent=2)
+            f.write("\n")
+        print(f"Baseline written to {args.update_baseline}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance, args.iterations, args.allow_skipped)
+        regressions += [f"streamlit_app/{name} differs from {name}" for name in shared_modules.differing_copies()]
+        if regressions:
+            print(f"{len(regressions)} regression(s) beyond {args.tolerance:.0%} of {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} of {args.baseline}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+"""A local mock of the bedrock-agent-runtime InvokeAgent endpoint.
+
+POST /agents/{agentId}/agentAliases/{aliasId}/sessions/{sessionId}/text answers with
+AWS event-stream frames (with valid prelude and message CRCs): a configurable number of
+trace events shaped like a real orchestration run (model invocations, rationales, action
+group calls, knowledge base lookups and the final response) followed by the answer split
+into chunk events. Trace and chunk frames are paced separately, with optional jitter, so
+the mock can stand in for a slow planner or a fast token stream. Point the Streamlit client
+or the asyncio client at it by passing its URL; benchmarks/agent_load.py drives it under load.
+
+Usage:
+    python benchmarks/mock_agent_runtime.py [--port 8765] [--trace-events 20] [--frame-delay 0.01]
+                                            [--chunk-delay 0.005] [--jitter 0.5] [--answer-bytes 2048]
+"""
+import argparse
+import base64
+import binascii
+import json
+import random
+import re
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+PATH_PATTERN = re.compile(r"^/agents/[^/]+/agentAliases/[^/]+/sessions/(?P<session>[^/]+)/text$")
+
+
+def encode_header(name, value):
+    name = name.encode("utf-8")
+    value = value.encode("utf-8")
+    # Header value type 7 is a string with a 2-byte length
+    return struct.pack(">B", len(name)) + name + b"\x07" + struct.pack(">H", len(value)) + value
+
+
+def encode_frame(headers, payload):
+    """Encodes one event-stream message: prelude, prelude CRC, headers, payload, message CRC."""
+    encoded_headers = b"".join(encode_header(name, value) for name, value in headers.items())
+    total_length = 16 + len(encoded_headers) + len(payload)
+    prelude = struct.pack(">II", total_length, len(encoded_headers))
+    prelude += struct.pack(">I", binascii.crc32(prelude) & 0xFFFFFFFF)
+    message = prelude + encoded_headers + payload
+    return message + struct.pack(">I", binascii.crc32(message) & 0xFFFFFFFF)
+
+
+def event_frame(event_type, payload):
+    headers = {":event-type": event_type, ":content-type": "application/json", ":message-type": "event"}
+    return encode_frame(headers, json.dumps(payload).encode("utf-8"))
+
+
+def chunk_frame(text):
+    return event_frame("chunk", {"bytes": base64.b64encode(text.encode("utf-8")).decode("utf-8")})
+
+
+def trace_frame(session_id, trace):
+    return event_frame("trace", {"agentId": "MOCKAGENT", "agentAliasId": "MOCKALIAS", "sessionId": session_id, "trace": trace})
+
+
+def build_traces(session_id, count, padding_bytes, answer=""):
+    """
+    Builds count orchestration trace frames shaped like a real agent run: each step invokes the
+    model, states a rationale and calls the action group or, every other step, looks up the
+    knowledge base. The last frame is the observation carrying the final response.
+    """
+    padding = "x" * padding_bytes
+    traces = []
+    for step in range(count - 1):
+        trace_id = f"mock-trace-{step // 4}"
+        kind = step % 4
+        knowledge_base = (step // 4) % 2 == 1
+        if kind == 0:
+            trace = {"modelInvocationInput": {"traceId": trace_id, "type": "ORCHESTRATION", "text": padding}}
+        elif kind == 1:
+            trace = {"rationale": {"traceId": trace_id, "text": f"Step {step}: call the model. {padding}"}}
+        elif kind == 2 and knowledge_base:
+            trace = {"invocationInput": {"traceId": trace_id, "invocationType": "KNOWLEDGE_BASE",
+                                         "knowledgeBaseLookupInput": {"knowledgeBaseId": "MOCKKB", "text": padding[:64]}}}
+        elif kind == 2:
+            trace = {"invocationInput": {"traceId": trace_id, "invocationType": "ACTION_GROUP",
+                                         "actionGroupInvocationInput": {"actionGroupName": "callModel",
+                                                                        "apiPath": "/callModel", "verb": "post"}}}
+        elif knowledge_base:
+            reference = {"content": {"text": padding}, "location": {"type": "S3", "s3Location": {"uri": "s3://mock/doc.txt"}}}
+            trace = {"observation": {"traceId": trace_id, "type": "KNOWLEDGE_BASE",
+                                     "knowledgeBaseLookupOutput": {"retrievedReferences": [reference]}}}
+        else:
+            trace = {"observation": {"traceId": trace_id, "type": "ACTION_GROUP",
+                                     "actionGroupInvocationOutput": {"text": padding}}}
+        traces.append(trace_frame(session_id, {"orchestrationTrace": trace}))
+    if count > 0:
+        final = {"observation": {"traceId": f"mock-trace-{(count - 1) // 4}", "type": "FINISH",
+                                 "finalResponse": {"text": answer}}}
+        traces.append(trace_frame(session_id, {"orchestrationTrace": final}))
+    return traces
+
+
+class MockAgentConfig:
+    """Shape and pacing of the mock responses."""
+    def __init__(self, trace_events=20, trace_padding=512, answer="The mock agent answered your question.",
+                 answer_chunks=4, frame_delay=0.0, first_frame_delay=0.0, chunk_delay=None, jitter=0.0,
+                 answer_bytes=None):
+        self.trace_events = trace_events
+        self.trace_padding = trace_padding
+        if answer_bytes:
+            # Repeat the answer text up to the requested size
+            answer = (answer + " ") * (answer_bytes // (len(answer) + 1) + 1)
+            answer = answer[:answer_bytes]
+        self.answer = answer
+        self.answer_chunks = answer_chunks
+        self.frame_delay = frame_delay
+        self.first_frame_delay = first_frame_delay
+        # Chunk frames are paced like trace frames unless told otherwise
+        self.chunk_delay = frame_delay if chunk_delay is None else chunk_delay
+        self.jitter = jitter
+
+    def frames(self, session_id):
+        frames = build_traces(session_id, self.trace_events, self.trace_padding, self.answer)
+        size = max(1, -(-len(self.answer) // self.answer_chunks))
+        frames += [chunk_frame(self.answer[i:i + size]) for i in range(0, len(self.answer), size)]
+        return frames
+
+    def delay_before(self, index):
+        """Seconds to wait before sending frame index (trace frames come first, then chunks)."""
+        if index == 0:
+            delay = self.first_frame_delay
+        elif index < self.trace_events:
+            delay = self.frame_delay
+        else:
+            delay = self.chunk_delay
+        if delay and self.jitter:
+            # Uniform jitter of +/- jitter * delay around the configured pacing
+            delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        return delay
+
+
+def make_handler(config):
+    class MockAgentHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # Frames are small writes; without TCP_NODELAY each would wait on the client's delayed ACK
+        disable_nagle_algorithm = True
+
+        def do_POST(self):
+            match = PATH_PATTERN.match(self.path)
+            length = int(self.headers.get("content-length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+            if match is None or "inputText" not in body:
+                payload = json.dumps({"message": "Unknown path or missing inputText"}).encode("utf-8")
+                self.send_response(400)
+                self.send_header("content-type", "application/json")
+                self.send_header("content-length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+                return
+
+            frames = config.frames(match.group("session"))
+            first = 0
+            if not body.get("enableTrace", True):
+                frames = frames[config.trace_events:]
+                first = config.trace_events
+
+            self.send_response(200)
+            self.send_header("content-type", "application/vnd.amazon.eventstream")
+            self.send_header("transfer-encoding", "chunked")
+            self.end_headers()
+            if first and config.first_frame_delay:
+                time.sleep(config.first_frame_delay)
+            try:
+                for index, frame in enumerate(frames, first):
+                    delay = config.delay_before(index)
+                    if delay:
+                        time.sleep(delay)
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(frame), frame))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+            except (BrokenPipeError, ConnectionResetError):
+                # The client canceled or timed out mid-stream
+                self.close_connection = True
+
+        def log_message(self, format, *args):
+            pass
+
+    return MockAgentHandler
+
+
+def start_mock_server(config=None, host="127.0.0.1", port=0):
+    """Starts the mock in a background thread and returns (server, base URL)."""
+    server = ThreadingHTTPServer((host, port), make_handler(config or MockAgentConfig()))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://{host}:{server.server_port}"
+
+
+def agent_url(base_url, session_id, agent_id="MOCKAGENT", alias_id="MOCKALIAS"):
+    return f"{base_url}/agents/{agent_id}/agentAliases/{alias_id}/sessions/{session_id}/text"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--trace-events", type=int, default=20, help="trace frames per response")
+    parser.add_argument("--trace-padding", type=int, default=512, help="bytes of filler text per trace frame")
+    parser.add_argument("--answer-chunks", type=int, default=4, help="chunk frames the answer is split into")
+    parser.add_argument("--answer-bytes", type=int, help="size of the answer text (default: a short sentence)")
+    parser.add_argument("--frame-delay", type=float, default=0.0, help="seconds between trace frames")
+    parser.add_argument("--chunk-delay", type=float, help="seconds between chunk frames (default: --frame-delay)")
+    parser.add_argument("--first-frame-delay", type=float, default=0.0, help="seconds before the first frame")
+    parser.add_argument("--jitter", type=float, default=0.0, help="relative random variation of every delay")
+    args = parser.parse_args()
+
+    config = MockAgentConfig(args.trace_events, args.trace_padding, answer_chunks=args.answer_chunks,
+                             frame_delay=args.frame_delay, first_frame_delay=args.first_frame_delay,
+                             chunk_delay=args.chunk_delay, jitter=args.jitter, answer_bytes=args.answer_bytes)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(config))
+    print(f"Mock agent runtime listening on http://{args.host}:{args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+"""Bytes, latency and image tokens of multimodal Claude 3 requests before and after preprocessing.
+
+For each input image and output format the shared preprocessing stage is timed cold
+(decode, resize, encode) and warm (content-hash cache hit), and the size of the
+Claude 3 request body the Lambda builds is compared with sending the original image.
+Inputs are the repository's images/the_image.png and a synthetic 3000x2000 photo-like
+PNG, so that both an in-budget and an oversized upload are covered.
+
+Usage:
+    python benchmarks/multimodal_payload.py [--formats auto png jpeg webp] [--json]
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, REPO_ROOT)
+
+import image_preprocessing
+import lambda_function
+
+
+def synthetic_photo(width=3000, height=2000):
+    """A gradient with noise, which compresses about as badly as a photo does."""
+    from PIL import Image
+    gradient = Image.linear_gradient("L").resize((width, height))
+    noise = Image.effect_noise((width, height), 40)
+    image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.Transpose.FLIP_LEFT_RIGHT)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def load_inputs():
+    inputs = {}
+    path = os.path.join(REPO_ROOT, "images", "the_image.png")
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            inputs["the_image.png"] = f.read()
+    inputs["synthetic-3000x2000.png"] = synthetic_photo()
+    return inputs
+
+
+def request_bytes(base64_data, media_type):
+    wrapper = lambda_function.Claude3Wrapper("anthropic.claude-3-haiku-20240307-v1:0", client=object())
+    body = wrapper.build_request_body("Describe the uploaded image.", base64_data, max_tokens=2048, media_type=media_type)
+    return len(json.dumps(body))
+
+
+def measure(name, image_bytes, target_format):
+    image_preprocessing._cache.clear()
+    start = time.perf_counter()
+    result = image_preprocessing.preprocess_image(image_bytes, target_format=target_format)
+    cold_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    image_preprocessing.preprocess_image(image_bytes, target_format=target_format)
+    warm_ms = (time.perf_counter() - start) * 1000
+
+    original_base64 = lambda_function.base64.b64encode(image_bytes).decode("utf-8")
+    return {
+        "image": name,
+        "format": target_format,
+        "media_type": result["media_type"],
+        "original_size": list(result["original_size"]),
+        "size": list(result["size"]),
+        "original_bytes": result["original_bytes"],
+        "processed_bytes": result["processed_bytes"],
+        "original_request_bytes": request_bytes(original_base64, "image/png"),
+        "request_bytes": request_bytes(result["base64"], result["media_type"]),
+        "original_tokens": result["original_tokens"],
+        "tokens": result["tokens"],
+        "cold_ms": round(cold_ms, 2),
+        "warm_ms": round(warm_ms, 4),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--formats", nargs="+", default=["auto", "png", "jpeg", "webp"], help="output formats to compare")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    results = [measure(name, data, target_format)
+               for name, data in load_inputs().items() for target_format in args.formats]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'image':<25}{'format':<7}{'size':>12}{'request KB':>20}{'tokens':>16}{'cold':>10}{'warm':>10}")
+    for r in results:
+        size = f"{r['size'][0]}x{r['size'][1]}"
+        request = f"{r['original_request_bytes'] / 1024:.0f} -> {r['request_bytes'] / 1024:.0f}"
+        tokens = f"{r['original_tokens']} -> {r['tokens']}"
+        print(f"{r['image']:<25}{r['format']:<7}{size:>12}{request:>20}{tokens:>16}"
+              f"{r['cold_ms']:>8.1f}ms{r['warm_ms']:>8.3f}ms")
+
+
+if __name__ == "__main__":
+    main()
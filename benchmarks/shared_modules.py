@@ -0,0 +1,39 @@
+"""Checks that the modules copied into streamlit_app/ match their repository-root originals.
+
+The Lambda image and the Streamlit app are deployed separately, so each carries its own copy
+of the modules they share (token_budget.py, image_preprocessing.py). The root file is the
+source of truth; after changing it, copy it over the streamlit_app/ one. end_to_end.py runs
+this check as part of its --baseline gate.
+
+Usage:
+    python benchmarks/shared_modules.py
+"""
+import filecmp
+import os
+import sys
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+SHARED_MODULES = ("token_budget.py", "image_preprocessing.py")
+
+
+def differing_copies():
+    """Returns the shared modules whose streamlit_app/ copy is missing or differs from the original."""
+    return [
+        name for name in SHARED_MODULES
+        if not os.path.exists(os.path.join(REPO_ROOT, "streamlit_app", name))
+        or not filecmp.cmp(os.path.join(REPO_ROOT, name), os.path.join(REPO_ROOT, "streamlit_app", name), shallow=False)
+    ]
+
+
+def main():
+    differing = differing_copies()
+    for name in differing:
+        print(f"streamlit_app/{name} differs from {name}; copy the root file over it")
+    if differing:
+        sys.exit(1)
+    print(f"streamlit_app/ copies match: {', '.join(SHARED_MODULES)}")
+
+
+if __name__ == "__main__":
+    main()
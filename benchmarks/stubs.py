@@ -0,0 +1,246 @@
+"""Local stand-ins for the Bedrock runtime and S3 clients used by the benchmarks.
+
+The stubs answer with recorded-shape fixtures so lambda_function can run every
+provider branch offline. Fixture images are built with zlib instead of Pillow so
+that loading the stubs does not pre-import anything the Lambda imports lazily.
+"""
+import base64
+import functools
+import io
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+
+from botocore.exceptions import ClientError
+
+
+def make_png(width=1024, height=1024, rgb=(200, 80, 40)):
+    """Returns the bytes of a solid-colour RGB PNG."""
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    row = b"\x00" + bytes(rgb) * width
+    header = struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", header)
+            + chunk(b"IDAT", zlib.compress(row * height)) + chunk(b"IEND", b""))
+
+
+FIXTURE_PNG = make_png()
+FIXTURE_PNG_BASE64 = base64.b64encode(FIXTURE_PNG).decode("utf-8")
+
+
+@functools.lru_cache(maxsize=None)
+def variant_png_base64(index):
+    """Base64 PNG of the index-th generated variant; variant 0 is FIXTURE_PNG and the others differ."""
+    if index == 0:
+        return FIXTURE_PNG_BASE64
+    return base64.b64encode(make_png(rgb=(200, 80, (40 + 37 * index) % 256))).decode("utf-8")
+
+# Native response bodies keyed by model ID prefix, in the shape each provider returns.
+TEXT_FIXTURES = {
+    "anthropic.claude-3": {
+        "content": [{"type": "text", "text": "A stubbed Claude 3 answer."}],
+        "usage": {"input_tokens": 12, "output_tokens": 6},
+    },
+    "anthropic": {"completion": "A stubbed Claude answer.", "stop_reason": "stop_sequence"},
+    "mistral": {"outputs": [{"text": "A stubbed Mistral answer.", "stop_reason": "stop"}]},
+    "meta": {"generation": "A stubbed Llama answer.", "prompt_token_count": 12, "generation_token_count": 5},
+    "cohere": {"generations": [{"text": "A stubbed Cohere answer."}]},
+    "ai21": {"completions": [{"data": {"text": "A stubbed Jurassic answer."}}]},
+    "amazon.titan-text": {"inputTextTokenCount": 12, "results": [{"outputText": "A stubbed Titan answer.", "tokenCount": 5}]},
+}
+
+
+# Streamed chunk builders keyed by model ID prefix: text delta -> native chunk
+STREAM_CHUNKS = {
+    "anthropic.claude-3": lambda text: {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": text}},
+    "anthropic": lambda text: {"completion": text},
+    "mistral": lambda text: {"outputs": [{"text": text, "stop_reason": None}]},
+    "meta": lambda text: {"generation": text},
+    "cohere": lambda text: {"text": text, "is_finished": False},
+    "amazon.titan-text": lambda text: {"outputText": text, "index": 0},
+}
+
+
+def fixture_text(fixture):
+    """Returns the answer text of a TEXT_FIXTURES entry."""
+    for path in (("content", 0, "text"), ("completion",), ("outputs", 0, "text"), ("generation",),
+                 ("generations", 0, "text"), ("results", 0, "outputText")):
+        value = fixture
+        try:
+            for step in path:
+                value = value[step]
+            return value
+        except (KeyError, IndexError):
+            continue
+    raise KeyError("fixture has no text")
+
+
+class StreamingBody:
+    """Mimics botocore's StreamingBody for the fixtures."""
+
+    def __init__(self, payload):
+        self._stream = io.BytesIO(payload)
+
+    def read(self, amt=None):
+        return self._stream.read(amt)
+
+
+class StubBedrockRuntime:
+    """Answers invoke_model and invoke_model_with_response_stream with fixtures and records every call.
+
+    Throttles can be injected: capacity is the number of concurrent calls per model the stub
+    accepts before it answers ThrottlingException, and throttle_rate throttles that fraction
+    of the remaining calls at random (seeded, so runs are repeatable).
+    """
+
+    def __init__(self, latency=0.0, capacity=None, throttle_rate=0.0, seed=0):
+        self.latency = latency
+        self.capacity = capacity
+        self.throttle_rate = throttle_rate
+        self.calls = []
+        self.throttled = 0
+        self._random = random.Random(seed)
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def _admit(self, model_id, operation):
+        with self._lock:
+            in_flight = self._in_flight.get(model_id, 0)
+            if (self.capacity is not None and in_flight >= self.capacity) or self._random.random() < self.throttle_rate:
+                self.throttled += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."},
+                                   "ResponseMetadata": {"HTTPStatusCode": 429}}, operation)
+            self._in_flight[model_id] = in_flight + 1
+
+    def _done(self, model_id):
+        with self._lock:
+            self._in_flight[model_id] -= 1
+
+    def fixture_for(self, model_id, body):
+        if model_id.startswith("stability"):
+            samples = body.get("samples", 1)
+            return {"artifacts": [{"base64": variant_png_base64(i), "finishReason": "SUCCESS"} for i in range(samples)]}
+        if model_id.startswith("amazon.titan-image"):
+            count = body.get("imageGenerationConfig", {}).get("numberOfImages", 1)
+            return {"images": [variant_png_base64(i) for i in range(count)], "error": None}
+        for prefix, fixture in TEXT_FIXTURES.items():
+            if model_id.startswith(prefix):
+                return fixture
+        raise ClientError({"Error": {"Code": "ValidationException", "Message": f"Unknown model {model_id}"}}, "InvokeModel")
+
+    def invoke_model(self, body, modelId, **kwargs):
+        self._admit(modelId, "InvokeModel")
+        try:
+            if self.latency:
+                time.sleep(self.latency)
+            request = json.loads(body)
+            self.calls.append((modelId, request))
+            payload = json.dumps(self.fixture_for(modelId, request)).encode("utf-8")
+        finally:
+            self._done(modelId)
+        return {"body": StreamingBody(payload), "contentType": "application/json"}
+
+    def invoke_model_with_response_stream(self, body, modelId, **kwargs):
+        self._admit(modelId, "InvokeModelWithResponseStream")
+        self._done(modelId)
+        request = json.loads(body)
+        self.calls.append((modelId, request))
+        prefix = next((prefix for prefix in STREAM_CHUNKS if modelId.startswith(prefix)), None)
+        if prefix is None:
+            raise ClientError({"Error": {"Code": "ValidationException", "Message": f"{modelId} does not stream"}},
+                              "InvokeModelWithResponseStream")
+        words = fixture_text(self.fixture_for(modelId, request)).split(" ")
+        chunks = [STREAM_CHUNKS[prefix](word if i == 0 else " " + word) for i, word in enumerate(words)]
+        if prefix == "anthropic.claude-3":
+            chunks.insert(0, {"type": "message_start", "message": {"usage": {"input_tokens": 12, "output_tokens": 1}}})
+            chunks.append({"type": "message_delta", "delta": {"stop_reason": "end_turn"}, "usage": {"output_tokens": len(words)}})
+            chunks.append({"type": "message_stop"})
+        chunks[-1]["amazon-bedrock-invocationMetrics"] = {
+            "inputTokenCount": 12, "outputTokenCount": len(words), "invocationLatency": 1, "firstByteLatency": 1
+        }
+
+        def events():
+            for chunk in chunks:
+                if self.latency:
+                    time.sleep(self.latency / len(chunks))
+                yield {"chunk": {"bytes": json.dumps(chunk).encode("utf-8")}}
+
+        return {"body": events(), "contentType": "application/json"}
+
+
+class StubS3:
+    """An in-memory bucket supporting the calls lambda_function makes."""
+
+    def __init__(self, objects=None):
+        self.objects = dict(objects or {})
+        self.calls = []
+
+    def _missing(self, operation):
+        return ClientError({"Error": {"Code": "404", "Message": "Not Found"}}, operation)
+
+    def etag(self, Key):
+        return '"%x"' % zlib.crc32(self.objects[Key])
+
+    def head_object(self, Bucket, Key, **kwargs):
+        self.calls.append(("head_object", Key))
+        if Key not in self.objects:
+            raise self._missing("HeadObject")
+        return {"ContentLength": len(self.objects[Key]), "ETag": self.etag(Key)}
+
+    def get_object(self, Bucket, Key, IfNoneMatch=None, **kwargs):
+        self.calls.append(("get_object", Key))
+        if Key not in self.objects:
+            raise ClientError({"Error": {"Code": "NoSuchKey", "Message": "The specified key does not exist."}}, "GetObject")
+        if IfNoneMatch == self.etag(Key):
+            raise ClientError({"Error": {"Code": "304", "Message": "Not Modified"}}, "GetObject")
+        return {"Body": StreamingBody(self.objects[Key]), "ETag": self.etag(Key), "ContentLength": len(self.objects[Key])}
+
+    def download_fileobj(self, Bucket, Key, Fileobj, **kwargs):
+        self.calls.append(("download_fileobj", Key))
+        if Key not in self.objects:
+            raise self._missing("GetObject")
+        Fileobj.write(self.objects[Key])
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.calls.append(("put_object", Key))
+        self.objects[Key] = Body if isinstance(Body, bytes) else Body.read()
+        return {"ETag": self.etag(Key)}
+
+    def generate_presigned_url(self, ClientMethod, Params=None, ExpiresIn=3600):
+        return f"https://{Params['Bucket']}.s3.amazonaws.com/{Params['Key']}?X-Amz-Expires={ExpiresIn}"
+
+
+def install(lambda_module, bedrock=None, s3=None):
+    """Places the stubs in lambda_function's client pool and returns them."""
+    bedrock = bedrock or StubBedrockRuntime()
+    s3 = s3 or StubS3()
+    pool = lambda_module._handle_pool
+    pool[("client", "s3", None, None)] = s3
+    pool[("client", "bedrock-runtime", lambda_module.region_name, lambda_module.endpoint_url)] = bedrock
+    return bedrock, s3
+
+
+def seed_session_image(lambda_module, s3, session_id, image_bytes=FIXTURE_PNG):
+    """Stores an image the way the Streamlit upload does: a content-addressed blob plus the session pointer."""
+    image_key = lambda_module.session_image_key(session_id, image_bytes)
+    s3.objects[image_key] = image_bytes
+    s3.objects[lambda_module.session_pointer_key(session_id)] = json.dumps({"key": image_key}).encode("utf-8")
+    return image_key
+
+
+def action_group_event(model_id, prompt, api_path="/callModel", **parameters):
+    """Builds a Bedrock agent action group event for /callModel."""
+    parameters = dict(parameters, modelId=model_id, prompt=prompt)
+    return {
+        "messageVersion": "1.0",
+        "agent": {"name": "benchmark", "id": "AGENT", "alias": "ALIAS", "version": "DRAFT"},
+        "sessionId": "benchmark-session",
+        "actionGroup": "callModel",
+        "apiPath": api_path,
+        "httpMethod": "POST",
+        "parameters": [{"name": name, "type": "string", "value": value} for name, value in parameters.items()],
+    }
@@ -0,0 +1,86 @@
+"""Per-provider latency of the native text adapters versus the LangChain Bedrock path.
+
+Both engines call the same stubbed bedrock-runtime client, so the numbers are the
+client-side overhead each engine adds on top of the model call. The first call of
+each engine (imports and object construction) is reported separately from the
+steady-state per-call median.
+
+Usage:
+    python benchmarks/text_engines.py [--calls 200] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import stubs
+import lambda_function
+
+MODELS = {
+    "mistral": "mistral.mistral-7b-instruct-v0:2",
+    "meta": "meta.llama2-13b-chat-v1",
+    "cohere": "cohere.command-text-v14",
+    "ai21": "ai21.j2-mid-v1",
+    "anthropic": "anthropic.claude-instant-v1",
+    "amazon": "amazon.titan-text-express-v1",
+}
+PROMPT = "Summarize the meeting transcript in three bullet points."
+
+
+def time_calls(call, calls):
+    start = time.perf_counter()
+    call()
+    first_ms = (time.perf_counter() - start) * 1000
+
+    samples = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        samples.append((time.perf_counter() - start) * 1000)
+    return {"first_ms": round(first_ms, 3), "median_ms": round(statistics.median(samples), 4)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--calls", type=int, default=200, help="steady-state calls per provider and engine")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    stubs.install(lambda_function)
+    results = []
+    for provider, model_id in MODELS.items():
+        adapter = lambda_function.TEXT_ADAPTERS[provider]
+        result = {"provider": provider, "model_id": model_id}
+        # The response cache is bypassed so every native call reaches the (stubbed) model
+        result["native"] = time_calls(lambda: adapter.invoke(model_id, PROMPT, use_cache=False), args.calls)
+        try:
+            result["langchain"] = time_calls(
+                lambda: lambda_function.get_langchain_llm(model_id).predict(PROMPT), args.calls
+            )
+        except Exception as e:
+            result["langchain"] = {"skipped": f"{type(e).__name__}: {e}"}
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'provider':<11}{'native first':>14}{'native/call':>13}{'langchain first':>17}{'langchain/call':>16}")
+    for result in results:
+        native, langchain = result["native"], result["langchain"]
+        line = f"{result['provider']:<11}{native['first_ms']:>12.2f}ms{native['median_ms']:>11.3f}ms"
+        if "skipped" in langchain:
+            line += f"  langchain skipped: {langchain['skipped']}"
+        else:
+            line += f"{langchain['first_ms']:>15.2f}ms{langchain['median_ms']:>14.3f}ms"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""Burst behaviour of the Lambda against a Bedrock stub that throttles.
+
+A burst of concurrent /callModel events is sent through lambda_handler while the stub accepts
+only --capacity concurrent calls per model (plus --throttle-rate random throttles). The run is
+repeated with admission control off (every throttle reaches the agent) and on (AIMD limit and
+jittered retries), reporting successes, throttles surfaced to the caller, throttles the stub
+answered, retries and latency percentiles.
+
+Usage:
+    python benchmarks/throttling.py [--requests 64] [--concurrency 32] [--capacity 4] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARK_DIR))
+sys.path.insert(0, BENCHMARK_DIR)
+
+import stubs
+import lambda_function
+
+MODEL_ID = "meta.llama2-13b-chat-v1"
+
+
+class LambdaContext:
+    """The part of the Lambda context object the handler uses."""
+    def __init__(self, timeout):
+        self.deadline = time.monotonic() + timeout
+
+    def get_remaining_time_in_millis(self):
+        return int((self.deadline - time.monotonic()) * 1000)
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_burst(mode, args):
+    lambda_function.admission_control_mode = mode
+    lambda_function._handle_pool.pop(('admission_control',), None)
+    bedrock, _ = stubs.install(lambda_function, bedrock=stubs.StubBedrockRuntime(
+        latency=args.latency, capacity=args.capacity, throttle_rate=args.throttle_rate
+    ))
+    # The response cache would answer every repeat of the deterministic prompt without a call
+    event = stubs.action_group_event(MODEL_ID, "Count the apples.", cache="false")
+
+    def send(_):
+        start = time.perf_counter()
+        response = lambda_function.lambda_handler(event, LambdaContext(args.timeout))
+        body = response["response"]["responseBody"]["application/json"]["body"]
+        return time.perf_counter() - start, "Throttling" not in str(body)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        outcomes = list(pool.map(send, range(args.requests)))
+    wall = time.perf_counter() - start
+
+    latencies = [latency * 1000 for latency, _ in outcomes]
+    controller = lambda_function.get_admission_controller()
+    stats = controller.stats() if controller else {}
+    return {
+        "admission_control": mode,
+        "succeeded": sum(ok for _, ok in outcomes),
+        "throttled_to_caller": sum(not ok for _, ok in outcomes),
+        "stub_throttles": bedrock.throttled,
+        "retries": stats.get("retries", 0),
+        "final_limit": stats.get("models", {}).get(MODEL_ID, {}).get("limit"),
+        "p50_ms": round(statistics.median(latencies), 1),
+        "p95_ms": round(percentile(latencies, 0.95), 1),
+        "wall_s": round(wall, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=64, help="events in the burst")
+    parser.add_argument("--concurrency", type=int, default=32, help="events in flight at once")
+    parser.add_argument("--capacity", type=int, default=4, help="concurrent calls the stub accepts per model")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of admitted calls throttled at random")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per stubbed model call")
+    parser.add_argument("--timeout", type=float, default=30.0, help="Lambda timeout given to each event")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    lambda_function.logger.disabled = True
+    # The handler prints every event and result; keep the report readable
+    stdout, sys.stdout = sys.stdout, open(os.devnull, "w")
+    try:
+        results = [run_burst(mode, args) for mode in ("off", "aimd")]
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'admission':<11}{'ok':>6}{'throttled':>11}{'stub 429s':>11}{'retries':>9}{'limit':>7}"
+          f"{'p50':>10}{'p95':>10}{'wall':>8}")
+    for r in results:
+        print(f"{r['admission_control']:<11}{r['succeeded']:>6}{r['throttled_to_caller']:>11}{r['stub_throttles']:>11}"
+              f"{r['retries']:>9}{str(r['final_limit']):>7}{r['p50_ms']:>8.1f}ms{r['p95_ms']:>8.1f}ms{r['wall_s']:>7.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,577 +1,1370 @@
 import json
 import os
 import base64
+import copy
+import functools
+import hashlib
 import logging
-import boto3
 import io
-from PIL import Image, ImageOps
+import random
+import threading
+import time
+import contextvars
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from langchain.llms.bedrock import Bedrock
+
+import admission_control
+import image_preprocessing
+import response_cache
+import telemetry
+import token_budget
 #from langchain_community.chat_models import BedrockChat
 
-s3 = boto3.client('s3')
+# boto3, Pillow and LangChain are imported inside the branches that use them so a
+# cold start only pays for the providers the first request actually touches.
+
 bucket_name = 'bedrock-agent-images'  # Replace with the name of your bucket
-object_name = 'the_image.png' 
+object_name = 'the_image.png'  # Shared legacy key, only used for events without a session ID
+
+region_name = os.environ.get("BWB_REGION_NAME")
+endpoint_url = os.environ.get("BWB_ENDPOINT_URL")
+profile_name = os.environ.get("BWB_PROFILE_NAME")
+
+# botocore connection pool settings for the pooled clients
+max_pool_connections = int(os.environ.get("BWB_MAX_POOL_CONNECTIONS", "10"))
+tcp_keepalive = os.environ.get("BWB_TCP_KEEPALIVE", "true").lower() == "true"
+
+# "native" calls invoke_model through TEXT_ADAPTERS; "langchain" keeps the LangChain Bedrock LLM
+text_engine = os.environ.get("BWB_TEXT_ENGINE", "native")
+
+# Stream model output with invoke_model_with_response_stream; a request's "stream" parameter overrides this
+stream_responses = os.environ.get("BWB_STREAM_RESPONSES", "false").lower() == "true"
 
 logger = logging.getLogger(__name__)
 
+# Input images cached across warm invocations and revalidated against S3 with their ETag.
+# BWB_IMAGE_CACHE_DIR spills entries to local storage (e.g. /tmp/image-cache) so they outlive
+# eviction from memory; BWB_IMAGE_CACHE_TTL trusts an entry for that many seconds without asking S3.
+# The memory tier holds at most BWB_IMAGE_CACHE_MAX_ENTRIES images and BWB_IMAGE_CACHE_MAX_BYTES bytes
+# (raw bytes plus the base64 copy, once one was needed).
+image_cache_dir = os.environ.get("BWB_IMAGE_CACHE_DIR")
+image_cache_ttl = float(os.environ.get("BWB_IMAGE_CACHE_TTL", "0"))
+image_cache_max_entries = int(os.environ.get("BWB_IMAGE_CACHE_MAX_ENTRIES", "32"))
+image_cache_max_bytes = int(os.environ.get("BWB_IMAGE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+
+# Default Titan inpainting mask: a box of this size centred horizontally, its bottom edge this far
+# above the bottom of the image. A request's "maskBox" parameter ("left,top,right,bottom") overrides it.
+mask_width = int(os.environ.get("BWB_MASK_WIDTH", "300"))
+mask_height = int(os.environ.get("BWB_MASK_HEIGHT", "100"))
+mask_bottom_offset = int(os.environ.get("BWB_MASK_BOTTOM_OFFSET", "200"))
+_image_cache = OrderedDict()
+_image_cache_bytes = 0
+_image_cache_lock = threading.Lock()
+
+# Deterministic model responses (temperature 0 or a fixed image seed) are cached by a hash of the
+# model ID and request body. BWB_RESPONSE_CACHE picks the persistent tier behind the in-memory LRU:
+# "memory" (none), "file" (BWB_RESPONSE_CACHE_DIR) or "s3" (BWB_RESPONSE_CACHE_BUCKET); "off" disables it.
+# The LRU holds at most BWB_RESPONSE_CACHE_MAX_ENTRIES responses and BWB_RESPONSE_CACHE_MAX_BYTES bytes.
+# A request's "cache" parameter set to "false" bypasses the cache.
+response_cache_tier = os.environ.get("BWB_RESPONSE_CACHE", "memory").lower()
+response_cache_ttl = float(os.environ.get("BWB_RESPONSE_CACHE_TTL", "3600"))
+response_cache_max_entries = int(os.environ.get("BWB_RESPONSE_CACHE_MAX_ENTRIES", "256"))
+response_cache_max_bytes = int(os.environ.get("BWB_RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+response_cache_dir = os.environ.get("BWB_RESPONSE_CACHE_DIR", "/tmp/response-cache")
+response_cache_bucket = os.environ.get("BWB_RESPONSE_CACHE_BUCKET", bucket_name)
+response_cache_prefix = os.environ.get("BWB_RESPONSE_CACHE_PREFIX", "response-cache/")
+
+# Clients and model handles that survive warm invocations. Keys are tuples of
+# (kind, region, endpoint[, model ID]) and every handle is created on first use.
+_handle_pool = {}
+_handle_pool_lock = threading.RLock()
+
+# Number of model dispatches per model ID for the lifetime of the container.
+# Every /callModel event should add exactly one entry here, and every /callModels item one more.
+model_invocations = Counter()
+_model_invocations_lock = threading.Lock()
+
+# /callModels runs its items concurrently on a pooled thread pool. Keep the worker count at or
+# below BWB_MAX_POOL_CONNECTIONS so the items don't queue for a Bedrock connection.
+batch_max_items = int(os.environ.get("BWB_BATCH_MAX_ITEMS", "10"))
+batch_max_workers = int(os.environ.get("BWB_BATCH_MAX_WORKERS", "8"))
+
+# Per-model admission control for Bedrock calls: an AIMD concurrency limit per model ID and
+# jittered retries of throttled and transiently failed calls that give up before the Lambda runs
+# out of time. BWB_ADMISSION_CONTROL=off sends calls straight through, retried by botocore instead.
+admission_control_mode = os.environ.get("BWB_ADMISSION_CONTROL", "aimd").lower()
+model_concurrency_initial = int(os.environ.get("BWB_MODEL_CONCURRENCY_INITIAL", "4"))
+model_concurrency_min = int(os.environ.get("BWB_MODEL_CONCURRENCY_MIN", "1"))
+model_concurrency_max = int(os.environ.get("BWB_MODEL_CONCURRENCY_MAX", str(max_pool_connections)))
+retry_max_attempts = int(os.environ.get("BWB_RETRY_MAX_ATTEMPTS", "4"))
+retry_base_delay = float(os.environ.get("BWB_RETRY_BASE_DELAY", "0.2"))
+retry_max_delay = float(os.environ.get("BWB_RETRY_MAX_DELAY", "5"))
+# Seconds kept in reserve to build and return the action group response
+deadline_margin = float(os.environ.get("BWB_DEADLINE_MARGIN", "1.0"))
+
+# One EMF record with per-stage timings and token/byte counts is printed per invocation.
+# Events and results are logged as summaries: long strings (base64 images) are cut to
+# BWB_LOG_MAX_STRING characters, the whole line to BWB_LOG_MAX_CHARS, for a
+# BWB_LOG_SAMPLE_RATE fraction of invocations.
+metrics_enabled = os.environ.get("BWB_METRICS", "true").lower() == "true"
+metrics_namespace = os.environ.get("BWB_METRICS_NAMESPACE", "BedrockAgentModels")
+log_sample_rate = float(os.environ.get("BWB_LOG_SAMPLE_RATE", "1.0"))
+log_max_string = int(os.environ.get("BWB_LOG_MAX_STRING", "200"))
+log_max_chars = int(os.environ.get("BWB_LOG_MAX_CHARS", "2000"))
+
+# Upper bound of a request's "variants" parameter (images generated for one Titan or Stability request).
+# Titan accepts up to 5 images per call; SDXL on Bedrock accepts one, so its variants are separate seeded calls.
+max_variants = int(os.environ.get("BWB_MAX_VARIANTS", "5"))
+
+# Text prompts are estimated locally before they're sent. BWB_TOKEN_BUDGET picks what happens to a
+# prompt that doesn't fit the model's context: "trim" (cut from the middle), "reject" (400) or "off".
+# max_tokens is lowered to what's left of the context and of the time budget: the invocation's
+# remaining time, or BWB_LATENCY_BUDGET seconds per model call when that's shorter.
+token_budget_mode = os.environ.get("BWB_TOKEN_BUDGET", "trim").lower()
+latency_budget = float(os.environ["BWB_LATENCY_BUDGET"]) if os.environ.get("BWB_LATENCY_BUDGET") else None
+min_output_tokens = int(os.environ.get("BWB_MIN_OUTPUT_TOKENS", "256"))
+
+
+def get_pooled_handle(key, factory):
+    """Returns the pooled handle for key, creating it with factory on first use."""
+    handle = _handle_pool.get(key)
+    if handle is None:
+        with _handle_pool_lock:
+            handle = _handle_pool.get(key)
+            if handle is None:
+                handle = factory()
+                _handle_pool[key] = handle
+    return handle
+
+
+def get_boto3_session():
+    def create_session():
+        import boto3
+        return boto3.Session(profile_name=profile_name)
+
+    return get_pooled_handle(('session', profile_name), create_session)
+
+
+def get_client(service_name, region=None, endpoint=None):
+    """Returns a pooled boto3 client for the service, region and endpoint."""
+    def create_client():
+        from botocore.config import Config
+        # With admission control on, the controller retries Bedrock calls, so botocore must not retry
+        # them too; otherwise botocore keeps its default (legacy) retries
+        if service_name == 'bedrock-runtime' and admission_control_mode != "off":
+            retries = {"mode": "standard", "total_max_attempts": 1}
+        elif service_name == 'bedrock-runtime':
+            retries = {"mode": "legacy"}
+        else:
+            retries = {"mode": "standard"}
+        config = Config(max_pool_connections=max_pool_connections, tcp_keepalive=tcp_keepalive, retries=retries)
+        return get_boto3_session().client(
+            service_name=service_name, region_name=region, endpoint_url=endpoint, config=config
+        )
 
-def lambda_handler(event, context):
-    print(event)
-    
-    def get_named_parameter(event, name):
-        return next(item for item in event['parameters'] if item['name'] == name)['value']
-
-    model_id = get_named_parameter(event, 'modelId')
-    prompt = get_named_parameter(event, 'prompt')
-    #encoded_image = get_named_parameter(event, 'image')
-    print("MODE ID: " + model_id)
-    print("PROMPT: " + prompt)
-
-    def fetch_image_from_s3():
-        """Fetches an image from an S3 bucket and returns it as a BytesIO object."""
-        image_content = io.BytesIO()
-        
-        try:
-            s3.download_fileobj(bucket_name, object_name, image_content)
-            print("Image successfully fetched from S3.")
-            return image_content
-        except Exception as e:
-            print(f"Error fetching image from S3: {e}")
-            return None
+    return get_pooled_handle(('client', service_name, region, endpoint), create_client)
 
-    def get_image_response(client, prompt_content): #text-to-text client function
-        
-        if(model_id.startswith('stability')):
-            request_body = json.dumps({"text_prompts": 
-                                    [ {"text": prompt_content} ], #prompts to use
-                                    "cfg_scale": 9, #how closely the model tries to match the prompt
-                                    "steps": 50, }) #number of diffusion steps to perform
-            try:
-                response = client.invoke_model(body=request_body, modelId=model_id) #call the Bedrock endpoint
-                payload = json.loads(response.get('body').read()) #load the response body into a json object 
-                images = payload.get('artifacts') #extract the image artifacts
-                
-                # Check if images is None or empty
-                if not images or 'base64' not in images[0]:
-                    logging.error("No images found or 'base64' key is missing.")
-                    return "No image data found in the response."
-                
-                image_data = base64.b64decode(images[0].get('base64')) #decode image
-                image = io.BytesIO(image_data) #return a BytesIO object for client app consumption
-                                
-                return image
-
-            except Exception as e:
-                logging.error(f"An error occurred: {str(e)}")
-                return (f"An error occurred processing the image response:  {str(e)}")
-        
-        elif(model_id == 'amazon.titan-image-generator-v1'):    
-            if "change" in prompt.lower():   #IMAGE MODIFICATION DETECTOR
-                # Fetch the image from S3 and get a BytesIO object
-                image_bytes_io = fetch_image_from_s3()
-
-                # Convert BytesIO to a PIL.Image object
-                s3_image = Image.open(image_bytes_io)
-
-                # Now you can safely use .size or any other Image methods
-                # Example: getting the size of the image
-                image_size = s3_image.size
-                print(f"Image size: {image_size}")
-
-                # If you need to manipulate the image (e.g., inpainting_mask), do so here
-                # For example, creating a mask based on the image size
-                # box = (left, top, right, bottom)
-                box = ((image_size[0] - 300) // 2, image_size[1] - 300, (image_size[0] + 300) // 2, image_size[1] - 200)
-                mask = inpaint_mask(s3_image, box)
-                # Debug
-                print("THE MASK ON IMAGE MOD: ", mask)
-
-                request_body = json.dumps({
-                    "taskType": "INPAINTING",
-                    "inPaintingParams": {
-                        "text": prompt_content,              # Optional
-                        #"negativeText": negative_prompts,   # Optional
-                        "image": image_to_base64(s3_image),               # One image is required
-                        #"maskPrompt": "sky",               # One of "maskImage" or "maskPrompt" is required
-                        "maskImage": image_to_base64(mask)  # Input maskImage based on the values 0 (black) or 255 (white) only
-                    },
-                    "imageGenerationConfig": {
-                        "numberOfImages": 1,
-                        "quality": "premium",
-                        "height": 1024,
-                        "width": 1024,
-                        "cfgScale": 7.5,
-                        "seed": 42
-                    }
-                })
-
-            else:    
-                request_body = json.dumps({
-                    "taskType": "TEXT_IMAGE",
-                    "textToImageParams": {
-                        "text": prompt_content
-                    },
-                    "imageGenerationConfig": {
-                        "numberOfImages": 1,
-                        "height": 1024,
-                        "width": 1024,
-                        "cfgScale": 8.0,
-                        "seed": 0
-                    }
-                })
-            
-
-        def generate_image(model_id, body):
-            """
-            Generate an image using Amazon Titan Image Generator G1 model on demand.
-            Args:
-                model_id (str): The model ID to use.
-                body (str) : The request body to use.
-            Returns:
-                image_bytes (bytes): The image generated by the model.
-            """
-
-            logger.info("Generating image with Amazon Titan Image Generator G1 model %s", model_id)
-            bedrock = boto3.client(service_name='bedrock-runtime')
-            accept = "application/json"
-            content_type = "application/json"
-
-            response = bedrock.invoke_model(
-                body=body, modelId=model_id, accept=accept, contentType=content_type
-            )
-            response_body = json.loads(response.get("body").read())
-            base64_image = response_body.get("images")[0]
-            base64_bytes = base64_image.encode('ascii')
-            image_bytes = base64.b64decode(base64_bytes)
-            finish_reason = response_body.get("error")
 
-            if finish_reason is not None:
-                raise ImageError(f"Image generation error. Error is {finish_reason}")
+def get_s3_client():
+    return get_client('s3')
 
-            logger.info(
-                "Successfully generated image with Amazon Titan Image Generator G1 model %s", model_id)
 
-            return image_bytes
+def get_bedrock_client():
+    return get_client('bedrock-runtime', region_name, endpoint_url)
 
-        try:
-            image_bytes = generate_image(model_id=model_id, body=request_body)
-            image = Image.open(io.BytesIO(image_bytes))
-            image.show()
 
-            return image
+def get_claude_wrapper(model_id):
+    return get_pooled_handle(
+        ('claude3', region_name, endpoint_url, model_id),
+        lambda: Claude3Wrapper(model_id, get_bedrock_client())
+    )
 
-        except ClientError as err:
-            message = err.response["Error"]["Message"]
-            logger.error("A client error occurred: %s", message)
-            print("A client error occured: " +
-                format(message))
-        except ImageError as err:
-            logger.error(err.message)
-            print(err.message)
-
-
-    def inpaint_mask(img, box):
-        """Generates a segmentation mask for inpainting"""  
-        img_size = img.size
-        assert len(box) == 4  # (left, top, right, bottom)
-        assert box[0] < box[2]
-        assert box[1] < box[3]
-        return ImageOps.expand(
-            Image.new(
-                mode = "RGB",
-                size = (
-                    box[2] - box[0],
-                    box[3] - box[1]
-                ),
-                color = 'black'
-            ),
-            border=(
-                box[0],
-                box[1],
-                img_size[0] - box[2],
-                img_size[1] - box[3]
-            ),
-            fill='white'
+
+def get_langchain_llm(model_id):
+    """Returns the pooled LangChain Bedrock LLM for the model, sharing the pooled runtime client."""
+    def create_llm():
+        from langchain.llms.bedrock import Bedrock
+        return Bedrock(
+            client=get_bedrock_client(),
+            region_name=region_name,
+            endpoint_url=endpoint_url,
+            model_id=model_id,
+            model_kwargs=get_inference_parameters(model_id, "")
         )
 
+    return get_pooled_handle(('langchain', region_name, endpoint_url, model_id), create_llm)
+
+
+def get_response_cache():
+    """Returns the pooled response cache, or None when caching is off."""
+    if response_cache_tier == "off":
+        return None
+
+    def create_cache():
+        store = None
+        if response_cache_tier == "file":
+            store = response_cache.LocalFileStore(response_cache_dir)
+        elif response_cache_tier == "s3":
+            store = response_cache.S3Store(response_cache_bucket, response_cache_prefix, get_s3_client)
+        return response_cache.ResponseCache(response_cache_max_entries, response_cache_ttl, store,
+                                            response_cache_max_bytes)
+
+    return get_pooled_handle(('response_cache', response_cache_tier), create_cache)
+
+
+def invoke_model_json(client, model_id, body, use_cache=True):
+    """
+    Calls invoke_model with a JSON request body and returns the decoded response.
+    Deterministic requests are answered from the response cache when possible, so a hit
+    never reaches Bedrock. Responses reporting an error are not cached.
+    """
+    cache = get_response_cache() if use_cache else None
+    key = None
+    if cache is not None and response_cache.is_deterministic(body):
+        key = response_cache.make_cache_key(model_id, body)
+        payload = cache.get(key)
+        if payload is not None:
+            logger.info("Response cache hit for %s", model_id)
+            telemetry.count("response_cache_hits")
+            return json.loads(payload)
+        telemetry.count("response_cache_misses")
+
+    request_body = json.dumps(body)
+
+    def call():
+        with telemetry.span("bedrock_invoke"):
+            response = client.invoke_model(
+                modelId=model_id, body=request_body, accept="application/json", contentType="application/json"
+            )
+            payload = response.get("body").read()
+        record_token_usage(response, payload)
+        return payload
+
+    telemetry.count("bedrock_request_bytes", len(request_body))
+    payload = admitted_call(model_id, call)
+    telemetry.count("bedrock_response_bytes", len(payload))
+    result = json.loads(payload)
+    if key is not None and not result.get("error"):
+        cache.put(key, payload)
+    return result
+
+
+def get_admission_controller():
+    """Returns the pooled admission controller, or None when admission control is off."""
+    if admission_control_mode == "off":
+        return None
+    return get_pooled_handle(('admission_control',), lambda: admission_control.AdmissionController(
+        model_concurrency_initial, model_concurrency_min, model_concurrency_max,
+        retry_max_attempts, retry_base_delay, retry_max_delay
+    ))
+
+
+def admitted_call(model_id, function):
+    """Runs a Bedrock call through the model's limiter and retry policy."""
+    controller = get_admission_controller()
+    if controller is None:
+        return function()
+    return controller.call(model_id, function)
+
+
+def admitted_stream(model_id, open_stream):
+    """Yields a Bedrock response stream's events while holding the model's limiter slot."""
+    controller = get_admission_controller()
+    if controller is None:
+        return open_stream()
+    return controller.stream(model_id, open_stream)
+
+
+def get_batch_executor():
+    return get_pooled_handle(
+        ('executor', batch_max_workers),
+        lambda: ThreadPoolExecutor(max_workers=batch_max_workers, thread_name_prefix="callModels")
+    )
+
+
+def get_variant_executor():
+    # Runs the per-variant calls of models that generate one image per call (SDXL)
+    return get_pooled_handle(
+        ('executor', 'variants', max_variants),
+        lambda: ThreadPoolExecutor(max_workers=max_variants, thread_name_prefix="variants")
+    )
+
+
+def get_upload_executor():
+    # Separate from the batch pool so a /callModels item waiting on its uploads can't starve them
+    return get_pooled_handle(
+        ('executor', 'uploads', max_variants),
+        lambda: ThreadPoolExecutor(max_workers=max_variants, thread_name_prefix="uploads")
+    )
+
+
+def record_token_usage(response, payload):
+    """Counts the input and output tokens Bedrock reports in its response headers."""
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    if "x-amzn-bedrock-input-token-count" in headers:
+        telemetry.count("input_tokens", int(headers["x-amzn-bedrock-input-token-count"]))
+        telemetry.count("output_tokens", int(headers.get("x-amzn-bedrock-output-token-count", 0)))
+        return
+    # Without the headers (e.g. a local endpoint), fall back to the counts some bodies include
+    result = json.loads(payload)
+    usage = result.get("usage") or {}
+    telemetry.count("input_tokens", usage.get("input_tokens") or result.get("inputTextTokenCount")
+                    or result.get("prompt_token_count") or 0)
+    telemetry.count("output_tokens", usage.get("output_tokens") or result.get("generation_token_count")
+                    or sum(item.get("tokenCount", 0) for item in result.get("results", [])))
+
+
+def apply_token_budget(model_id, prompt, max_tokens, image_tokens=0):
+    """
+    Fits a text call into the model's token and time budget; returns (prompt, max_tokens).
+    The estimate goes into the invocation's metrics next to the input tokens Bedrock reports.
+    """
+    if token_budget_mode == "off":
+        return prompt, max_tokens
+    with telemetry.span("token_budget"):
+        budget = token_budget.plan(model_id, prompt, max_tokens, image_tokens, token_budget_mode,
+                                   admission_control.time_remaining(), latency_budget, min_output_tokens)
+    telemetry.count("input_tokens_estimate", budget["input_tokens"])
+    telemetry.count("input_tokens_trimmed", budget["trimmed_tokens"])
+    telemetry.count("max_tokens_requested", budget["max_tokens"])
+    logger.info("Token budget for %s: ~%d input tokens (%d trimmed), max_tokens %d of %d", model_id,
+                budget["input_tokens"], budget["trimmed_tokens"], budget["max_tokens"], max_tokens)
+    if budget["time_limited"]:
+        # The answer may be cut short because of the deadline, not the model's limits
+        telemetry.count("max_tokens_time_limited")
+        logger.warning("max_tokens for %s lowered to %d to fit the time left", model_id, budget["max_tokens"])
+    return budget["prompt"], budget["max_tokens"]
+
+
+def get_named_parameter(event, name):
+    return next(item for item in event['parameters'] if item['name'] == name)['value']
+
+
+def get_optional_parameter(event, name, default=None):
+    return next((item['value'] for item in event.get('parameters', []) if item['name'] == name), default)
+
+
+def parse_request(event):
+    """Builds the execution plan for an action group event."""
+    request = {
+        'action_group': event['actionGroup'],
+        'api_path': event['apiPath'],
+        'http_method': event['httpMethod'],
+        'model_id': None,
+        'prompt': None,
+        'stream': str(get_optional_parameter(event, 'stream', stream_responses)).lower() == 'true',
+        'session_id': event.get('sessionId'),
+        'mask_box': get_optional_parameter(event, 'maskBox'),
+        'use_cache': str(get_optional_parameter(event, 'cache', 'true')).lower() != 'false',
+        'variants': 1,
+    }
+    try:
+        request['variants'] = int(get_optional_parameter(event, 'variants', 1))
+    except ValueError:
+        request['error'] = "variants must be an integer"
+    if not 1 <= request['variants'] <= max_variants:
+        request['error'] = f"variants must be between 1 and {max_variants}"
+    if request['mask_box']:
+        try:
+            request['mask_box'] = parse_mask_box(request['mask_box'])
+        except MaskBoxError as e:
+            request['error'] = str(e)
+    if request['api_path'] == '/callModel':
+        request['model_id'] = get_named_parameter(event, 'modelId')
+        request['prompt'] = get_named_parameter(event, 'prompt')
+        #encoded_image = get_named_parameter(event, 'image')
+        print("MODE ID: " + request['model_id'])
+        print("PROMPT: " + telemetry.summarize_payload(request['prompt'], log_max_string, log_max_chars))
+    elif request['api_path'] == '/callModels':
+        try:
+            request['items'] = parse_batch_items(event)
+        except (ValueError, KeyError, TypeError, StopIteration) as e:
+            request['items'], request['error'] = [], f"Invalid /callModels request: {e!r}"
+        print(f"BATCH OF {len(request['items'])} ITEMS")
+    return request
+
+
+def parse_batch_items(event):
+    """
+    Reads the /callModels items: either "items", a JSON list of {"modelId", "prompt"} objects,
+    or "modelIds", a comma-separated list of model IDs that all get the same "prompt".
+    """
+    items = get_optional_parameter(event, 'items')
+    if items is not None:
+        items = json.loads(items) if isinstance(items, str) else items
+        items = [{'model_id': item['modelId'], 'prompt': item['prompt']} for item in items]
+    else:
+        prompt = get_named_parameter(event, 'prompt')
+        model_ids = [model_id.strip() for model_id in get_named_parameter(event, 'modelIds').split(',')]
+        items = [{'model_id': model_id, 'prompt': prompt} for model_id in model_ids if model_id]
+    if len(items) > batch_max_items:
+        raise ValueError(f"/callModels accepts at most {batch_max_items} items, got {len(items)}")
+    return items
+
+
+def _image_spill_path(bucket, key):
+    return os.path.join(image_cache_dir, hashlib.sha256(f"{bucket}/{key}".encode("utf-8")).hexdigest())
+
+
+def _load_spilled_image(bucket, key):
+    """Returns the entry spilled to image_cache_dir for the object, if any."""
+    if not image_cache_dir:
+        return None
+    path = _image_spill_path(bucket, key)
+    try:
+        with open(path + ".etag") as f:
+            etag = f.read()
+        with open(path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    # Never trusted without revalidation (time.monotonic() may be smaller than the TTL after a boot)
+    return {"etag": etag, "bytes": data, "checked_at": float("-inf")}
 
-    def image_to_base64(img):
-        """Converts a PIL Image, local image file path, or BytesIO object to a base64 string"""
-        if isinstance(img, str):
-            # Handling file path
-            if os.path.isfile(img):
-                print(f"Reading image from file: {img}")
-                with open(img, "rb") as f:
-                    return base64.b64encode(f.read()).decode("utf-8")
+
+def _spill_image(bucket, key, entry):
+    try:
+        os.makedirs(image_cache_dir, exist_ok=True)
+        path = _image_spill_path(bucket, key)
+        with open(path, "wb") as f:
+            f.write(entry["bytes"])
+        with open(path + ".etag", "w") as f:
+            f.write(entry["etag"])
+    except OSError as e:
+        logger.warning("Couldn't spill cached image %s to %s: %s", key, image_cache_dir, e)
+
+
+def _image_entry_size(entry):
+    return len(entry["bytes"]) + len(entry.get("base64", ""))
+
+
+def _cache_image_entry(bucket, key, entry):
+    """Puts an entry in the memory tier, evicting the least recently used ones over the bounds."""
+    global _image_cache_bytes
+    with _image_cache_lock:
+        previous = _image_cache.pop((bucket, key), None)
+        if previous is not None:
+            _image_cache_bytes -= _image_entry_size(previous)
+        # An image over a quarter of the budget would evict most of the cache; it's only spilled
+        if _image_entry_size(entry) > image_cache_max_bytes // 4:
+            return
+        _image_cache[(bucket, key)] = entry
+        _image_cache_bytes += _image_entry_size(entry)
+        while len(_image_cache) > image_cache_max_entries or _image_cache_bytes > image_cache_max_bytes:
+            _, evicted = _image_cache.popitem(last=False)
+            _image_cache_bytes -= _image_entry_size(evicted)
+
+
+def remember_image(bucket, key, data, etag):
+    """Caches image bytes under their S3 ETag and returns the cache entry."""
+    entry = {"etag": etag, "bytes": data, "checked_at": time.monotonic()}
+    _cache_image_entry(bucket, key, entry)
+    if image_cache_dir:
+        _spill_image(bucket, key, entry)
+    return entry
+
+
+def image_base64(entry):
+    """Returns the base64 of a cached image, encoding it on first use."""
+    global _image_cache_bytes
+    encoded = entry.get("base64")
+    if encoded is None:
+        with telemetry.span("base64_encode"):
+            encoded = base64.b64encode(entry["bytes"]).decode("utf-8")
+        with _image_cache_lock:
+            if "base64" not in entry:
+                entry["base64"] = encoded
+                if any(cached is entry for cached in _image_cache.values()):
+                    _image_cache_bytes += len(encoded)
+    return encoded
+
+
+def forget_image(bucket, key):
+    global _image_cache_bytes
+    with _image_cache_lock:
+        entry = _image_cache.pop((bucket, key), None)
+        if entry is not None:
+            _image_cache_bytes -= _image_entry_size(entry)
+    if image_cache_dir:
+        for path in (_image_spill_path(bucket, key), _image_spill_path(bucket, key) + ".etag"):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def forget_session(bucket, session_id):
+    """Drops the cached images and pointer of a session, e.g. after its prefix was deleted."""
+    prefix = session_prefix(session_id)
+    with _image_cache_lock:
+        keys = [key for cached_bucket, key in _image_cache if cached_bucket == bucket and key.startswith(prefix)]
+    for key in keys:
+        forget_image(bucket, key)
+
+
+def get_input_image(bucket, key, immutable=False):
+    """
+    Returns the cached entry (etag and raw bytes; see image_base64) for an S3 image, or None when it doesn't exist.
+    A cached entry is revalidated with a conditional GET, so an unchanged image costs a single
+    304 response, or no request at all while it is younger than BWB_IMAGE_CACHE_TTL.
+    Content-addressed (immutable) keys are never revalidated once cached.
+    """
+    with _image_cache_lock:
+        entry = _image_cache.get((bucket, key))
+    if entry is None:
+        entry = _load_spilled_image(bucket, key)
+
+    if entry is not None and (immutable or time.monotonic() - entry["checked_at"] < image_cache_ttl):
+        return entry
+
+    request = {"Bucket": bucket, "Key": key}
+    if entry is not None:
+        request["IfNoneMatch"] = entry["etag"]
+
+    try:
+        with telemetry.span("s3_get"):
+            response = get_s3_client().get_object(**request)
+            data = response['Body'].read()
+    except ClientError as e:
+        code = e.response['Error']['Code']
+        if code in ('304', 'NotModified'):
+            entry["checked_at"] = time.monotonic()
+            _cache_image_entry(bucket, key, entry)
+            return entry
+        if code in ('404', 'NoSuchKey'):
+            forget_image(bucket, key)
+            return None
+        raise
+
+    telemetry.count("s3_download_bytes", len(data))
+    return remember_image(bucket, key, data, response['ETag'])
+
+
+# Images are stored per agent session under content-addressed keys:
+#   sessions/<session ID>/images/<sha256>.png  the image bytes, written once and never modified
+#   sessions/<session ID>/current.json          points at the session's current input image
+# Concurrent sessions never overwrite each other, and identical images in a session are stored once.
+# Deleting the sessions/<session ID>/ prefix cleans a session up. The Streamlit client does that when
+# it ends a session; s3-lifecycle.json expires whatever it misses (a restarted client, a session the
+# service ended) after 7 days, the longest presigned URL lifetime. Apply it to the bucket with
+#   aws s3api put-bucket-lifecycle-configuration --bucket <bucket> --lifecycle-configuration file://s3-lifecycle.json
+# (this replaces the bucket's existing rules; merge them in first if it has any).
+def session_prefix(session_id):
+    return f"sessions/{session_id}/"
+
+
+def session_image_key(session_id, image_bytes):
+    return f"{session_prefix(session_id)}images/{hashlib.sha256(image_bytes).hexdigest()}.png"
+
+
+def session_pointer_key(session_id):
+    return f"{session_prefix(session_id)}current.json"
+
+
+def get_session_image(bucket, session_id):
+    """Returns the cache entry of the session's current input image, or None when it has none."""
+    if not session_id:
+        return get_input_image(bucket, object_name)
+
+    pointer = get_input_image(bucket, session_pointer_key(session_id))
+    if pointer is None:
+        # The session was deleted (or never had an image); drop whatever is still cached for it
+        forget_session(bucket, session_id)
+        return None
+    return get_input_image(bucket, json.loads(pointer["bytes"])["key"], immutable=True)
+
+
+def put_image(bucket, key, data, content_type, cache=True):
+    """Uploads an object; it's cached only when cache is set (it will be read back as an input)."""
+    with telemetry.span("s3_upload"):
+        response = get_s3_client().put_object(Bucket=bucket, Key=key, Body=data, ContentType=content_type)
+    telemetry.count("s3_upload_bytes", len(data))
+    if cache:
+        remember_image(bucket, key, data, response['ETag'])
+
+
+def store_session_image(bucket, session_id, image_bytes, make_current=True, legacy_key=object_name):
+    """
+    Stores PNG bytes under the session's content-addressed key and optionally makes it the
+    session's current input image. Events without a session ID fall back to the shared legacy
+    key. Returns the object key.
+
+    Both objects are always written: the session may have been deleted since this container
+    cached them, and rewriting a content-addressed key is idempotent.
+    """
+    # Only the current image is read back (as the next input), so only it is cached
+    if not session_id:
+        put_image(bucket, legacy_key, image_bytes, 'image/png', cache=make_current)
+        if not make_current:
+            forget_image(bucket, legacy_key)  # legacy keys are overwritten; drop what was cached for it
+        return legacy_key
+
+    key = session_image_key(session_id, image_bytes)
+    put_image(bucket, key, image_bytes, 'image/png', cache=make_current)
+    if make_current:
+        pointer = json.dumps({"key": key}).encode("utf-8")
+        put_image(bucket, session_pointer_key(session_id), pointer, 'application/json')
+    return key
+
+
+def get_image_response(client, model_id, prompt_content, session_id=None, mask_box=None, use_cache=True, variants=1): #text-to-text client function
+    """Returns the list of generated PNG images (one per variant), or an error message or None on failure."""
+
+    if(model_id.startswith('stability')):
+        request_body = {"text_prompts":
+                                [ {"text": prompt_content} ], #prompts to use
+                                "cfg_scale": 9, #how closely the model tries to match the prompt
+                                "steps": 50, #number of diffusion steps to perform
+                                "samples": 1, } #SDXL on Bedrock generates one image per call
+        try:
+            if variants == 1:
+                payloads = [invoke_model_json(client, model_id, request_body, use_cache)] #call the Bedrock endpoint
             else:
-                raise FileNotFoundError(f"File {img} does not exist")
-        elif isinstance(img, Image.Image):
-            # Handling PIL Image
-            buffer = io.BytesIO()
-            img.save(buffer, format="PNG")
-            return base64.b64encode(buffer.getvalue()).decode("utf-8")
-        elif isinstance(img, io.BytesIO):
-            # Handling BytesIO object
-            return base64.b64encode(img.getvalue()).decode("utf-8")
+                # One call per variant, each with its own random seed so the images differ. The
+                # seeds never repeat, so these responses are kept out of the response cache.
+                bodies = [dict(request_body, seed=seed) for seed in random.sample(range(1, 2**32), variants)]
+                executor = get_variant_executor()
+                futures = [executor.submit(contextvars.copy_context().run, invoke_model_json, client, model_id, body, False)
+                           for body in bodies]
+                payloads = [future.result() for future in futures]
+            images = [image for payload in payloads for image in (payload.get('artifacts') or [])] #extract the image artifacts
+
+            # Check if images is None or empty
+            if not images or any('base64' not in image for image in images):
+                logging.error("No images found or 'base64' key is missing.")
+                return "No image data found in the response."
+
+            with telemetry.span("image_decode"):
+                return [base64.b64decode(image.get('base64')) for image in images] #decode images to the model's PNG bytes
+
+        except Exception as e:
+            logging.error(f"An error occurred: {str(e)}")
+            return (f"An error occurred processing the image response:  {str(e)}")
+
+    elif(model_id == 'amazon.titan-image-generator-v1'):
+        if "change" in prompt_content.lower():   #IMAGE MODIFICATION DETECTOR
+            # Fetch the image from S3 (through the image cache)
+            s3_image = get_session_image(bucket_name, session_id)
+            if s3_image is None:
+                logger.error("There is no image in S3 to modify for session %s", session_id)
+                return None
+
+            # PNG sources are sent as the cached base64 of the original bytes and
+            # sized from their header; other formats are converted once
+            if is_png(s3_image["bytes"]):
+                source_base64 = image_base64(s3_image)
+                image_size = png_size(s3_image["bytes"])
+            else:
+                png_bytes = ensure_png(s3_image["bytes"])
+                source_base64 = base64.b64encode(png_bytes).decode("utf-8")
+                image_size = png_size(png_bytes)
+            print(f"Image size: {image_size}")
+
+            # box = (left, top, right, bottom)
+            box = get_mask_box(image_size, mask_box)
+            print("THE MASK ON IMAGE MOD: ", box)
+            with telemetry.span("mask_build"):
+                mask_base64 = inpaint_mask_base64(image_size, box)
+
+            request_body = {
+                "taskType": "INPAINTING",
+                "inPaintingParams": {
+                    "text": prompt_content,              # Optional
+                    #"negativeText": negative_prompts,   # Optional
+                    "image": source_base64,               # One image is required
+                    #"maskPrompt": "sky",               # One of "maskImage" or "maskPrompt" is required
+                    "maskImage": mask_base64  # Input maskImage based on the values 0 (black) or 255 (white) only
+                },
+                "imageGenerationConfig": {
+                    "numberOfImages": variants,
+                    "quality": "premium",
+                    "height": 1024,
+                    "width": 1024,
+                    "cfgScale": 7.5,
+                    "seed": 42
+                }
+            }
+
         else:
-            raise ValueError(f"Expected str (filename), PIL Image, or BytesIO object. Got {type(img)}")
+            request_body = {
+                "taskType": "TEXT_IMAGE",
+                "textToImageParams": {
+                    "text": prompt_content
+                },
+                "imageGenerationConfig": {
+                    "numberOfImages": variants,
+                    "height": 1024,
+                    "width": 1024,
+                    "cfgScale": 8.0,
+                    "seed": 0
+                }
+            }
+
+    try:
+        # The generated PNG bytes are passed through as-is; they're only decoded if a transform needs it
+        return generate_image(model_id=model_id, body=request_body, use_cache=use_cache)
 
+    except ClientError as err:
+        message = err.response["Error"]["Message"]
+        logger.error("A client error occurred: %s", message)
+        print("A client error occured: " +
+            format(message))
+    except ImageError as err:
+        logger.error(err.message)
+        print(err.message)
 
 
+def generate_image(model_id, body, use_cache=True):
+    """
+    Generate an image using Amazon Titan Image Generator G1 model on demand.
+    Args:
+        model_id (str): The model ID to use.
+        body (dict) : The request body to use.
+        use_cache (bool): Whether a cached image for the same request may be returned.
+    Returns:
+        images (list of bytes): The images generated by the model, one per numberOfImages.
+    """
 
-    class Claude3Wrapper:
-        """Encapsulates Claude 3 model invocations using the Amazon Bedrock Runtime client."""
-        def __init__(self, client=None):
-            self.client = client or boto3.client(
-                service_name="bedrock-runtime", region_name=os.environ.get("BWB_REGION_NAME")
-            )
+    logger.info("Generating image with Amazon Titan Image Generator G1 model %s", model_id)
+    bedrock = get_bedrock_client()
+    response_body = invoke_model_json(bedrock, model_id, body, use_cache)
+    finish_reason = response_body.get("error")
+
+    if finish_reason is not None:
+        raise ImageError(f"Image generation error. Error is {finish_reason}")
+
+    with telemetry.span("image_decode"):
+        images = [base64.b64decode(base64_image.encode('ascii')) for base64_image in response_body.get("images")]
+
+    logger.info(
+        "Successfully generated %d image(s) with Amazon Titan Image Generator G1 model %s", len(images), model_id)
 
-        def invoke_claude_3_with_text(self, prompt):
-            """
-            Invokes Anthropic Claude 3 Sonnet to run an inference using the input provided in the request body.
-            """
-            try:
-                response = self.client.invoke_model(
-                    modelId=model_id,
-                    body=json.dumps(
-                        {
-                            "anthropic_version": "bedrock-2023-05-31",
-                            "max_tokens": 1024,
-                            "messages": [
-                                {
-                                    "role": "user",
-                                    "content": [{"type": "text", "text": prompt}],
-                                }
-                            ],
-                        }
-                    ),
-                )
-
-                result = json.loads(response.get("body").read())
-                input_tokens = result["usage"]["input_tokens"]
-                output_tokens = result["usage"]["output_tokens"]
-                output_list = result.get("content", [])
-                
-
-                print("Invocation details:")
-                print(f"- The input length is {input_tokens} tokens.")
-                print(f"- The output length is {output_tokens} tokens.")
-                
-                return output_list
-
-            except ClientError as err:
-                logger.error("Couldn't invoke Claude 3 with text. Error: %s", err)
-                raise
-
-        def invoke_claude_3_multimodal(self, prompt, base64_image_data):
-            """
-            Invokes Anthropic Claude 3 Haiku to run a multimodal inference using the input provided in the request body.
-            """
-
-            try:
-                request_body = {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 2048,
-                    "messages": [
-                        {
-                            "role": "user",
-                            "content": [
-                                {"type": "text", "text": prompt},
-                                {
-                                    "type": "image",
-                                    "source": {
-                                        "type": "base64",
-                                        "media_type": "image/png",
-                                        "data": base64_image_data,
-                                    },
-                                },
-                            ],
-                        }
-                    ],
+    return images
+
+
+def png_size(png_bytes):
+    """Reads (width, height) from a PNG's IHDR chunk without decoding the image."""
+    return int.from_bytes(png_bytes[16:20], "big"), int.from_bytes(png_bytes[20:24], "big")
+
+
+class MaskBoxError(ValueError):
+    "Raised for a maskBox that isn't a non-empty box on the image; the agent gets a 400"
+
+
+def parse_mask_box(mask_box):
+    """Parses a "left,top,right,bottom" maskBox into a tuple of 4 integers with left < right and top < bottom."""
+    try:
+        box = tuple(int(value) for value in str(mask_box).split(","))
+    except ValueError:
+        raise MaskBoxError(f"maskBox must be 4 comma-separated integers, got {mask_box!r}") from None
+    if len(box) != 4:
+        raise MaskBoxError(f"maskBox must be 4 comma-separated integers, got {mask_box!r}")
+    if not (box[0] < box[2] and box[1] < box[3]):
+        raise MaskBoxError(f"maskBox must have left < right and top < bottom, got {mask_box!r}")
+    return box
+
+
+def get_mask_box(image_size, mask_box=None):
+    """Returns the (left, top, right, bottom) inpainting box, clamped to the image."""
+    width, height = image_size
+    if mask_box:
+        box = mask_box if isinstance(mask_box, tuple) else parse_mask_box(mask_box)
+    else:
+        box = ((width - mask_width) // 2, height - mask_bottom_offset - mask_height,
+               (width + mask_width) // 2, height - mask_bottom_offset)
+    left, top, right, bottom = box
+    box = max(left, 0), max(top, 0), min(right, width), min(bottom, height)
+    if not (box[0] < box[2] and box[1] < box[3]):
+        raise MaskBoxError(f"The mask box {tuple(box)} doesn't overlap the {width}x{height} image")
+    return box
+
+
+def inpaint_mask(img_size, box):
+    """Generates a segmentation mask for inpainting: black inside the box, white elsewhere"""
+    from PIL import Image
+    # (left, top, right, bottom)
+    if len(box) != 4 or not (box[0] < box[2] and box[1] < box[3]):
+        raise MaskBoxError(f"The mask box {tuple(box)} is empty")
+    # A single-channel mask is a third of the size of an RGB one and encodes much faster
+    mask = Image.new(mode="L", size=img_size, color=255)
+    mask.paste(0, box)
+    return mask
+
+
+@functools.lru_cache(maxsize=64)
+def inpaint_mask_base64(img_size, box):
+    """Returns the base64 PNG of the inpainting mask, memoized by image size and box"""
+    return image_to_base64(inpaint_mask(img_size, box))
+
+
+def image_to_base64(img):
+    """Converts a PIL Image, local image file path, or BytesIO object to a base64 string"""
+    if isinstance(img, str):
+        # Handling file path
+        if os.path.isfile(img):
+            print(f"Reading image from file: {img}")
+            with open(img, "rb") as f:
+                return base64.b64encode(f.read()).decode("utf-8")
+        else:
+            raise FileNotFoundError(f"File {img} does not exist")
+    elif isinstance(img, io.BytesIO):
+        # Handling BytesIO object
+        return base64.b64encode(img.getvalue()).decode("utf-8")
+
+    from PIL import Image
+    if isinstance(img, Image.Image):
+        # Handling PIL Image
+        buffer = io.BytesIO()
+        img.save(buffer, format="PNG")
+        return base64.b64encode(buffer.getvalue()).decode("utf-8")
+    else:
+        raise ValueError(f"Expected str (filename), PIL Image, or BytesIO object. Got {type(img)}")
+
+
+class Claude3Wrapper:
+    """Encapsulates Claude 3 model invocations using the Amazon Bedrock Runtime client."""
+    def __init__(self, model_id, client=None):
+        self.model_id = model_id
+        self.client = client or get_bedrock_client()
+
+    def build_request_body(self, prompt, base64_image_data=None, max_tokens=1024, media_type="image/png"):
+        """Builds the Messages API request body, adding the image block for multimodal calls."""
+        content = [{"type": "text", "text": prompt}]
+        if base64_image_data:
+            content.append(
+                {
+                    "type": "image",
+                    "source": {
+                        "type": "base64",
+                        "media_type": media_type,
+                        "data": base64_image_data,
+                    },
                 }
+            )
+        return {
+            "anthropic_version": "bedrock-2023-05-31",
+            "max_tokens": max_tokens,
+            "messages": [{"role": "user", "content": content}],
+        }
+
+    def invoke_claude_3_with_text(self, prompt, use_cache=True, max_tokens=1024):
+        """
+        Invokes Anthropic Claude 3 Sonnet to run an inference using the input provided in the request body.
+        """
+        try:
+            result = invoke_model_json(self.client, self.model_id,
+                                       self.build_request_body(prompt, max_tokens=max_tokens), use_cache)
+            input_tokens = result["usage"]["input_tokens"]
+            output_tokens = result["usage"]["output_tokens"]
+            output_list = result.get("content", [])
+
+
+            print("Invocation details:")
+            print(f"- The input length is {input_tokens} tokens.")
+            print(f"- The output length is {output_tokens} tokens.")
+
+            return output_list
+
+        except ClientError as err:
+            logger.error("Couldn't invoke Claude 3 with text. Error: %s", err)
+            raise
+
+    def invoke_claude_3_multimodal(self, prompt, base64_image_data, media_type="image/png", use_cache=True,
+                                   max_tokens=2048):
+        """
+        Invokes Anthropic Claude 3 Haiku to run a multimodal inference using the input provided in the request body.
+        """
 
-                response = self.client.invoke_model(
-                    modelId=model_id,
-                    body=json.dumps(request_body),
-                )
-
-                result = json.loads(response.get("body").read())
-                input_tokens = result["usage"]["input_tokens"]
-                output_tokens = result["usage"]["output_tokens"]
-                output_list = result.get("content", [])
-                
-
-                print("Invocation details:")
-                print(f"- The input length is {input_tokens} tokens.")
-                print(f"- The output length is {output_tokens} tokens.")
-                
-                return output_list
-
-            except ClientError as err:
-                logger.error("Couldn't invoke Claude 3 multimodally. Error: %s", err)
-                raise
-
-    class ImageError(Exception):
-        "Custom exception for errors returned by Amazon Titan Image Generator G1"
-
-        def __init__(self, message):
-            self.message = message
-
-    def get_inference_parameters(model): #return a default set of parameters based on the model's provider
-        bedrock_model_provider = model.split('.')[0] #grab the model provider from the first part of the model id
-        
-        if (bedrock_model_provider == 'mistral'):
-            #example modelID: mistral.gpt-3.5-turbo
-            #example modelID: mistral.mistral-large-2402-v1:0
+        try:
+            request_body = self.build_request_body(prompt, base64_image_data, max_tokens=max_tokens, media_type=media_type)
+
+            result = invoke_model_json(self.client, self.model_id, request_body, use_cache)
+            input_tokens = result["usage"]["input_tokens"]
+            output_tokens = result["usage"]["output_tokens"]
+            output_list = result.get("content", [])
+
+
+            print("Invocation details:")
+            print(f"- The input length is {input_tokens} tokens.")
+            print(f"- The output length is {output_tokens} tokens.")
+
+            return output_list
+
+        except ClientError as err:
+            logger.error("Couldn't invoke Claude 3 multimodally. Error: %s", err)
+            raise
+
+    def stream_claude_3(self, prompt, base64_image_data=None, usage=None, media_type="image/png", max_tokens=None):
+        """
+        Streams a Claude 3 text or multimodal inference, yielding text deltas as they arrive.
+        Token usage from the stream is collected into the usage dict when one is given.
+        """
+        max_tokens = max_tokens or claude_3_max_tokens(base64_image_data)
+        body = self.build_request_body(prompt, base64_image_data, max_tokens=max_tokens, media_type=media_type)
+        try:
+            yield from stream_model_response(self.client, self.model_id, body, parse_claude_3_chunk, usage)
+        except ClientError as err:
+            logger.error("Couldn't stream Claude 3. Error: %s", err)
+            raise
+
+
+def claude_3_max_tokens(base64_image_data=None):
+    """Default max_tokens of a Claude 3 call: more room for image descriptions."""
+    return 2048 if base64_image_data else 1024
+
+
+def parse_claude_3_chunk(chunk, usage):
+    """Returns the text delta of a Messages API stream event and records its token usage."""
+    if chunk["type"] == "message_start":
+        usage["input_tokens"] = chunk["message"]["usage"]["input_tokens"]
+    elif chunk["type"] == "message_delta":
+        usage["output_tokens"] = chunk["usage"]["output_tokens"]
+    elif chunk["type"] == "content_block_delta" and chunk["delta"].get("type") == "text_delta":
+        return chunk["delta"]["text"]
+    return None
+
+
+def stream_model_response(client, model_id, body, parse_chunk, usage=None):
+    """
+    Calls invoke_model_with_response_stream and yields the text deltas parse_chunk extracts.
+    Bedrock's invocation metrics (token counts, first byte latency) are collected into usage.
+    """
+    usage = {} if usage is None else usage
+    request_body = json.dumps(body)
+    telemetry.count("bedrock_request_bytes", len(request_body))
+    with telemetry.span("bedrock_stream"):
+        # The model's limiter slot is held until the whole stream has been read
+        events = admitted_stream(model_id, lambda: client.invoke_model_with_response_stream(
+            modelId=model_id, body=request_body, accept="application/json", contentType="application/json"
+        ).get("body"))
+        for event in events:
+            if "chunk" not in event:
+                continue
+            telemetry.count("bedrock_response_bytes", len(event["chunk"]["bytes"]))
+            chunk = json.loads(event["chunk"]["bytes"])
+            metrics = chunk.get("amazon-bedrock-invocationMetrics")
+            if metrics:
+                usage.update(metrics)
+            delta = parse_chunk(chunk, usage)
+            if delta:
+                yield delta
+    telemetry.count("input_tokens", usage.get("inputTokenCount", 0))
+    telemetry.count("output_tokens", usage.get("outputTokenCount", 0))
+
+
+def collect_stream(deltas):
+    """Joins streamed text deltas, logging the time to the first token."""
+    start = time.perf_counter()
+    parts = []
+    for delta in deltas:
+        if not parts:
+            logger.info("First token after %.1f ms", (time.perf_counter() - start) * 1000)
+        parts.append(delta)
+    return "".join(parts)
+
+
+class ImageError(Exception):
+    "Custom exception for errors returned by Amazon Titan Image Generator G1"
+
+    def __init__(self, message):
+        self.message = message
+
+
+# Name of the max output tokens parameter in each provider's inference parameters
+MAX_TOKENS_PARAMETERS = {
+    'mistral': "max_tokens",
+    'ai21': "maxTokens",
+    'cohere': "max_tokens",
+    'meta': "max_gen_len",
+    'anthropic': "max_tokens_to_sample",
+    'amazon': "maxTokenCount",
+}
+
+
+# Default inference parameters per model provider (the first part of the model ID)
+INFERENCE_PARAMETERS = {
+    #example modelID: mistral.mistral-large-2402-v1:0
+    'mistral': {
+        "max_tokens": 200,
+        "temperature": 0.5,
+        "top_k": 50,
+        "top_p": 0.9,
+    },
+    #example modelID: ai21.j2-ultra-v1
+    'ai21': {
+        "maxTokens": 512,
+        "temperature": 0,
+        "topP": 0.5,
+        "stopSequences": [],
+        "countPenalty": {"scale": 0 },
+        "presencePenalty": {"scale": 0 },
+        "frequencyPenalty": {"scale": 0 }
+    },
+    #example modelID: cohere.command-text-v14
+    'cohere': {
+        "max_tokens": 512,
+        "temperature": 0,
+        "p": 0.01,
+        "k": 0,
+        "stop_sequences": [],
+        "return_likelihoods": "NONE"
+    },
+    #example modelID: meta.llama2-70b-chat-v1
+    'meta': {
+        "temperature": 0,
+        "top_p": 0.9,
+        "max_gen_len": 512
+    },
+    #example modelID: stability.stable-diffusion-xl-v0
+    'stability': {
+        "weight": 1,
+        "cfg_scale": 10,
+        "seed": 0,
+        "steps": 50,
+        "width": 512,
+        "height": 512
+    },
+    #example modelID: anthropic.claude-v2:1
+    'anthropic': {
+        "max_tokens_to_sample": 300,
+        "temperature": 0.5,
+        "top_k": 250,
+        "top_p": 1,
+        "stop_sequences": ["\n\nHuman:"],
+        "anthropic_version": "bedrock-2023-05-31"
+    },
+    #example modelID: amazon.titan-text-express-v1
+    #These parameters go in the textGenerationConfig item of the Titan request body
+    'amazon': {
+        "maxTokenCount": 512,
+        "stopSequences": [],
+        "temperature": 0,
+        "topP": 0.9
+    },
+}
+
+
+def get_inference_parameters(model_id, prompt): #return a default set of parameters based on the model's provider
+    if(model_id == 'amazon.titan-image-generator-v1'):
+        # Check if the word "change" is in the prompt (case-insensitive). If so, this setup will be needed for IMAGE MODIFICATION (inpainting)
+        if "change" in prompt.lower():
             return {
-                "max_tokens": 200,
-                "temperature": 0.5,
-                "top_k": 50,
-                "top_p": 0.9,
+                "taskType": "TEXT_IMAGE",
+                "textToImageParams": {
+                    "text": "string"
+                },
+                "imageGenerationConfig": {
+                    "numberOfImages": 1,
+                    "height": 1024,
+                    "width": 1024,
+                    "cfgScale": 8,
+                    "seed": 0,
+                    "quality": "standard"
+                }
             }
-        elif (bedrock_model_provider == 'ai21'): #AI21
-            #example modelID: ai21.j2-ultra-v1
-            return { #AI21
-                "maxTokens": 512, 
-                "temperature": 0, 
-                "topP": 0.5, 
-                "stopSequences": [], 
-                "countPenalty": {"scale": 0 }, 
-                "presencePenalty": {"scale": 0 }, 
-                "frequencyPenalty": {"scale": 0 } 
-            }    
-        elif (bedrock_model_provider == 'cohere'): #COHERE
-            #example modelID: cohere.command-text-v14
-            return {
-                "max_tokens": 512,
-                "temperature": 0,
-                "p": 0.01,
-                "k": 0,
-                "stop_sequences": [],
-                "return_likelihoods": "NONE"
-            }   
-        elif (bedrock_model_provider == 'meta'): #META
-            #example modelID: meta.llama2-70b-chat-v1
-            return {
-                "temperature": 0,
-                "top_p": 0.9,
-                "max_gen_len": 512
-            }  
-        elif (bedrock_model_provider == 'stability'): 
-            #example modelID: stability.stable-diffusion-xl-v0
+        else:
             return {
-                "weight": 1,
-                "cfg_scale": 10,
-                "seed": 0,
-                "steps": 50,
-                "width": 512,
-                "height": 512
-            }         
-        elif(bedrock_model_provider == 'anthropic'): #Anthropic
-            #example modelID: openai.gpt-3.5-turbo
-            return { 
-                "max_tokens_to_sample": 300,
-                "temperature": 0.5, 
-                "top_k": 250, 
-                "top_p": 1, 
-                "stop_sequences": ["\n\nHuman:"],
-                "anthropic_version": "bedrock-2023-05-31" 
-            }
-        elif(model_id == 'amazon.titan-image-generator-v1'):
-            # Check if the word "change" is in the prompt (case-insensitive). If so, this setup will be needed for IMAGE MODIFICATION (inpainting)
-            if "change" in prompt.lower():
-                return {
-                    "taskType": "TEXT_IMAGE",
-                    "textToImageParams": {
-                        "text": "string"
-                    },
-                    "imageGenerationConfig": {
-                        "numberOfImages": 1,
-                        "height": 1024,
-                        "width": 1024,
-                        "cfgScale": 8,
-                        "seed": 0,
-                        "quality": "standard"
-                    }
-                }
-            else:
-                return {
-                    "taskType": "TEXT_IMAGE",
-                    "textToImageParams": {
-                        "text": "string",      
-                        "negativeText": "string"
-                    },
-                    "imageGenerationConfig": {
-                        "numberOfImages": int,
-                        "height": int,
-                        "width": int,
-                        "cfgScale": float,
-                        "seed": int
-                    }
+                "taskType": "TEXT_IMAGE",
+                "textToImageParams": {
+                    "text": "string",
+                    "negativeText": "string"
+                },
+                "imageGenerationConfig": {
+                    "numberOfImages": int,
+                    "height": int,
+                    "width": int,
+                    "cfgScale": float,
+                    "seed": int
                 }
-        else: #Amazon
-            #For the LangChain Bedrock implementation, these parameters will be added to the 
-            #textGenerationConfig item that LangChain creates for us
-            return { 
-                "maxTokenCount": 512, 
-                "stopSequences": [], 
-                "temperature": 0, 
-                "topP": 0.9 
             }
-  
-    def get_text_response(model_id, prompt):
-        client = boto3.client(service_name="bedrock-runtime", region_name=os.environ.get("BWB_REGION_NAME"))
-        encoded_image = None
 
+    bedrock_model_provider = model_id.split('.')[0] #grab the model provider from the first part of the model id
+    # Unknown providers fall back to the Amazon Titan text parameters
+    return copy.deepcopy(INFERENCE_PARAMETERS.get(bedrock_model_provider, INFERENCE_PARAMETERS['amazon']))
+
+
+class TextAdapter:
+    """Calls a text model through invoke_model using the provider's native request and response format."""
+    def __init__(self, build_body, parse_response, parse_chunk=None, stream_parameters=None):
+        self.build_body = build_body
+        self.parse_response = parse_response
+        # Providers without a chunk parser don't support response streaming
+        self.parse_chunk = parse_chunk
+        self.stream_parameters = stream_parameters or {}
+
+    def request_body(self, model_id, prompt):
+        """Builds the request body with the prompt and max tokens fitted to the model's budget."""
+        params = get_inference_parameters(model_id, prompt)
+        name = MAX_TOKENS_PARAMETERS.get(model_id.split('.')[0], MAX_TOKENS_PARAMETERS['amazon'])
+        prompt, params[name] = apply_token_budget(model_id, prompt, params[name])
+        return self.build_body(prompt, params)
+
+    def invoke(self, model_id, prompt, client=None, use_cache=True):
+        client = client or get_bedrock_client()
+        body = self.request_body(model_id, prompt)
+        return self.parse_response(invoke_model_json(client, model_id, body, use_cache))
+
+    def stream(self, model_id, prompt, client=None, usage=None):
+        """Yields text deltas from invoke_model_with_response_stream as they arrive."""
+        client = client or get_bedrock_client()
+        body = dict(self.request_body(model_id, prompt), **self.stream_parameters)
+        parse_chunk = self.parse_chunk
+        yield from stream_model_response(client, model_id, body, lambda chunk, usage: parse_chunk(chunk), usage)
+
+
+# One adapter per provider; the request formats match what LangChain's Bedrock LLM sends
+TEXT_ADAPTERS = {
+    'mistral': TextAdapter(
+        lambda prompt, params: dict(params, prompt=prompt),
+        lambda result: result["outputs"][0]["text"],
+        lambda chunk: chunk["outputs"][0]["text"]
+    ),
+    'meta': TextAdapter(
+        lambda prompt, params: dict(params, prompt=prompt),
+        lambda result: result["generation"],
+        lambda chunk: chunk.get("generation")
+    ),
+    'cohere': TextAdapter(
+        lambda prompt, params: dict(params, prompt=prompt),
+        lambda result: result["generations"][0]["text"],
+        lambda chunk: chunk.get("text"),
+        stream_parameters={"stream": True}
+    ),
+    'ai21': TextAdapter(
+        lambda prompt, params: dict(params, prompt=prompt),
+        lambda result: result["completions"][0]["data"]["text"]
+    ),
+    'anthropic': TextAdapter(
+        lambda prompt, params: dict(params, prompt=f"\n\nHuman: {prompt}\n\nAssistant:"),
+        lambda result: result["completion"],
+        lambda chunk: chunk.get("completion")
+    ),
+    'amazon': TextAdapter(
+        lambda prompt, params: {"inputText": prompt, "textGenerationConfig": params},
+        lambda result: result["results"][0]["outputText"],
+        lambda chunk: chunk.get("outputText")
+    ),
+}
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+
+def is_png(image_bytes):
+    """Checks the PNG signature without decoding the image."""
+    return image_bytes[:8] == PNG_SIGNATURE
+
+
+def ensure_png(image_bytes):
+    """Returns PNG bytes, decoding and re-encoding only when the input isn't already a PNG."""
+    if is_png(image_bytes):
+        return image_bytes
+
+    from PIL import Image
+    output_image_bytes = io.BytesIO()
+    Image.open(io.BytesIO(image_bytes)).save(output_image_bytes, format='PNG')
+    return output_image_bytes.getvalue()
+
+
+def store_generated_image(image_bytes, bucket, session_id=None, make_current=True, legacy_key=object_name, expires_in=3600):
+    """
+    Saves generated image bytes to an S3 bucket without re-encoding PNG output.
+    Returns the image metadata: its key, a presigned URL, its size in bytes and its dimensions.
+    """
+    png_bytes = ensure_png(image_bytes)
+    object_name = store_session_image(bucket, session_id, png_bytes, make_current=make_current, legacy_key=legacy_key)
+    print(f"Image successfully saved to s3://{bucket}/{object_name}")
+
+    # Generate a presigned URL for the saved image
+    with telemetry.span("presign"):
+        presigned_url = get_s3_client().generate_presigned_url('get_object',
+                                                Params={'Bucket': bucket, 'Key': object_name},
+                                                ExpiresIn=expires_in)
+    width, height = png_size(png_bytes)
+    return {"key": object_name, "url": presigned_url, "bytes": len(png_bytes), "width": width, "height": height,
+            "expires_in": expires_in}
+
+
+def variant_key(legacy_key, index):
+    """Legacy key of the index-th variant: the_image.png, the_image_1.png, the_image_2.png, ..."""
+    if index == 0:
+        return legacy_key
+    stem, extension = os.path.splitext(legacy_key)
+    return f"{stem}_{index}{extension}"
+
+
+def save_images_to_s3(images, bucket, session_id=None, make_current=True, legacy_key=object_name, expires_in=3600):
+    """
+    Uploads generated variants concurrently and returns their metadata in generation order.
+    Only the first variant becomes the session's current image. A variant that failed to
+    upload has an "error" instead of a URL.
+    """
+    def save(index, image_bytes):
         try:
-            # Check if the file exists in S3
-            s3.head_object(Bucket=bucket_name, Key=object_name)
-            file_exists = True
-        except ClientError as e:
-            # If a ClientError is thrown, check if it was a 404 error
-            # which means the object does not exist.
-            if e.response['Error']['Code'] == '404':
-                file_exists = False
-            else:
-                # Reraise the exception if it was a different error
-                raise
-
-        if file_exists:
-            # Create a BytesIO object to store image data from S3
-            file_stream = io.BytesIO()
-            s3.download_fileobj(bucket_name, object_name, file_stream)
-
-            # Reset the file pointer to the beginning after download
-            file_stream.seek(0)
-
-            # Directly encode the downloaded image data to base64
-            encoded_image = base64.b64encode(file_stream.getvalue()).decode('utf-8')
-            # Here you can use encoded_image as needed
-            print("File exists and has been encoded.")
+            metadata = store_generated_image(image_bytes, bucket, session_id, make_current and index == 0,
+                                             variant_key(legacy_key, index), expires_in)
+        except Exception as e:
+            print(e)
+            metadata = {"error": f"{type(e).__name__}: {e}"}
+        return dict(metadata, index=index)
+
+    if len(images) == 1:
+        return [save(0, images[0])]
+    executor = get_upload_executor()
+    futures = [executor.submit(contextvars.copy_context().run, save, index, image) for index, image in enumerate(images)]
+    return [future.result() for future in futures]
+
+
+def image_result(message, images):
+    """Builds the action response for generated images; "url" stays the first image's URL."""
+    saved = [image for image in images if "url" in image]
+    if not saved:
+        return {"message": "Failed to create or save the image."}
+    return {"message": message, "url": saved[0]["url"], "images": images}
+
+
+def get_text_response(model_id, prompt, stream=False, session_id=None, mask_box=None, use_cache=True, variants=1):
+    with _model_invocations_lock:
+        model_invocations[model_id] += 1
+    client = get_bedrock_client()
+
+    if model_id == 'anthropic.claude-3-haiku-20240307-v1:0' or model_id == 'anthropic.claude-3-sonnet-20240229-v1:0':
+        # Claude 3 describes the uploaded image when there is one in S3
+        image = get_session_image(bucket_name, session_id)
+        if image:
+            # Downsize and re-encode to the configured budget before base64 goes over the wire
+            with telemetry.span("image_preprocess"):
+                prepared = image_preprocessing.preprocess_image(image["bytes"])
+            telemetry.count("image_bytes", prepared["processed_bytes"])
+            telemetry.count("image_tokens_estimate", prepared["tokens"])
+            encoded_image, media_type, image_tokens = prepared["base64"], prepared["media_type"], prepared["tokens"]
+            print(f"File exists and has been encoded: {prepared['original_size']} -> {prepared['size']} {media_type}, "
+                  f"{prepared['original_bytes']} -> {prepared['processed_bytes']} bytes, ~{prepared['tokens']} image tokens.")
         else:
+            encoded_image, media_type, image_tokens = None, "image/png", 0
             print("File does not exist in the bucket.")
+        prompt, max_tokens = apply_token_budget(model_id, prompt, claude_3_max_tokens(encoded_image), image_tokens)
+
+        # Invoke Claude 3 with text to text
+        wrapper = get_claude_wrapper(model_id)
+        if stream:
+            # Stream the completion and assemble the same content list invoke_model returns
+            usage = {}
+            text = collect_stream(wrapper.stream_claude_3(prompt, encoded_image, usage, media_type, max_tokens))
+            print("Invocation details:")
+            print(f"- The input length is {usage.get('input_tokens')} tokens.")
+            print(f"- The output length is {usage.get('output_tokens')} tokens.")
+            return [{"type": "text", "text": text}]
+        elif not encoded_image:
+            return wrapper.invoke_claude_3_with_text(prompt, use_cache, max_tokens)
+        else:
+            # Invoke Claude 3 with image to text
+            return wrapper.invoke_claude_3_multimodal(prompt, encoded_image, media_type, use_cache, max_tokens)
+
+    # Conditional check for model_id starting with 'stability'
+    elif model_id.startswith('stability'):
+        image_response = get_image_response(client, model_id, prompt, session_id, use_cache=use_cache, variants=variants)
+        if not isinstance(image_response, list):
+            # get_image_response returns an error message when Stability didn't produce an image
+            return {"message": f"Failed to create or save the image. {image_response}"}
+        images = save_images_to_s3(image_response, bucket_name, session_id, expires_in=3600)  # URLs expire in 1 hour
+        return image_result("Stability image created and saved successfully", images)
+
+    # Conditional check for model_id equal to 'amazon.titan-image-generator-v1'
+    elif model_id == 'amazon.titan-image-generator-v1':
+        image_response = get_image_response(client, model_id, prompt, session_id, mask_box, use_cache, variants)
+        if image_response is None:
+            return {"message": "Failed to create or save the image."}
+        # A modified image is stored as a new image without replacing the session's current input image
+        modified = "change" in prompt.lower()
+        images = save_images_to_s3(image_response, bucket_name, session_id, make_current=not modified,
+                                   legacy_key="modified_image.png" if modified else object_name,
+                                   expires_in=604800)  # URLs expire in 7 days
+        return image_result("Amazon image created and saved successfully", images)
 
-            # Load the image file into a variable
-            #fetched_image = Image.open(file_stream)   
+    else:
+        adapter = TEXT_ADAPTERS.get(model_id.split('.')[0])
+        if adapter is not None and text_engine == "native":
+            if stream and adapter.parse_chunk is not None:
+                return collect_stream(adapter.stream(model_id, prompt, client))
+            return adapter.invoke(model_id, prompt, client, use_cache)
+        # The pooled LangChain LLM has its max tokens fixed, so only the prompt is fitted
+        name = MAX_TOKENS_PARAMETERS.get(model_id.split('.')[0], MAX_TOKENS_PARAMETERS['amazon'])
+        prompt, _ = apply_token_budget(model_id, prompt, get_inference_parameters(model_id, prompt)[name])
+        return get_langchain_llm(model_id).predict(prompt)
+
+
+def call_models(request):
+    """
+    Runs every /callModels item concurrently on the batch thread pool.
+    Returns the per-item results in request order, each with its timing and error (if any),
+    and the wall-clock time of the whole batch.
+    """
+    def run_item(index, item):
+        start = time.perf_counter()
+        outcome = {'index': index, 'modelId': item['model_id'], 'prompt': item['prompt']}
+        try:
+            outcome['result'] = get_text_response(item['model_id'], item['prompt'], stream=request['stream'],
+                                                  session_id=request['session_id'], mask_box=request['mask_box'],
+                                                  use_cache=request['use_cache'], variants=request['variants'])
+        except Exception as e:
+            # One failing model doesn't fail the batch
+            logger.error("Batch item %d (%s) failed: %s", index, item['model_id'], e)
+            outcome['error'] = f"{type(e).__name__}: {e}"
+        outcome['elapsed_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        return outcome
+
+    start = time.perf_counter()
+    executor = get_batch_executor()
+    # Each item runs in a copy of this context so it sees the invocation deadline
+    futures = [executor.submit(contextvars.copy_context().run, run_item, index, item)
+               for index, item in enumerate(request['items'])]
+    results = [future.result() for future in futures]
+    return {
+        'results': results,
+        'succeeded': sum('error' not in outcome for outcome in results),
+        'failed': sum('error' in outcome for outcome in results),
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 1),
+    }
 
-        if model_id == 'anthropic.claude-3-haiku-20240307-v1:0' or model_id == 'anthropic.claude-3-sonnet-20240229-v1:0':
-            # Invoke Claude 3 with text to text
-            wrapper = Claude3Wrapper(client)
-            if not encoded_image:
-                return wrapper.invoke_claude_3_with_text(prompt)
-            else:
-                # Invoke Claude 3 with image to text
-                return wrapper.invoke_claude_3_multimodal(prompt, encoded_image)
-            
-        # Conditional check for model_id starting with 'stability'
-        elif model_id.startswith('stability'):
-            def save_image_to_s3(image_bytes_io, bucket, object_name):
-                """
-                Saves an image (provided as a BytesIO object) to an S3 bucket for 'stability' models
-                and returns a presigned URL for the object.
-                """
-                try:
-                    image = Image.open(image_bytes_io)
-                    output_image_bytes = io.BytesIO()
-                    image.save(output_image_bytes, format='PNG')
-                    output_image_bytes.seek(0)
-                    s3.put_object(Bucket=bucket, Key=object_name, Body=output_image_bytes.getvalue())
-                    print(f"Image successfully saved to s3://{bucket}/{object_name}")
-                    
-                    # Generate a presigned URL for the saved image
-                    presigned_url = s3.generate_presigned_url('get_object',
-                                                            Params={'Bucket': bucket, 'Key': object_name},
-                                                            ExpiresIn=3600)  # URL expires in 1 hour
-                    return presigned_url
-                except ClientError as e:
-                    print(e)
-                    return None
-
-            image_response = get_image_response(client, prompt)
-            #generated_object_name = 'generated_images/image_{}.png'.format(int(time.time()))
-            generated_object_name = object_name       
-            presigned_url = save_image_to_s3(image_response, bucket_name, generated_object_name)
-            if presigned_url:
-                return {"message": "Stability image created and saved successfully", "url": presigned_url}
-            else:
-                return {"message": "Failed to create or save the image."}
-
-        # Conditional check for model_id equal to 'amazon.titan-image-generator-v1'
-        elif model_id == 'amazon.titan-image-generator-v1':
-
-            #Modify image object_name to create a new image, and store it as modified_image.png
-
-
-
-            def save_image_to_s3(image, bucket, object_name):
-                """
-                Saves an image (provided as a PIL Image object) to an S3 bucket for 'amazon.titan-image-generator-v1' models
-                and returns a presigned URL for the object.
-                """
-                
-                try:
-                    image_bytes = io.BytesIO()
-                    image.save(image_bytes, format='PNG')
-                    image_bytes.seek(0)
-
-                    if "change" in prompt.lower():
-                        object_name = "modified_image.png"
-                    
-
-                    s3.put_object(Bucket=bucket, Key=object_name, Body=image_bytes.getvalue())
-                    print(f"Image successfully saved to s3://{bucket}/{object_name}")
-                    
-                    # Generate a presigned URL for the saved image
-                    presigned_url = s3.generate_presigned_url('get_object',
-                                                            Params={'Bucket': bucket, 'Key': object_name},
-                                                            ExpiresIn=604800)  # URL expires in 7 days
-                    return presigned_url
-                except Exception as e:
-                    print(e)
-                    return None
-
-            image_response = get_image_response(client, prompt)
-            generated_object_name = object_name
-            presigned_url = save_image_to_s3(image_response, bucket_name, generated_object_name)
-            if presigned_url:
-                return {"message": "Amazon image created and saved successfully", "url": presigned_url}
-            else:
-                return {"message": "Failed to create or save the image."}
 
-        else:
-            model_kwargs = get_inference_parameters(model_id)
-            llm = Bedrock(
-                credentials_profile_name=os.environ.get("BWB_PROFILE_NAME"),
-                region_name=os.environ.get("BWB_REGION_NAME"),
-                endpoint_url=os.environ.get("BWB_ENDPOINT_URL"),
-                model_id=model_id,
-                model_kwargs=model_kwargs
-            )
-            return llm.predict(prompt)
+def dispatch(request):
+    """Runs the model call for a parsed request exactly once and returns (status code, result)."""
+    if request.get('error'):
+        return 400, request['error']
+    if request['api_path'] == '/callModels':
+        result = call_models(request)
+        telemetry.log_payload("RESULT", result, log_sample_rate, log_max_string, log_max_chars)
+        record_cache_metrics()
+        return 200, result
+    if request['api_path'] != '/callModel':
+        return 404, f"Unrecognized api path: {request['action_group']}::{request['api_path']}"
 
     try:
-        # Main execution
-        response = get_text_response(model_id, prompt)
-        print(response)
+        result = get_text_response(request['model_id'], request['prompt'], stream=request['stream'],
+                                   session_id=request['session_id'], mask_box=request['mask_box'],
+                                   use_cache=request['use_cache'], variants=request['variants'])
+    except (token_budget.BudgetError, MaskBoxError) as e:
+        # The prompt doesn't fit the model or the mask doesn't fit the image; nothing was sent to Bedrock
+        return 400, str(e)
     except ClientError as e:
-        response = (f"An error occurred processing the text response:  {str(e)}")
         # Prepare a response indicating a request error
+        result = (f"An error occurred processing the text response:  {str(e)}")
+    telemetry.log_payload("RESULT", result, log_sample_rate, log_max_string, log_max_chars)
+    record_cache_metrics()
+    return 200, result
 
 
+def record_cache_metrics():
+    # Hits and misses are counted per call; the memory tier's size goes on the invocation record
+    cache = get_response_cache()
+    if cache is not None:
+        stats = cache.stats()
+        telemetry.gauge("response_cache_entries", stats["entries"])
+        telemetry.gauge("response_cache_bytes", stats["bytes"])
 
-    #----------Below code is for the action group response----------#
-
-    response_code = 200
-    action_group = event['actionGroup']
-    api_path = event['apiPath']
-
-    if api_path == '/callModel':
-        result = get_text_response(model_id, prompt)
-    else:
-        response_code = 404
-        result = f"Unrecognized api path: {action_group}::{api_path}"
 
+def build_action_response(request, response_code, result):
+    #----------Below code is for the action group response----------#
     response_body = {
         'application/json': {
             'body': result
@@ -579,12 +1372,43 @@ def lambda_handler(event, context):
      }
 
     action_response = {
-        'actionGroup': event['actionGroup'],
-        'apiPath': event['apiPath'],
-        'httpMethod': event['httpMethod'],
+        'actionGroup': request['action_group'],
+        'apiPath': request['api_path'],
+        'httpMethod': request['http_method'],
         'httpStatusCode': response_code,
         'responseBody': response_body
     }
 
     api_response = {'messageVersion': '1.0', 'response': action_response}
     return api_response
+
+
+def lambda_handler(event, context):
+    telemetry.log_payload("EVENT", event, log_sample_rate, log_max_string, log_max_chars)
+    record, telemetry_token = telemetry.start_invocation(
+        metrics_namespace, ApiPath=str(event.get('apiPath')), ModelId="none"
+    )
+    if context is not None:
+        telemetry.set_property("RequestId", getattr(context, "aws_request_id", None))
+    telemetry.set_property("SessionId", event.get('sessionId'))
+
+    # Retries and queueing for a model stop in time to return a response before the Lambda times out
+    remaining = context.get_remaining_time_in_millis() / 1000 if context is not None else None
+    deadline_token = admission_control.set_deadline(remaining, deadline_margin)
+    try:
+        # Parse once, dispatch once, and build the action group response from that single result
+        with telemetry.span("parse"):
+            request = parse_request(event)
+        if request['model_id']:
+            telemetry.set_dimension("ModelId", request['model_id'])
+        elif request.get('items'):
+            telemetry.set_dimension("ModelId", "batch")
+        response_code, result = dispatch(request)
+        telemetry.set_property("StatusCode", response_code)
+        with telemetry.span("response_build"):
+            return build_action_response(request, response_code, result)
+    finally:
+        admission_control.reset_deadline(deadline_token)
+        telemetry.end_invocation(telemetry_token)
+        if metrics_enabled:
+            telemetry.emit(record)
@@ -0,0 +1,166 @@
+"""Content-addressed cache for deterministic Bedrock model responses.
+
+Responses are stored as the raw invoke_model body under a SHA-256 of the model ID and
+the canonical JSON request body (which includes any input image), in a bounded in-memory
+LRU tier backed by an optional persistent tier: a local directory or an S3 prefix.
+Every tier expires entries after the same TTL.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter, OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model_id, body):
+    """Hashes the model ID and the request body with sorted keys, so equal requests share a key."""
+    canonical = json.dumps(body, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(f"{model_id}\n{canonical}".encode("utf-8")).hexdigest()
+
+
+def is_deterministic(body):
+    """A request is deterministic when its sampling temperature is 0 or its image seed is fixed."""
+    for config in ("textGenerationConfig", "imageGenerationConfig"):
+        if config in body:
+            body = body[config]
+    if "seed" in body:
+        return True
+    return body.get("temperature", None) == 0
+
+
+class LocalFileStore:
+    """Persistent tier keeping one file per response in a local directory (e.g. /tmp/response-cache)."""
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key, ttl):
+        path = self._path(key)
+        try:
+            if time.time() - os.path.getmtime(path) >= ttl:
+                os.remove(path)
+                return None
+            with open(path, "rb") as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def put(self, key, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            # Write then rename so concurrent readers never see a partial response
+            tmp_path = f"{self._path(key)}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Couldn't write cached response %s to %s: %s", key, self.directory, e)
+
+
+class S3Store:
+    """Persistent tier keeping responses as objects under an S3 prefix, shared by every container."""
+    def __init__(self, bucket, prefix, get_client):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.get_client = get_client
+
+    def get(self, key, ttl):
+        from botocore.exceptions import ClientError
+        try:
+            response = self.get_client().get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response["Error"]["Code"] not in ("404", "NoSuchKey"):
+                logger.warning("Couldn't read cached response %s: %s", key, e)
+            return None
+        last_modified = response.get("LastModified")
+        if last_modified is not None and time.time() - last_modified.timestamp() >= ttl:
+            return None
+        return response["Body"].read()
+
+    def put(self, key, data):
+        from botocore.exceptions import ClientError
+        try:
+            self.get_client().put_object(Bucket=self.bucket, Key=self.prefix + key, Body=data,
+                                         ContentType="application/json")
+        except ClientError as e:
+            logger.warning("Couldn't write cached response %s: %s", key, e)
+
+
+class ResponseCache:
+    """
+    An LRU of response bodies with a TTL, in front of an optional persistent store.
+    The in-memory tier is bounded by entry count and by total bytes; a body larger than a
+    quarter of max_bytes (e.g. a batch of generated images) is only kept in the store.
+    """
+    def __init__(self, max_entries=256, ttl=3600, store=None, max_bytes=64 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.store = store
+        self.metrics = Counter()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the cached response body, or None on a miss."""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[0] < self.ttl:
+                    self._entries.move_to_end(key)
+                    self.metrics["hits"] += 1
+                    return entry[1]
+                del self._entries[key]
+                self._bytes -= len(entry[1])
+                self.metrics["expired"] += 1
+
+        if self.store is not None:
+            data = self.store.get(key, self.ttl)
+            if data is not None:
+                self.metrics["store_hits"] += 1
+                self._remember(key, data)
+                return data
+
+        self.metrics["misses"] += 1
+        return None
+
+    def put(self, key, data):
+        self._remember(key, data)
+        if self.store is not None:
+            self.store.put(key, data)
+
+    def _remember(self, key, data):
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= len(previous[1])
+            if len(data) > self.max_bytes // 4:
+                self.metrics["too_large"] += 1
+                return
+            self._entries[key] = (time.monotonic(), data)
+            self._bytes += len(data)
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._bytes -= len(evicted)
+                self.metrics["evictions"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Returns the hit/miss counters, the entry count and bytes, and the hit ratio."""
+        with self._lock:
+            stats = dict(self.metrics, entries=len(self._entries), bytes=self._bytes)
+        lookups = stats.get("hits", 0) + stats.get("store_hits", 0) + stats.get("misses", 0)
+        stats["hit_ratio"] = round((lookups - stats.get("misses", 0)) / lookups, 4) if lookups else 0.0
+        return stats
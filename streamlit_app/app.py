@@ -1,17 +1,35 @@
 import invoke_agent as agenthelper
 import streamlit as st
-import json
+import altair as alt
+import functools
+import itertools
+import os
 import pandas as pd
+from collections import deque
 from PIL import Image, ImageOps, ImageDraw
 import re
+import token_budget  # a copy of the Lambda's token_budget.py, kept next to the app
 
-live_session_id = "MYSESSION"
-image_name = 'the_image.png'
+# Conversation entries kept per browser session (oldest dropped first) and shown per page
+history_max_entries = int(os.environ.get("APP_HISTORY_MAX_ENTRIES", "100"))
+history_page_size = int(os.environ.get("APP_HISTORY_PAGE_SIZE", "10"))
 
 
 # Streamlit page configuration
 st.set_page_config(page_title="Call Multiple Models Agent", page_icon=":robot_face:", layout="wide")
 
+
+# One pool per server process: it ends agent sessions that go idle or don't fit
+@st.cache_resource
+def get_session_pool():
+    return agenthelper.AgentSessionPool()
+
+
+# Every browser session gets its own agent session; an ended one is replaced on the next run
+session_pool = get_session_pool()
+live_session_id = session_pool.session(st.session_state.get('agent_session_id'))
+st.session_state['agent_session_id'] = live_session_id
+
 # Function to crop image into a circle
 def crop_to_circle(image):
     mask = Image.new('L', image.size, 0)
@@ -21,6 +39,12 @@ def crop_to_circle(image):
     result.putalpha(mask)
     return result
 
+
+# Avatars are decoded and cropped once per server process and shared by every session
+@st.cache_resource
+def load_avatar(path):
+    return crop_to_circle(Image.open(path))
+
 # Title
 st.title("Multiple Models Agent")
 
@@ -30,16 +54,22 @@ engineering_prompt = engineering_prompt.strip()
 
 request_prompt = st.text_input("Please enter the request prompt: ", max_chars=10000)
 request_prompt = request_prompt.strip()
+if request_prompt:
+    # The Lambda trims or rejects prompts that don't fit the chosen model; show the size up front
+    prompt_tokens = token_budget.estimate_tokens(f"{request_prompt} - {engineering_prompt}")
+    st.caption(f"About {prompt_tokens} input tokens")
 
 # Display a primary button for submission
 submit_button = st.button("Submit", type="primary")
+timeout_seconds = st.number_input("Timeout (seconds): ", min_value=10, max_value=900,
+                                  value=int(agenthelper.http_read_timeout), step=10)
 
 # Create a file uploader widget
 #uploaded_file = st.file_uploader("", type=['jpg', 'jpeg', 'png'])
 
 # Check if a file has been uploaded
 # if uploaded_file is not None:
-#     result_message = agenthelper.upload_image_to_s3(uploaded_file)
+#     result_message = agenthelper.upload_image_to_s3(uploaded_file, live_session_id)
 #     st.write(result_message)
 
 #     # Display the uploaded image
@@ -52,69 +82,102 @@ submit_button = st.button("Submit", type="primary")
 
 
 # Sidebar for user input
+st.sidebar.metric("Active agent sessions", session_pool.active())
 st.sidebar.title("Trace Data")
+# "off" asks the agent for no trace at all; "summary" shows one line per trace step
+trace_level = st.sidebar.selectbox("Trace level", agenthelper.TRACE_LEVELS,
+                                   index=agenthelper.TRACE_LEVELS.index(agenthelper.default_trace_level))
 
 # Session State Management
 if 'history' not in st.session_state:
-    st.session_state['history'] = []
+    st.session_state['history'] = deque(maxlen=history_max_entries)
+    st.session_state['history_count'] = 0
 
 
+def add_to_history(question, answer):
+    """Appends a conversation entry with a stable ID, so widget keys survive paging and trimming."""
+    st.session_state['history_count'] += 1
+    st.session_state['history'].append({"id": st.session_state['history_count'], "question": question, "answer": answer})
+
+
+# Regular expression to find URLs
+url_pattern = re.compile(r'(https?://\S+)')
+
+
+# Entries are re-rendered on every rerun; format each text only once
+@functools.lru_cache(maxsize=1024)
 def format_link(text):
-    # Regular expression to find URLs
-    url_pattern = r'(https?://\S+)'
     # Replace URLs in the text with Markdown links using "link" as the display text
-    formatted_text = re.sub(url_pattern, r'[Click here](\1)', text)
+    formatted_text = url_pattern.sub(r'[Click here](\1)', text)
     return formatted_text
 
 
-# Function to parse and format response
-def format_response(response_body):
-    try:
-        # Try to load the response as JSON
-        data = json.loads(response_body)
-        # If it's a list, convert it to a DataFrame for better visualization
-        if isinstance(data, list):
-            return pd.DataFrame(data)
-        else:
-            return response_body
-    except json.JSONDecodeError:
-        # If response is not JSON, return as is
-        return response_body
-
 # Handling user input and responses
 if submit_button and request_prompt:
     # Concatenating engineering_prompt with request_prompt if provided
     combined_prompt = f"{request_prompt} - {engineering_prompt}" if engineering_prompt else request_prompt
-    
-    event = {
-        "sessionId": live_session_id,
-        "question": combined_prompt
-    }
-    
-    response = agenthelper.lambda_handler(event, None)
-    
-    try:
-        # Parse the JSON string
-        if response and 'body' in response and response['body']:
-            response_data = json.loads(response['body'])
-            print("TRACE & RESPONSE DATA ->  ", response_data)
-        else:
-            print("Invalid or empty response received")
-    except json.JSONDecodeError as e:
-        print("JSON decoding error:", e)
-        response_data = None 
-    
-    try:
-        # Extract the response and trace data
-        all_data = format_response(response_data['response'])
-        the_response = response_data['trace_data']
-    except:
-        all_data = "..." 
-        the_response = "Apologies, but an error occurred. Please rerun the application" 
-
-    # Use trace_data and formatted_response as needed
-    st.sidebar.text_area("", value=all_data, height=300)
-    st.session_state['history'].append({"question": combined_prompt, "answer": the_response})
+
+    # The session is now used, so the pool ends it on the agent when it expires
+    session_pool.touch(live_session_id)
+    # A new question replaces one that is still running
+    if 'agent_call' in st.session_state:
+        st.session_state['agent_call'].cancel()
+    # The agent runs on a background thread; this and later reruns render its events as they arrive
+    st.session_state['agent_call'] = agenthelper.AgentCall(
+        combined_prompt, agenthelper.get_agent_url(live_session_id), timeout=timeout_seconds, trace_level=trace_level
+    ).start()
+
+agent_call = st.session_state.get('agent_call')
+if agent_call is not None:
+    if agent_call.running and st.button("Cancel"):
+        agent_call.cancel()
+
+    trace_container = st.sidebar.container()
+
+    def answer_stream():
+        # Chunks go to the page and traces to the sidebar as the worker receives them.
+        # While nothing arrives an empty write lets Streamlit stop this run for a rerun (e.g. Cancel).
+        for event in agent_call.iter_events(poll_interval=0.5):
+            if event["type"] == "chunk":
+                yield event["text"]
+            elif event["type"] == "waiting":
+                yield ""
+            elif event["type"] == "trace" and agent_call.trace_level == "full":
+                trace_container.json(event["trace"], expanded=False)
+            elif event["type"] == "trace":
+                record = agenthelper.trace_record(event["trace"], (event["received"] - agent_call.started) * 1000)
+                trace_container.text(agenthelper.summarize_trace_record(record))
+
+    with st.chat_message("assistant"):
+        st.write_stream(answer_stream())
+
+    trace_text, the_response = agent_call.result()
+    print("TRACE & RESPONSE DATA ->  ", {"response": trace_text, "trace_data": the_response})
+    if agent_call.error is not None:
+        print("Agent call failed:", agent_call.error)
+        the_response = "Apologies, but an error occurred. Please rerun the application"
+    elif agent_call.canceled:
+        the_response = f"{the_response} ({agent_call.canceled})"
+        st.warning(agent_call.canceled)
+
+    if agent_call.first_event is not None:
+        st.caption(f"First event after {agent_call.first_event - agent_call.started:.2f}s")
+    if agent_call.trace_level != "off":
+        # Where the agent spent the request's time, one bar per stage
+        segments = agent_call.waterfall()
+        waterfall = pd.DataFrame(segments)
+        waterfall["end_ms"] = waterfall["start_ms"] + waterfall["duration_ms"]
+        waterfall["label"] = [f"{i:02d} {stage}" for i, stage in enumerate(waterfall["stage"])]
+        st.sidebar.write("#### Latency waterfall")
+        st.sidebar.altair_chart(alt.Chart(waterfall).mark_bar().encode(
+            x=alt.X("start_ms", title="ms"), x2="end_ms", y=alt.Y("label", title=None, sort=None),
+            color="stage", tooltip=["stage", "step", "name", "start_ms", "duration_ms"]
+        ), use_container_width=True)
+        st.sidebar.table(pd.Series(agenthelper.waterfall_totals(segments), name="ms"))
+    del st.session_state['agent_call']
+    # A long answer counts as activity, so the session isn't ended right after it
+    session_pool.touch(live_session_id)
+    add_to_history(agent_call.question, the_response)
     st.session_state['trace_data'] = the_response
 
 
@@ -124,17 +187,21 @@ submit_button2 = st.button("Delete Image", type="primary")
 # Display conversation history
 st.write("## Conversation History")
 
-# Load images outside the loop to optimize performance
-human_image = Image.open('images/human_face.png')
-robot_image = Image.open('images/robot_face.jpg')
-circular_human_image = crop_to_circle(human_image)
-circular_robot_image = crop_to_circle(robot_image)
+circular_human_image = load_avatar('images/human_face.png')
+circular_robot_image = load_avatar('images/robot_face.jpg')
 
-# Before displaying conversation history
+# Only the current page of the history is rendered, newest entries first
+page_count = max(1, -(-len(st.session_state['history']) // history_page_size))
+page = 1
+if page_count > 1:
+    page = st.number_input(f"Page (of {page_count})", min_value=1, max_value=page_count, value=1, step=1,
+                           key="history_page")
+start = (page - 1) * history_page_size
+page_entries = itertools.islice(reversed(st.session_state['history']), start, start + history_page_size)
 
-for index, chat in enumerate(reversed(st.session_state['history'])):
+for chat in page_entries:
+    index = chat["id"]
     formatted_question = format_link(chat["question"])
-    formatted_answer = format_link(chat["answer"])
     
     # Creating columns for Question
     col1_q, col2_q = st.columns([2, 10])
@@ -155,13 +222,13 @@ for index, chat in enumerate(reversed(st.session_state['history'])):
             st.image(circular_robot_image, width=150)
         with col2_a:
             # Directly use st.markdown to render the answer with clickable links
-            st.markdown(formatted_answer, unsafe_allow_html=True)
+            st.markdown(format_link(chat["answer"]), unsafe_allow_html=True)
 
 
 # Add a delete button
 if submit_button2:
-    # Call the delete function
-    agenthelper.delete_file_from_s3('bedrock-agent-images', image_name)
+    # Delete every image stored for this session
+    agenthelper.delete_session_images(agenthelper.bucket_name, live_session_id)
     st.success('Generated image deleted successfully.')
 
 # Example Prompts Section
@@ -274,34 +341,52 @@ image_generate_and_rate_prompt = [
 
 
 
+# The tables are built once per server process instead of on every rerun
+@st.cache_data
+def prompt_tables():
+    catalogs = {
+        "amazon": amazon_prompts,
+        "anthropic1": anthropic_prompts1,
+        "anthropic2": anthropic_prompts2,
+        "stability_ai": stability_ai_prompts,
+        "mistral": mistral_prompts,
+        "meta": meta_prompts,
+        "cohere": cohere_prompts,
+        "ai21labs": ai21labs_prompts,
+        "image_generate_and_rate": image_generate_and_rate_prompt,
+    }
+    return {name: pd.DataFrame(prompts) for name, prompts in catalogs.items()}
+
+
 # Displaying the prompts as tables
+tables = prompt_tables()
 
 st.write("### Amazon Models")
-st.table(amazon_prompts)
+st.table(tables["amazon"])
 
 st.write("### Anthropic Models")
 st.write("#### The anthropic prompts below are image-to-text inference calls, which will call the image-to-text anthropic function IF the the_image.png file is detected in the S3 bucket.")
-st.table(anthropic_prompts1)
+st.table(tables["anthropic1"])
 st.write("#### Remove the mypic.png image from the S3 bucket before running the anthropic prompts below. This will call the text anthropic function if the image is NOT detected in the S3 bucket. If not, the response may have descrepency.")
-st.table(anthropic_prompts2)
+st.table(tables["anthropic2"])
 
 st.write("### Stability AI Models")
-st.table(stability_ai_prompts)
+st.table(tables["stability_ai"])
 
 st.write("### Mistral Models")
-st.table(mistral_prompts)
+st.table(tables["mistral"])
 
 st.write("### Meta Models")
-st.table(meta_prompts)
+st.table(tables["meta"])
 
 st.write("### Cohere Models")
-st.table(cohere_prompts)
+st.table(tables["cohere"])
 
 st.write("### AI21labs Models")
-st.table(ai21labs_prompts)
+st.table(tables["ai21labs"])
 
 st.write("### Amazon & Claude Model")
-st.table(image_generate_and_rate_prompt)
+st.table(tables["image_generate_and_rate"])
 
 #st.write("### RAG")
 #st.table(knowledge_base_model_promt)
@@ -311,11 +396,8 @@ st.table(image_generate_and_rate_prompt)
 end_session_button = st.button("End Session")
 
 if end_session_button:
-    st.session_state['history'].append({"question": "Session Ended", "answer": "Thank you for using AnyCompany Support Agent!"})
-    event = {
-        "sessionId": live_session_id,
-        "question": "placeholder to end session",
-        "endSession": True
-    }
-    agenthelper.lambda_handler(event, None)
+    add_to_history("Session Ended", "Thank you for using AnyCompany Support Agent!")
+    # Ends the agent session and deletes its images; the next run starts a new session
+    session_pool.end(live_session_id)
+    del st.session_state['agent_session_id']
     st.session_state['history'].clear()
\ No newline at end of file
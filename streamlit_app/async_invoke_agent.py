@@ -0,0 +1,108 @@
+import asyncio
+import json
+
+import aiohttp
+from botocore.eventstream import EventStreamBuffer
+
+import invoke_agent as agenthelper
+
+# asyncio variant of the invoke_agent client for driving many agent sessions from one process.
+# Requests are signed with the same SigV4 helper and event frames are decoded with the same parser.
+
+
+class AsyncAgentClient:
+    """Sends agent questions concurrently over a shared aiohttp connection pool.
+
+    max_concurrency caps in-flight questions across all sessions; connection_limit caps open
+    connections. Use it as an async context manager so the connection pool is closed afterwards.
+    """
+    def __init__(self, max_concurrency=32, connection_limit=None, transport=None,
+                 connect_timeout=None, read_timeout=None):
+        self.max_concurrency = max_concurrency
+        self.connection_limit = connection_limit or max_concurrency
+        self.transport = transport or agenthelper.get_default_transport()
+        self.timeout = aiohttp.ClientTimeout(
+            sock_connect=connect_timeout or agenthelper.http_connect_timeout,
+            sock_read=read_timeout or agenthelper.http_read_timeout
+        )
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._http = None
+
+    async def __aenter__(self):
+        connector = aiohttp.TCPConnector(limit=self.connection_limit)
+        self._http = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self._http is not None:
+            await self._http.close()
+            self._http = None
+
+    async def _signed_request(self, url, body):
+        # Refreshing expired credentials makes a blocking STS call, so it runs off the event loop
+        credentials = await asyncio.to_thread(self.transport.get_credentials)
+        return agenthelper.sign_request(
+            url,
+            method='POST',
+            body=body,
+            headers=agenthelper.AGENT_REQUEST_HEADERS,
+            service='bedrock',
+            region=agenthelper.theRegion,
+            credentials=credentials
+        )
+
+    async def iter_events(self, question, sessionId, endSession=False, url=None, trace_level=None):
+        """Yields typed chunk and trace events for one question as the agent streams them."""
+        if self._http is None:
+            raise RuntimeError("AsyncAgentClient must be used inside 'async with'")
+
+        url = url or agenthelper.get_agent_url(sessionId)
+
+        async with self._semaphore:
+            # Signed once admitted, so a queued question's signature can't go stale while it waits
+            req = await self._signed_request(url, agenthelper.build_question_body(question, endSession, trace_level))
+            async with self._http.post(req.url, data=req.body, headers=dict(req.headers)) as response:
+                if response.status != 200:
+                    text = await response.text()
+                    raise agenthelper.AgentStreamError(f"Agent request failed with status {response.status}: {text}")
+
+                buffer = EventStreamBuffer()
+                async for data in response.content.iter_chunked(agenthelper.EVENT_STREAM_CHUNK_SIZE):
+                    buffer.add_data(data)
+                    for message in buffer:
+                        yield agenthelper.parse_event_message(message)
+
+    async def ask_question(self, question, sessionId, endSession=False, url=None, trace_level=None):
+        """Returns the (trace text, final response) pair, like invoke_agent.askQuestion."""
+        events = [event async for event in self.iter_events(question, sessionId, endSession, url, trace_level)]
+        return agenthelper.collect_response(events, trace_level)
+
+    async def ask_many(self, questions, return_exceptions=True):
+        """Asks (question, sessionId) pairs concurrently, bounded by max_concurrency."""
+        return await asyncio.gather(
+            *(self.ask_question(question, sessionId) for question, sessionId in questions),
+            return_exceptions=return_exceptions
+        )
+
+
+async def lambda_handler(event, context, client):
+    """asyncio counterpart of invoke_agent.lambda_handler using a shared AsyncAgentClient."""
+    sessionId = event["sessionId"]
+    question = event["question"]
+    endSession = str(event.get("endSession", False)).lower() == "true"
+
+    try:
+        response, trace_data = await client.ask_question(question, sessionId, endSession,
+                                                         trace_level=event.get("traceLevel"))
+        return {
+            "status_code": 200,
+            "body": json.dumps({"response": response, "trace_data": trace_data})
+        }
+    except Exception as e:
+        return {
+            "status_code": 500,
+            "body": json.dumps({"error": str(e)})
+        }
@@ -0,0 +1,146 @@
+"""Size-budgeted image preprocessing shared by the Lambda and the Streamlit upload path.
+
+Images are downsized to a maximum edge and pixel budget and optionally re-encoded
+(PNG, JPEG or WebP) before they are sent to a multimodal model. Results are cached
+by content hash, so the same image is only processed once per warm process.
+Pillow is imported only when an image actually has to be decoded.
+
+streamlit_app/image_preprocessing.py is a copy for the Streamlit client; keep the two files
+identical (benchmarks/shared_modules.py checks).
+"""
+import base64
+import hashlib
+import io
+import os
+import threading
+from collections import OrderedDict
+
+# Claude 3 resizes anything larger than ~1.15 megapixels or 1568 px on the long edge anyway,
+# so sending more only costs upload time and bytes
+max_edge = int(os.environ.get("BWB_IMAGE_MAX_EDGE", "1568"))
+max_pixels = int(os.environ.get("BWB_IMAGE_MAX_PIXELS", "1150000"))
+# "auto" keeps the source format, otherwise one of png, jpeg, webp
+output_format = os.environ.get("BWB_IMAGE_FORMAT", "auto").lower()
+output_quality = int(os.environ.get("BWB_IMAGE_QUALITY", "85"))
+cache_max_entries = int(os.environ.get("BWB_IMAGE_PREPROCESS_CACHE_ENTRIES", "32"))
+
+FORMATS = {"png": "PNG", "jpeg": "JPEG", "jpg": "JPEG", "webp": "WEBP"}
+MEDIA_TYPES = {"PNG": "image/png", "JPEG": "image/jpeg", "WEBP": "image/webp", "GIF": "image/gif"}
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def estimate_image_tokens(width, height):
+    """Anthropic's estimate of the input tokens an image costs: width * height / 750."""
+    return -(-width * height // 750)
+
+
+def fit_to_budget(width, height, edge_limit=None, pixel_limit=None):
+    """Returns the largest (width, height) with the same aspect ratio inside both limits."""
+    edge_limit = edge_limit or max_edge
+    pixel_limit = pixel_limit or max_pixels
+    scale = min(1.0, edge_limit / max(width, height), (pixel_limit / (width * height)) ** 0.5)
+    if scale >= 1.0:
+        return width, height
+    return max(1, int(width * scale)), max(1, int(height * scale))
+
+
+def get_resample_filter():
+    from PIL import Image
+    # Image.ANTIALIAS was removed in Pillow 10; LANCZOS is the same filter
+    return getattr(Image, "Resampling", Image).LANCZOS
+
+
+def _png_size(image_bytes):
+    if image_bytes[:8] == PNG_SIGNATURE and image_bytes[12:16] == b"IHDR":
+        return int.from_bytes(image_bytes[16:20], "big"), int.from_bytes(image_bytes[20:24], "big")
+    return None
+
+
+def _encode(image, image_format, quality):
+    if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+        # JPEG has no alpha channel; flatten onto white
+        from PIL import Image
+        rgba = image.convert("RGBA")
+        flattened = Image.new("RGB", rgba.size, (255, 255, 255))
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+        image = flattened
+    elif image.mode in ("CMYK", "YCbCr", "LAB", "HSV"):
+        image = image.convert("RGB")
+    buffer = io.BytesIO()
+    if image_format == "PNG":
+        image.save(buffer, format="PNG", optimize=False)
+    else:
+        image.save(buffer, format=image_format, quality=quality)
+    return buffer.getvalue()
+
+
+def _process(image_bytes, edge_limit, pixel_limit, target_format, quality):
+    size = _png_size(image_bytes)
+    if size and target_format in ("auto", "png") and fit_to_budget(*size, edge_limit, pixel_limit) == size:
+        # A PNG that is already inside the budget is passed through without decoding it
+        return image_bytes, "PNG", size, size
+
+    from PIL import Image
+    image = Image.open(io.BytesIO(image_bytes))
+    source_format = image.format or "PNG"
+    original_size = image.size
+    new_size = fit_to_budget(*original_size, edge_limit, pixel_limit)
+
+    if target_format == "auto":
+        image_format = source_format if source_format in MEDIA_TYPES else "PNG"
+    else:
+        image_format = FORMATS[target_format]
+
+    if new_size == original_size and image_format == source_format:
+        return image_bytes, image_format, original_size, original_size
+
+    if image_format == "GIF":
+        image_format = "PNG"
+    if new_size != original_size:
+        image = image.resize(new_size, get_resample_filter())
+    return _encode(image, image_format, quality), image_format, original_size, new_size
+
+
+def preprocess_image(image_bytes, edge_limit=None, pixel_limit=None, target_format=None, quality=None):
+    """
+    Downsizes and re-encodes an image for a multimodal request.
+
+    Returns a dict with the processed "bytes", their "base64", the "media_type", the
+    original and new sizes and byte counts, and the estimated input tokens before and after.
+    Results are cached by the SHA-256 of the input and the settings used.
+    """
+    edge_limit = edge_limit or max_edge
+    pixel_limit = pixel_limit or max_pixels
+    target_format = (target_format or output_format).lower()
+    quality = quality or output_quality
+    if target_format != "auto" and target_format not in FORMATS:
+        raise ValueError(f"Unsupported image format: {target_format}")
+
+    cache_key = (hashlib.sha256(image_bytes).hexdigest(), edge_limit, pixel_limit, target_format, quality)
+    with _cache_lock:
+        if cache_key in _cache:
+            _cache.move_to_end(cache_key)
+            return _cache[cache_key]
+
+    data, image_format, original_size, new_size = _process(image_bytes, edge_limit, pixel_limit, target_format, quality)
+    result = {
+        "bytes": data,
+        "base64": base64.b64encode(data).decode("utf-8"),
+        "media_type": MEDIA_TYPES[image_format],
+        "format": image_format,
+        "original_size": original_size,
+        "size": new_size,
+        "original_bytes": len(image_bytes),
+        "processed_bytes": len(data),
+        "original_tokens": estimate_image_tokens(*original_size),
+        "tokens": estimate_image_tokens(*new_size),
+    }
+
+    with _cache_lock:
+        _cache[cache_key] = result
+        while len(_cache) > cache_max_entries:
+            _cache.popitem(last=False)
+    return result
@@ -3,13 +3,22 @@ from boto3.session import Session
 from botocore.auth import SigV4Auth
 from botocore.awsrequest import AWSRequest
 from botocore.credentials import Credentials
+from botocore.eventstream import EventStreamBuffer
 import json
 import os
-from requests import request
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import base64
-import io
-import sys
-from PIL import Image
+import hashlib
+import threading
+import time
+import uuid
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+# A copy of the Lambda's image_preprocessing.py, kept next to the app
+import image_preprocessing
 
 #For this to run on a local machine in VScode, you need to set the AWS_PROFILE environment variable to the name of the profile/credentials you want to use. 
 #You also need to input your model ID near the bottom of this file.
@@ -25,7 +34,25 @@ agentAliasId = "xx" # Hits draft alias, set to a specific alias id for a deploye
 bucket_name = 'bedrock-agent-images'
 os.environ["AWS_REGION"] = "us-west-2"
 
-image_name = 'the_image.png'
+image_name = 'the_image.png'  # Shared legacy key, only used when no session ID is given
+
+# Bytes read from the agent response per iteration; frames are decoded as they complete
+EVENT_STREAM_CHUNK_SIZE = 64 * 1024
+
+# How much trace a question asks for: "off" (the agent sends none), "summary" (typed records
+# and a one-line summary per trace) or "full" (the records and the complete trace JSON)
+TRACE_LEVELS = ("off", "summary", "full")
+default_trace_level = os.environ.get("AGENT_TRACE_LEVEL", "full")
+
+# Connection pool, retry and timeout settings for the agent HTTP transport
+http_pool_size = int(os.environ.get("AGENT_HTTP_POOL_SIZE", "10"))
+http_retries = int(os.environ.get("AGENT_HTTP_RETRIES", "3"))
+http_connect_timeout = float(os.environ.get("AGENT_HTTP_CONNECT_TIMEOUT", "5"))
+http_read_timeout = float(os.environ.get("AGENT_HTTP_READ_TIMEOUT", "300"))
+
+# Agent sessions tracked by the client: at most this many at once, ended after this many idle seconds
+session_pool_size = int(os.environ.get("AGENT_SESSION_POOL_SIZE", "100"))
+session_idle_ttl = float(os.environ.get("AGENT_SESSION_IDLE_TTL", "1800"))
 
 
 theRegion = os.environ["AWS_REGION"]
@@ -33,6 +60,91 @@ region = os.environ.get("AWS_REGION")
 llm_response = ""
 s3 = boto3.client('s3')
 
+def sign_request(url, method='GET', body=None, params=None, headers=None, service='execute-api', region=None, credentials=None):
+    """Signs a request with SigV4 and returns the prepared request.
+    Credentials default to the current boto3 session's credentials, refreshed when they are about to expire.
+    """
+    region = region or os.environ['AWS_REGION']
+    credentials = credentials or get_default_transport().get_credentials()
+
+    req = AWSRequest(
+        method=method,
+        url=url,
+        data=body,
+        params=params,
+        headers=headers
+    )
+    SigV4Auth(credentials, service, region).add_auth(req)
+    return req.prepare()
+
+
+class SigV4Transport:
+    """Sends SigV4-signed requests over a persistent, pooled requests.Session.
+
+    Connections are kept alive across questions, and every request is signed with the
+    session's refreshable credentials, so long-running apps pick up rotated STS credentials.
+    """
+    def __init__(self, pool_size=None, retries=None, connect_timeout=None, read_timeout=None, session=None):
+        pool_size = pool_size or http_pool_size
+        retries = http_retries if retries is None else retries
+        self.timeout = (connect_timeout or http_connect_timeout, read_timeout or http_read_timeout)
+        self.boto_session = session or Session()
+
+        # Throttling and service-unavailable responses, and connections that couldn't be
+        # opened, are retried with exponential backoff. The POST isn't idempotent (the agent
+        # may already be answering it), so errors after the request went out are never retried.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=0,
+            other=0,
+            backoff_factor=0.5,
+            status_forcelist=(429, 503),
+            allowed_methods=None,
+            raise_on_status=False
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+        self.http = requests.Session()
+        self.http.mount('https://', adapter)
+        self.http.mount('http://', adapter)
+
+    def get_credentials(self):
+        """Returns frozen credentials; refreshable credentials renew themselves before expiring."""
+        credentials = self.boto_session.get_credentials()
+        if credentials is None:
+            raise RuntimeError("No AWS credentials found for signing the agent request")
+        return credentials.get_frozen_credentials()
+
+    def request(self, url, method='GET', body=None, params=None, headers=None, service='execute-api',
+                region=None, credentials=None, stream=False):
+        req = sign_request(url, method, body, params, headers, service, region, credentials or self.get_credentials())
+        return self.http.request(
+            method=req.method,
+            url=req.url,
+            headers=req.headers,
+            data=req.body,
+            timeout=self.timeout,
+            stream=stream
+        )
+
+    def close(self):
+        self.http.close()
+
+
+_default_transport = None
+_default_transport_lock = threading.Lock()
+
+
+def get_default_transport():
+    """Returns the process-wide transport, creating it on first use."""
+    global _default_transport
+    if _default_transport is None:
+        with _default_transport_lock:
+            if _default_transport is None:
+                _default_transport = SigV4Transport()
+    return _default_transport
+
+
 def sigv4_request(
     url,
     method='GET',
@@ -40,8 +152,10 @@ def sigv4_request(
     params=None,
     headers=None,
     service='execute-api',
-    region=os.environ['AWS_REGION'],
-    credentials=Session().get_credentials().get_frozen_credentials()
+    region=None,
+    credentials=None,
+    transport=None,
+    stream=False
 ):
     """Sends an HTTP request signed with SigV4
     Args:
@@ -52,96 +166,223 @@ def sigv4_request(
     headers: The request headers (e.g. { 'content-type': 'application/json' }). Defaults to None.
     service: The AWS service name. Defaults to 'execute-api'.
     region: The AWS region id. Defaults to the env var 'AWS_REGION'.
-    credentials: The AWS credentials. Defaults to the current boto3 session's credentials.
+    credentials: The AWS credentials. Defaults to the current boto3 session's credentials, refreshed on every call.
+    transport: The SigV4Transport to send with. Defaults to the shared pooled transport.
+    stream: Whether to stream the response body instead of reading it up front. Defaults to False.
     Returns:
      The HTTP response
     """
+    transport = transport or get_default_transport()
+    return transport.request(url, method, body, params, headers, service, region, credentials, stream)
 
-    # sign request
-    req = AWSRequest(
-        method=method,
-        url=url,
-        data=body,
-        params=params,
-        headers=headers
-    )
-    SigV4Auth(credentials, service, region).add_auth(req)
-    req = req.prepare()
+# Headers for InvokeAgent requests, shared by the sync and asyncio clients
+AGENT_REQUEST_HEADERS = {
+    'content-type': 'application/json',
+    'accept': 'application/json',
+}
+
+
+def get_agent_url(sessionId):
+    return f'https://bedrock-agent-runtime.{theRegion}.amazonaws.com/agents/{agentId}/agentAliases/{agentAliasId}/sessions/{sessionId}/text'
 
-    # send request
-    return request(
-        method=req.method,
-        url=req.url,
-        headers=req.headers,
-        data=req.body
-    )
 
-def askQuestion(question, url, endSession=False):
+def build_question_body(question, endSession=False, trace_level=None):
     myobj = {
-        "inputText": question,   
-        "enableTrace": True,
+        "inputText": question,
+        "enableTrace": (trace_level or default_trace_level) != "off",
         "endSession": endSession
     }
-    
+    return json.dumps(myobj)
+
+
+def askQuestion(question, url, endSession=False, trace_level=None):
     # send request
     response = sigv4_request(
         url,
         method='POST',
         service='bedrock',
-        headers={
-            'content-type': 'application/json', 
-            'accept': 'application/json',
-        },
+        headers=AGENT_REQUEST_HEADERS,
         region=theRegion,
-        body=json.dumps(myobj)
-    ) 
-    return decode_response(response)
+        body=build_question_body(question, endSession, trace_level),
+        stream=True
+    )
+    try:
+        return decode_response(response, trace_level)
+    finally:
+        # Return the connection to the pool for the next question
+        response.close()
 
 
-def delete_file_from_s3(bucket_name, object_name):
+def stream_question(question, url, endSession=False, trace_level=None):
+    """Yields typed chunk and trace events for one question as the agent streams them."""
+    response = sigv4_request(
+        url,
+        method='POST',
+        service='bedrock',
+        headers=AGENT_REQUEST_HEADERS,
+        region=theRegion,
+        body=build_question_body(question, endSession, trace_level),
+        stream=True
+    )
     try:
-        s3.delete_object(Bucket=bucket_name, Key=object_name)
-        print(f"File {object_name} deleted successfully from bucket {bucket_name}.")
+        yield from iter_response_events(response)
+    finally:
+        response.close()
+
+
+class AgentCall:
+    """Asks one question on a background thread and buffers its events for the UI.
+
+    The UI reads them with iter_events() while the worker is still receiving, so the first
+    chunk can be shown as soon as it arrives. Every buffered event is replayed to each new
+    reader, so a Streamlit rerun can pick up a call that is still running. cancel() and the
+    timeout stop the readers at once; the worker drops the connection at its next event.
+    """
+    def __init__(self, question, url, endSession=False, timeout=None, trace_level=None):
+        self.question = question
+        self.url = url
+        self.endSession = endSession
+        self.timeout = timeout
+        self.trace_level = trace_level or default_trace_level
+        self.events = []
+        self.error = None
+        self.canceled = None
+        self.done = False
+        self.started = None
+        self.first_event = None
+        self.finished = None
+        self._condition = threading.Condition()
+        self._timer = None
+
+    def start(self):
+        self.started = time.monotonic()
+        threading.Thread(target=self._run, daemon=True).start()
+        if self.timeout:
+            self._timer = threading.Timer(self.timeout, self.cancel, args=(f"Timed out after {self.timeout:g} seconds",))
+            self._timer.daemon = True
+            self._timer.start()
+        return self
+
+    def _run(self):
+        try:
+            for event in stream_question(self.question, self.url, self.endSession, self.trace_level):
+                with self._condition:
+                    if self.canceled:
+                        break
+                    if self.first_event is None:
+                        self.first_event = time.monotonic()
+                    self.events.append(event)
+                    self._condition.notify_all()
+        except Exception as e:
+            self.error = e
+        finally:
+            with self._condition:
+                self.done = True
+                self.finished = time.monotonic()
+                self._condition.notify_all()
+            if self._timer is not None:
+                self._timer.cancel()
+
+    def cancel(self, reason="Canceled"):
+        with self._condition:
+            if not self.done and self.canceled is None:
+                self.canceled = reason
+            self._condition.notify_all()
+
+    @property
+    def running(self):
+        return not self.done and self.canceled is None
+
+    def iter_events(self, poll_interval=None):
+        """
+        Yields every event received so far, then new ones until the call ends or is canceled.
+        With poll_interval, a {"type": "waiting"} event is yielded whenever nothing arrived
+        for that many seconds, so the reader gets a chance to notice its own interruption.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: index < len(self.events) or not self.running, poll_interval)
+                pending = self.events[index:]
+                finished = not self.running
+            if not pending and not finished:
+                yield {"type": "waiting"}
+            yield from pending
+            index += len(pending)
+            if finished and index >= len(self.events):
+                return
+
+    def result(self):
+        """Returns the (trace text, final response) pair of the events received so far."""
+        with self._condition:
+            events = list(self.events)
+        return collect_response(events, self.trace_level)
+
+    def waterfall(self):
+        """Returns the latency waterfall of the call from its trace records."""
+        with self._condition:
+            events = list(self.events)
+            finished = self.finished or time.monotonic()
+        return trace_waterfall(trace_records(events, self.started), (finished - self.started) * 1000)
+
+
+# Session image keys; these must match the layout in lambda_function.py
+def session_prefix(session_id):
+    return f"sessions/{session_id}/"
+
+
+def session_image_key(session_id, image_bytes):
+    return f"{session_prefix(session_id)}images/{hashlib.sha256(image_bytes).hexdigest()}.png"
+
+
+def session_pointer_key(session_id):
+    return f"{session_prefix(session_id)}current.json"
+
+
+def delete_session_images(bucket_name, session_id):
+    """
+    Deletes every image and the current-image pointer stored for an agent session. Sessions this
+    process never ends (e.g. after a restart) are left to the bucket's lifecycle rule in
+    s3-lifecycle.json, which expires the sessions/ prefix after 7 days.
+    """
+    deleted = 0
+    try:
+        paginator = s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket_name, Prefix=session_prefix(session_id)):
+            keys = [{'Key': item['Key']} for item in page.get('Contents', [])]
+            if keys:
+                s3.delete_objects(Bucket=bucket_name, Delete={'Objects': keys, 'Quiet': True})
+                deleted += len(keys)
+        print(f"Deleted {deleted} objects for session {session_id} from bucket {bucket_name}.")
     except Exception as e:
-        print(f"Error deleting file {object_name} from bucket {bucket_name}: {str(e)}")
+        print(f"Error deleting images of session {session_id} from bucket {bucket_name}: {str(e)}")
+    return deleted
 
 
 
-def resize_image(image):
+def resize_image(image_bytes, max_edge=None):
     """
-    Resize the image to a width of 300 pixels while maintaining aspect ratio.
+    Downsize an image to the shared preprocessing budget, keeping its aspect ratio.
     
     Parameters:
-    - image: PIL Image object.
+    - image_bytes: The encoded image (PNG, JPEG, ...).
+    - max_edge: Optional longest-edge limit in pixels.
     
     Returns:
-    A byte array of the resized image.
+    A byte array of the resized PNG image.
     """
-    # Desired width
-    target_width = 300
-
-    # Calculate the new height to maintain aspect ratio
-    original_width, original_height = image.size
-    aspect_ratio = original_height / original_width
-    new_height = int(target_width * aspect_ratio)
+    return image_preprocessing.preprocess_image(image_bytes, edge_limit=max_edge, target_format="png")["bytes"]
 
-    # Resize the image
-    resized_image = image.resize((target_width, new_height), Image.ANTIALIAS)
 
-    # Convert the resized image to a byte array
-    img_byte_arr = io.BytesIO()
-    resized_image.save(img_byte_arr, format='PNG')
-    
-    return img_byte_arr.getvalue()
-
-
-def upload_image_to_s3(uploaded_file):
+def upload_image_to_s3(uploaded_file, session_id=None):
     """
     Converts uploaded image to PNG format and uploads to an S3 bucket.
+    With a session ID the image is stored under its content-addressed session key
+    and becomes the session's current input image.
     
     Parameters:
     - uploaded_file: The uploaded file object from Streamlit.
-    - bucket_name: The name of the S3 bucket.
+    - session_id: The agent session the image belongs to.
     
     Returns:
     A success message if upload succeeds, otherwise an error message.
@@ -157,101 +398,228 @@ def upload_image_to_s3(uploaded_file):
         return "File must be jpg, jpeg, or png."
 
     try:
-        # Convert uploaded file to PIL Image then resize
-        image = Image.open(uploaded_file)
-
-        # Convert image to PNG byte array
-        img_byte_arr = io.BytesIO()
-
-        image.save(img_byte_arr, format='PNG')
-        img_byte_arr = img_byte_arr.getvalue()
-        #img_byte_arr = resize_image(img_byte_arr)
-
-        # Upload the PNG byte array to S3
-        s3_client.put_object(Body=img_byte_arr, Bucket=bucket_name, Key=image_name)
-
-        return "Image successfully uploaded to S3 as 'image.png'."
+        # Convert the upload to a PNG byte array, downsized to the preprocessing budget
+        img_byte_arr = resize_image(uploaded_file.getvalue())
+
+        if not session_id:
+            # Upload the PNG byte array to S3
+            s3_client.put_object(Body=img_byte_arr, Bucket=bucket_name, Key=image_name)
+            return f"Image successfully uploaded to S3 as '{image_name}'."
+
+        key = session_image_key(session_id, img_byte_arr)
+        s3_client.put_object(Body=img_byte_arr, Bucket=bucket_name, Key=key, ContentType='image/png')
+        s3_client.put_object(Body=json.dumps({"key": key}).encode('utf-8'), Bucket=bucket_name,
+                             Key=session_pointer_key(session_id), ContentType='application/json')
+        return f"Image successfully uploaded to S3 as '{key}'."
     except Exception as e:
         # Handle exceptions
         print(e)
         return "Failed to upload the image to S3."
     
     
-def decode_response(response):
-    # Create a StringIO object to capture print statements
-    captured_output = io.StringIO()
-    sys.stdout = captured_output
-
-    # Your existing logic
-    string = ""
-    for line in response.iter_content():
-        try:
-            string += line.decode(encoding='utf-8')
-        except:
-            continue
+class AgentStreamError(Exception):
+    """Raised when the agent returns an error status or an exception event."""
 
-    print("Decoded response", string)
-    split_response = string.split(":message-type")
-    print(f"Split Response: {split_response}")
-    print(f"length of split: {len(split_response)}")
-
-    for idx in range(len(split_response)):
-        if "bytes" in split_response[idx]:
-            #print(f"Bytes found index {idx}")
-            encoded_last_response = split_response[idx].split("\"")[3]
-            decoded = base64.b64decode(encoded_last_response)
-            final_response = decoded.decode('utf-8')
-            print(final_response)
-        else:
-            print(f"no bytes at index {idx}")
-            print(split_response[idx])
-            
-    last_response = split_response[-1]
-    print(f"Lst Response: {last_response}")
-    if "bytes" in last_response:
-        print("Bytes in last response")
-        encoded_last_response = last_response.split("\"")[3]
-        decoded = base64.b64decode(encoded_last_response)
-        final_response = decoded.decode('utf-8')
+
+def parse_event_message(message):
+    """Converts one event-stream message into a typed agent event dict."""
+    headers = message.headers
+    payload = json.loads(message.payload) if message.payload else {}
+
+    if headers.get(':message-type') == 'exception':
+        error_type = headers.get(':exception-type', 'exception')
+        raise AgentStreamError(f"{error_type}: {payload.get('message', payload)}")
+
+    # Frames carry no timestamp of their own; the receive time stands in for it
+    event_type = headers.get(':event-type')
+    if event_type == 'chunk':
+        return {"type": "chunk", "text": base64.b64decode(payload.get("bytes", "")).decode('utf-8'), "received": time.monotonic()}
+    elif event_type == 'trace':
+        return {"type": "trace", "trace": payload.get("trace", payload), "received": time.monotonic()}
     else:
-        print("no bytes in last response")
-        part1 = string[string.find('finalResponse')+len('finalResponse":'):] 
-        part2 = part1[:part1.find('"}')+2]
-        final_response = json.loads(part2)['text']
+        return {"type": event_type, "payload": payload, "received": time.monotonic()}
+
+
+def iter_response_events(response, chunk_size=EVENT_STREAM_CHUNK_SIZE):
+    """
+    Yields typed chunk and trace events from an InvokeAgent event-stream response as frames arrive.
+    Frames are parsed incrementally by botocore's EventStreamBuffer, which validates the prelude
+    and message CRCs of every frame.
+    """
+    if response.status_code != 200:
+        raise AgentStreamError(f"Agent request failed with status {response.status_code}: {response.text}")
+
+    buffer = EventStreamBuffer()
+    for data in response.iter_content(chunk_size=chunk_size):
+        buffer.add_data(data)
+        for message in buffer:
+            yield parse_event_message(message)
+
+
+def get_final_response_from_trace(trace):
+    """Returns the final response text recorded in an orchestration trace, if any."""
+    observation = trace.get("orchestrationTrace", {}).get("observation", {})
+    return observation.get("finalResponse", {}).get("text")
+
+
+def trace_record(trace, at_ms=None):
+    """
+    Converts one trace into a typed record dict: kind (pre_processing, model_invocation,
+    model_output, rationale, action_group, knowledge_base, observation, final_response,
+    post_processing, guardrail or failure), step (the orchestration step's trace ID), name
+    (the action group and API path, or knowledge base ID) and at_ms (when it arrived).
+    """
+    record = {"kind": "other", "step": None, "name": None, "at_ms": at_ms}
+    for section, body in trace.items():
+        if not isinstance(body, dict):
+            continue
+        if section == "orchestrationTrace":
+            if "modelInvocationInput" in body:
+                record.update(kind="model_invocation", step=body["modelInvocationInput"].get("traceId"))
+            elif "modelInvocationOutput" in body:
+                record.update(kind="model_output", step=body["modelInvocationOutput"].get("traceId"))
+            elif "rationale" in body:
+                record.update(kind="rationale", step=body["rationale"].get("traceId"))
+            elif "invocationInput" in body:
+                invocation = body["invocationInput"]
+                record["step"] = invocation.get("traceId")
+                if "knowledgeBaseLookupInput" in invocation:
+                    record.update(kind="knowledge_base", name=invocation["knowledgeBaseLookupInput"].get("knowledgeBaseId"))
+                else:
+                    action = invocation.get("actionGroupInvocationInput", {})
+                    name = " ".join(filter(None, (action.get("actionGroupName"), action.get("apiPath") or action.get("function"))))
+                    record.update(kind="action_group", name=name or invocation.get("invocationType"))
+            elif "observation" in body:
+                observation = body["observation"]
+                kind = "final_response" if "finalResponse" in observation else "observation"
+                record.update(kind=kind, step=observation.get("traceId"), name=observation.get("type"))
+        elif section == "preProcessingTrace":
+            record["kind"] = "pre_processing"
+        elif section == "postProcessingTrace":
+            record["kind"] = "post_processing"
+        elif section == "guardrailTrace":
+            record["kind"] = "guardrail"
+        elif section == "failureTrace":
+            record.update(kind="failure", name=body.get("failureReason"))
+        else:
+            continue
+        break
+    return record
+
+
+def trace_records(events, started=None):
+    """Typed records of the trace events, timed in milliseconds from started (a time.monotonic())."""
+    records = []
+    for event in events:
+        if event["type"] == "trace":
+            received = event.get("received")
+            at_ms = round((received - started) * 1000, 2) if started is not None and received is not None else None
+            records.append(trace_record(event["trace"], at_ms))
+    return records
+
+
+# Waterfall stage of the time between a record of this kind and the next record
+WATERFALL_STAGES = {
+    "pre_processing": "pre_processing",
+    "model_invocation": "model",
+    "model_output": "orchestration",
+    "rationale": "orchestration",
+    "action_group": "action_group",
+    "knowledge_base": "knowledge_base",
+    "observation": "model",
+    "final_response": "response",
+    "post_processing": "post_processing",
+}
+
+
+def trace_waterfall(records, total_ms):
+    """
+    Splits a request's time into consecutive stages from its timed trace records: the wait for
+    the first trace, model time, action group calls, knowledge base lookups, and the answer after
+    the last trace. Returns [{"stage", "step", "name", "start_ms", "duration_ms"}] in order.
+    """
+    timed = [record for record in records if record["at_ms"] is not None]
+    segments = []
+    start, stage, step, name = 0.0, "request", None, None
+    for record in timed + [{"kind": "end", "at_ms": total_ms, "step": None, "name": None}]:
+        end = min(max(record["at_ms"], start), total_ms)
+        if segments and segments[-1]["stage"] == stage and segments[-1]["step"] == step:
+            segments[-1]["duration_ms"] = round(end - segments[-1]["start_ms"], 2)
+        elif end > start or stage == "request":
+            segments.append({"stage": stage, "step": step, "name": name, "start_ms": round(start, 2),
+                             "duration_ms": round(end - start, 2)})
+        start = end
+        stage = WATERFALL_STAGES.get(record["kind"], stage)
+        step = record["step"] or step
+        name = record["name"] if record["kind"] in ("action_group", "knowledge_base") else None
+    return segments
+
+
+def waterfall_totals(segments):
+    """Milliseconds per stage across a waterfall."""
+    totals = {}
+    for segment in segments:
+        totals[segment["stage"]] = round(totals.get(segment["stage"], 0) + segment["duration_ms"], 2)
+    return totals
+
+
+def summarize_trace_record(record):
+    """One line describing a typed trace record."""
+    at = f"{record['at_ms']:>8.1f}ms " if record["at_ms"] is not None else ""
+    return f"{at}{record['kind']}" + (f" {record['name']}" if record["name"] else "") + (f" [{record['step']}]" if record["step"] else "")
+
+
+def decode_response(response, trace_level=None):
+    return collect_response(iter_response_events(response), trace_level)
+
+
+def collect_response(events, trace_level=None):
+    """
+    Builds the (trace text, final response) pair from typed agent events. The trace text is
+    the complete trace JSON at the "full" trace level, one line per trace at "summary" and
+    empty at "off".
+    """
+    trace_level = trace_level or default_trace_level
+    trace_lines = []
+    chunks = []
+    trace_final_response = None
+
+    for event in events:
+        if event["type"] == "chunk":
+            chunks.append(event["text"])
+        elif event["type"] == "trace":
+            if trace_level == "full":
+                trace_lines.append(json.dumps(event["trace"], indent=2))
+            elif trace_level == "summary":
+                trace_lines.append(summarize_trace_record(trace_record(event["trace"])))
+            trace_final_response = get_final_response_from_trace(event["trace"]) or trace_final_response
+
+    # The answer arrives in chunk events; fall back to the final response in the trace
+    final_response = "".join(chunks) if chunks else (trace_final_response or "")
 
     final_response = final_response.replace("\"", "")
     final_response = final_response.replace("{input:{value:", "")
     final_response = final_response.replace(",source:null}}", "")
     llm_response = final_response
 
-    # Restore original stdout
-    sys.stdout = sys.__stdout__
-
-    # Get the string from captured output
-    captured_string = captured_output.getvalue()
-
-    # Return both the captured output and the final response
-    return captured_string, llm_response
+    # Return both the trace output and the final response
+    return "\n".join(trace_lines), llm_response
 
 
 def lambda_handler(event, context):
     sessionId = event["sessionId"]
     question = event["question"]
-    endSession = False
+    # Callers pass a bool or the string "true"
+    endSession = str(event.get("endSession", False)).lower() == "true"
+    trace_level = event.get("traceLevel")
     
     print(f"Session: {sessionId} asked question: {question}")
     
-    try:
-        if (event["endSession"] == "true"):
-            endSession = True
-    except:
-        endSession = False
-    
-    url = f'https://bedrock-agent-runtime.{theRegion}.amazonaws.com/agents/{agentId}/agentAliases/{agentAliasId}/sessions/{sessionId}/text'
+    url = get_agent_url(sessionId)
 
     
     try: 
-        response, trace_data = askQuestion(question, url, endSession)
+        response, trace_data = askQuestion(question, url, endSession, trace_level)
 
         return {
             "status_code": 200,
@@ -265,3 +633,117 @@ def lambda_handler(event, context):
         }
 
 
+def end_agent_session(session_id):
+    """Ends an agent session on the service and deletes the images stored for it."""
+    lambda_handler({"sessionId": session_id, "question": "placeholder to end session", "endSession": True,
+                    "traceLevel": "off"}, None)
+    delete_session_images(bucket_name, session_id)
+
+
+class AgentSessionPool:
+    """Hands out one agent session ID per user and ends the sessions nobody uses any more.
+
+    Sessions are kept in least-recently-used order. A session idle for idle_ttl seconds is
+    ended by a background reaper, and when max_sessions are active the least recently used
+    one is ended to make room. Sessions are ended on a small worker pool, off the caller's thread.
+    A session only becomes "used" once touch() is called for it (a question was sent); ending
+    an unused one just forgets it, without an endSession call to the agent.
+    """
+    def __init__(self, max_sessions=None, idle_ttl=None, end_session=end_agent_session):
+        self.max_sessions = max_sessions or session_pool_size
+        self.idle_ttl = idle_ttl or session_idle_ttl
+        self.end_session = end_session
+        self.metrics = Counter()
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+        self._closing = ThreadPoolExecutor(max_workers=2, thread_name_prefix="agent-session-end")
+        self._reaper = threading.Thread(target=self._reap_forever, daemon=True)
+        self._reaper.start()
+
+    def session(self, session_id=None):
+        """
+        Returns session_id after marking it used, or a new session ID when session_id is
+        None or was already ended.
+        """
+        # Each session maps to (last used time, whether a question was sent in it)
+        with self._lock:
+            if session_id in self._sessions:
+                self._sessions[session_id] = (time.monotonic(), self._sessions[session_id][1])
+                self._sessions.move_to_end(session_id)
+                return session_id
+            session_id = str(uuid.uuid4())
+            self._sessions[session_id] = (time.monotonic(), False)
+            self.metrics["created"] += 1
+            while len(self._sessions) > self.max_sessions:
+                evicted, (_, used) = self._sessions.popitem(last=False)
+                self.metrics["evicted"] += 1
+                self._retire(evicted, used)
+            return session_id
+
+    def touch(self, session_id):
+        """Marks a session as used (a question was sent); returns False when it is no longer active."""
+        with self._lock:
+            if session_id not in self._sessions:
+                return False
+            self._sessions[session_id] = (time.monotonic(), True)
+            self._sessions.move_to_end(session_id)
+            return True
+
+    def end(self, session_id, wait=True):
+        """Ends a session now, e.g. when its user presses End Session."""
+        with self._lock:
+            entry = self._sessions.pop(session_id, None)
+            if entry is None:
+                return
+            self.metrics["ended"] += 1
+            future = self._retire(session_id, entry[1])
+        if wait and future is not None:
+            future.result()
+
+    def _retire(self, session_id, used):
+        """
+        Ends a used session on the worker pool; an unused one has nothing to end on the service.
+        Called with the lock held.
+        """
+        if not used:
+            self.metrics["dropped_unused"] += 1
+            return None
+        return self._closing.submit(self._end, session_id)
+
+    def reap(self):
+        """Ends every session idle for longer than idle_ttl; returns how many."""
+        cutoff = time.monotonic() - self.idle_ttl
+        expired = []
+        with self._lock:
+            # Oldest first, so stop at the first session used after the cutoff
+            for session_id, (last_used, used) in self._sessions.items():
+                if last_used > cutoff:
+                    break
+                expired.append((session_id, used))
+            for session_id, _ in expired:
+                del self._sessions[session_id]
+            self.metrics["expired"] += len(expired)
+            for session_id, used in expired:
+                self._retire(session_id, used)
+        return len(expired)
+
+    def _reap_forever(self):
+        while True:
+            time.sleep(min(60.0, self.idle_ttl / 2))
+            self.reap()
+
+    def _end(self, session_id):
+        try:
+            self.end_session(session_id)
+        except Exception as e:
+            self.metrics["end_errors"] += 1
+            print(f"Error ending agent session {session_id}: {str(e)}")
+
+    def active(self):
+        with self._lock:
+            return len(self._sessions)
+
+    def stats(self):
+        """Returns the active session count and the created/ended/expired/evicted/dropped_unused counters."""
+        with self._lock:
+            return dict(self.metrics, active=len(self._sessions))
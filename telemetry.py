@@ -0,0 +1,163 @@
+"""Per-invocation timing spans and counters, emitted as one CloudWatch EMF record.
+
+lambda_handler starts an invocation record; code anywhere below it wraps a stage in
+span("name"), adds token and byte counts with count() and records levels with gauge(). Worker threads that run in a
+copy of the invocation's context (contextvars.copy_context) add to the same record.
+emit() prints the record as a single JSON line in the embedded metric format, so
+CloudWatch turns the stage totals and counters into metrics without extra API calls.
+Outside an invocation (benchmarks, scripts) every call here is a no-op.
+"""
+import contextvars
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+_current = contextvars.ContextVar("telemetry", default=None)
+
+
+class InvocationTelemetry:
+    """Spans, counters and properties of one invocation."""
+    def __init__(self, namespace, dimensions=None):
+        self.namespace = namespace
+        self.dimensions = dict(dimensions or {})
+        self.properties = {}
+        self.spans = []
+        self.counters = defaultdict(int)
+        self.started = time.perf_counter()
+        self.timestamp = int(time.time() * 1000)
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, end):
+        with self._lock:
+            self.spans.append((name, round((start - self.started) * 1000, 2), round((end - start) * 1000, 2)))
+
+    def count(self, name, value):
+        with self._lock:
+            self.counters[name] += value
+
+    def gauge(self, name, value):
+        with self._lock:
+            self.counters[name] = value
+
+    def record(self):
+        """Builds the EMF record: stage totals in milliseconds and counters as metrics, spans as a property."""
+        with self._lock:
+            stages = defaultdict(float)
+            for name, _, duration in self.spans:
+                stages[f"{name}_ms"] += duration
+            metrics = {name: round(total, 2) for name, total in stages.items()}
+            metrics["total_ms"] = round((time.perf_counter() - self.started) * 1000, 2)
+            metrics.update(self.counters)
+            spans = [{"name": name, "start_ms": start, "duration_ms": duration} for name, start, duration in self.spans]
+
+        dimension_names = list(self.dimensions)
+        record = {
+            "_aws": {
+                "Timestamp": self.timestamp,
+                "CloudWatchMetrics": [{
+                    "Namespace": self.namespace,
+                    "Dimensions": [dimension_names[:1], dimension_names] if len(dimension_names) > 1 else [dimension_names],
+                    "Metrics": [{"Name": name, "Unit": metric_unit(name)} for name in metrics],
+                }],
+            },
+        }
+        record.update(self.dimensions)
+        record.update(self.properties)
+        record.update(metrics)
+        record["spans"] = spans
+        return record
+
+
+def metric_unit(name):
+    if name.endswith("_ms"):
+        return "Milliseconds"
+    if name.endswith("_bytes"):
+        return "Bytes"
+    return "Count"
+
+
+def start_invocation(namespace, **dimensions):
+    """Starts the record of an invocation; returns (record, token for end_invocation)."""
+    record = InvocationTelemetry(namespace, dimensions)
+    return record, _current.set(record)
+
+
+def end_invocation(token):
+    _current.reset(token)
+
+
+def current():
+    return _current.get()
+
+
+def set_dimension(name, value):
+    record = _current.get()
+    if record is not None:
+        record.dimensions[name] = value
+
+
+def set_property(name, value):
+    record = _current.get()
+    if record is not None:
+        record.properties[name] = value
+
+
+def count(name, value=1):
+    record = _current.get()
+    if record is not None and value:
+        record.count(name, value)
+
+
+def gauge(name, value):
+    """Records the latest value of a level (a limit, a cache size) rather than adding to it."""
+    record = _current.get()
+    if record is not None:
+        record.gauge(name, value)
+
+
+@contextmanager
+def span(name):
+    """Times the enclosed block as one span of the current invocation."""
+    record = _current.get()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if record is not None:
+            record.add_span(name, start, time.perf_counter())
+
+
+def emit(record):
+    """Prints the record as one EMF JSON line."""
+    print(json.dumps(record.record(), default=str))
+
+
+def summarize_payload(payload, max_string=200, max_chars=2000):
+    """
+    Returns a loggable rendering of a payload: strings longer than max_string (base64 images,
+    long prompts) are cut to a prefix and their length, and the whole text to max_chars.
+    """
+    def shorten(value):
+        if isinstance(value, str) and len(value) > max_string:
+            return f"{value[:max_string]}...<{len(value)} chars>"
+        if isinstance(value, (bytes, bytearray)):
+            return f"<{len(value)} bytes>"
+        if isinstance(value, dict):
+            return {key: shorten(item) for key, item in value.items()}
+        if isinstance(value, (list, tuple)):
+            return [shorten(item) for item in value]
+        return value
+
+    text = json.dumps(shorten(payload), default=str)
+    if len(text) > max_chars:
+        text = f"{text[:max_chars]}...<{len(text)} chars>"
+    return text
+
+
+def log_payload(label, payload, sample_rate=1.0, max_string=200, max_chars=2000):
+    """Prints a summarized payload for a sample_rate fraction of calls."""
+    if sample_rate >= 1.0 or random.random() < sample_rate:
+        print(f"{label}: {summarize_payload(payload, max_string, max_chars)}")
@@ -0,0 +1,154 @@
+"""Local token estimates and per-model prompt budgets for Bedrock text calls.
+
+Input tokens are estimated without a tokenizer: the prompt is split into letter runs, digit
+runs and single symbols, and each run is costed with its provider family's rough letters and
+digits per token. Estimates are deliberately on the high side; the EMF record carries them
+next to the counts Bedrock reports, so the profiles can be recalibrated from real traffic.
+
+Every model has a context window and an output ceiling, and an approximate output rate. A
+prompt that would leave too little room for the answer is trimmed in the middle (or rejected),
+and max_tokens is sized from what is left of the context and of the time budget.
+
+streamlit_app/token_budget.py is a copy for the Streamlit client's token counts; keep the two
+files identical (benchmarks/shared_modules.py checks).
+"""
+import math
+import re
+
+# Letters and digits per token, and fixed prompt template overhead in tokens, per provider family
+FAMILY_PROFILES = {
+    "anthropic": {"letters_per_token": 4.0, "digits_per_token": 3, "overhead": 12},
+    "amazon": {"letters_per_token": 4.0, "digits_per_token": 3, "overhead": 4},
+    "meta": {"letters_per_token": 3.5, "digits_per_token": 1, "overhead": 8},
+    "mistral": {"letters_per_token": 3.5, "digits_per_token": 1, "overhead": 10},
+    "cohere": {"letters_per_token": 4.0, "digits_per_token": 3, "overhead": 4},
+    "ai21": {"letters_per_token": 5.0, "digits_per_token": 3, "overhead": 4},
+}
+
+# Context window, output ceiling and approximate output tokens per second. Model IDs match by
+# prefix, longest first; the family entry covers model IDs not listed.
+MODEL_LIMITS = {
+    "anthropic.claude-3-haiku": {"context": 200000, "max_output": 4096, "tokens_per_second": 100},
+    "anthropic.claude-3-sonnet": {"context": 200000, "max_output": 4096, "tokens_per_second": 50},
+    "anthropic.claude-v2": {"context": 100000, "max_output": 4096, "tokens_per_second": 40},
+    "anthropic.claude-instant": {"context": 100000, "max_output": 4096, "tokens_per_second": 80},
+    "anthropic": {"context": 100000, "max_output": 4096, "tokens_per_second": 40},
+    "amazon.titan-text-lite": {"context": 4096, "max_output": 4096, "tokens_per_second": 60},
+    "amazon.titan-text-express": {"context": 8192, "max_output": 8192, "tokens_per_second": 50},
+    "amazon": {"context": 4096, "max_output": 4096, "tokens_per_second": 50},
+    "meta.llama2-70b": {"context": 4096, "max_output": 2048, "tokens_per_second": 25},
+    "meta": {"context": 4096, "max_output": 2048, "tokens_per_second": 45},
+    "mistral.mistral-large": {"context": 32000, "max_output": 8192, "tokens_per_second": 30},
+    "mistral": {"context": 32000, "max_output": 8192, "tokens_per_second": 60},
+    "cohere": {"context": 4096, "max_output": 4000, "tokens_per_second": 40},
+    "ai21": {"context": 8191, "max_output": 8191, "tokens_per_second": 40},
+}
+
+# Seconds before the first output token, budgeted on top of the output rate
+FIRST_TOKEN_LATENCY = 1.0
+
+_limit_prefixes = sorted(MODEL_LIMITS, key=len, reverse=True)
+
+TRIM_MARKER = "\n...[trimmed]...\n"
+
+_pieces = re.compile(r"[A-Za-z]+|\d+|\S")
+
+
+class BudgetError(ValueError):
+    """Raised when a prompt doesn't fit the model's budget and can't be trimmed to fit."""
+
+
+def provider_family(model_id):
+    family = model_id.split(".")[0]
+    return family if family in FAMILY_PROFILES else "amazon"
+
+
+def model_limits(model_id):
+    """The limits of the longest MODEL_LIMITS prefix of model_id."""
+    for prefix in _limit_prefixes:
+        if model_id.startswith(prefix):
+            return MODEL_LIMITS[prefix]
+    return MODEL_LIMITS[provider_family(model_id)]
+
+
+def estimate_tokens(text, family="amazon"):
+    """Estimates the tokens of text for a provider family, without the prompt template."""
+    profile = FAMILY_PROFILES.get(family, FAMILY_PROFILES["amazon"])
+    tokens = 0
+    for piece in _pieces.findall(text):
+        if piece[0].isdigit():
+            tokens += math.ceil(len(piece) / profile["digits_per_token"])
+        elif piece[0].isalpha():
+            tokens += math.ceil(len(piece) / profile["letters_per_token"])
+        else:
+            # Punctuation and non-ASCII characters are usually a token each
+            tokens += 1
+    return tokens
+
+
+def trim_middle(text, keep_chars):
+    """Keeps the first two thirds and the last third of keep_chars, marking the cut."""
+    if len(text) <= keep_chars:
+        return text
+    keep_chars = max(0, keep_chars - len(TRIM_MARKER))
+    head = keep_chars * 2 // 3
+    tail = keep_chars - head
+    return text[:head] + TRIM_MARKER + (text[-tail:] if tail else "")
+
+
+def plan(model_id, prompt, max_tokens, image_tokens=0, mode="trim", time_left=None, latency_budget=None,
+         min_output_tokens=256):
+    """
+    Fits a text call into the model's budget. Returns a dict with the prompt to send (trimmed
+    when mode is "trim"), the estimated input tokens, the max_tokens to request and the
+    estimated tokens trimmed. Raises BudgetError when mode is "reject" and the prompt is too
+    long, or when the time left can't fit even a short answer.
+
+    The time budget is the smaller of time_left (the invocation's remaining seconds) and
+    latency_budget; max_tokens is lowered to what the model can produce within it. When that,
+    rather than the context or the output ceiling, sets max_tokens, "time_limited" is True.
+    """
+    family = provider_family(model_id)
+    limits = model_limits(model_id)
+    overhead = FAMILY_PROFILES[family]["overhead"] + image_tokens
+    input_tokens = estimate_tokens(prompt, family) + overhead
+    original_tokens = input_tokens
+
+    # The prompt may use the context minus room for at least a short answer
+    reserve = min(max_tokens, min_output_tokens)
+    max_input = limits["context"] - reserve
+    if input_tokens > max_input:
+        if mode == "reject":
+            raise BudgetError(f"The prompt is about {input_tokens} tokens; {model_id} accepts about {max_input}.")
+        # Scale the kept characters by the token ratio, then shrink until the estimate fits
+        text_budget = max(0, max_input - overhead)
+        keep_chars = int(len(prompt) * text_budget / max(1, input_tokens - overhead))
+        while True:
+            trimmed = trim_middle(prompt, keep_chars)
+            input_tokens = estimate_tokens(trimmed, family) + overhead
+            if input_tokens <= max_input or keep_chars == 0:
+                break
+            keep_chars = int(keep_chars * 0.9)
+        if input_tokens > max_input:
+            # The template and image alone exceed the budget
+            raise BudgetError(f"The request is about {input_tokens} tokens without its text; {model_id} accepts about {max_input}.")
+        prompt = trimmed
+
+    output_tokens = min(max_tokens, limits["max_output"], limits["context"] - input_tokens)
+    time_limited = False
+    budgets = [seconds for seconds in (time_left, latency_budget) if seconds is not None]
+    if budgets:
+        seconds = min(budgets) - FIRST_TOKEN_LATENCY
+        timely_tokens = int(seconds * limits["tokens_per_second"])
+        if timely_tokens < min(reserve, 16):
+            raise BudgetError(f"{model_id} can't answer within the {min(budgets):.1f}s left.")
+        time_limited = timely_tokens < output_tokens
+        output_tokens = min(output_tokens, timely_tokens)
+
+    return {
+        "prompt": prompt,
+        "input_tokens": input_tokens,
+        "max_tokens": max(1, output_tokens),
+        "trimmed_tokens": original_tokens - input_tokens,
+        "time_limited": time_limited,
+    }